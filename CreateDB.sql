@@ -1,4 +1,5 @@
 CREATE DATABASE cashflow;
+-- после создания таблиц выполнить python migrations.py upgrade: миграции будут отмечены примененными
 
 CREATE TABLE public.users
 (
@@ -144,29 +145,104 @@ ALTER TABLE IF EXISTS public.categories
     OWNER to pi;
 
 
-CREATE VIEW public.inflow_lastsum
- AS
- SELECT inflow.description,
-    inflow.sum,
-    inflow.owner_id
-   FROM inflow
-  WHERE inflow.date = ( SELECT max(inflow_1.date) AS max
-           FROM inflow inflow_1
-          WHERE inflow_1.description = inflow.description and inflow.owner_id = inflow_1.owner_id);
-
-ALTER TABLE public.inflow_lastsum
-    OWNER TO pi;
-
-
-CREATE VIEW public.outflow_lastsum
- AS
- SELECT outflow.description,
-    outflow.sum,
-    outflow.owner_id
-   FROM outflow
-  WHERE outflow.date = ( SELECT max(outflow_1.date) AS max
-           FROM outflow outflow_1
-          WHERE outflow_1.description = outflow.description and outflow.owner_id = outflow_1.owner_id);
-
-ALTER TABLE public.outflow_lastsum
-    OWNER TO pi;
+CREATE TABLE public.data_versions
+(
+	owner_id integer REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+	resource text NOT NULL,
+	version integer NOT NULL DEFAULT 0,
+	CONSTRAINT pk_data_versions PRIMARY KEY (owner_id, resource)
+)
+
+WITH (
+    OIDS = FALSE
+);
+
+ALTER TABLE IF EXISTS public.data_versions
+    OWNER to pi;
+
+
+CREATE UNIQUE INDEX ix_users_email ON public.users (email);
+CREATE INDEX ix_users_username ON public.users (username);
+CREATE INDEX ix_inflow_owner_id_date ON public.inflow (owner_id, date);
+CREATE INDEX ix_inflow_owner_id_description ON public.inflow (owner_id, description);
+CREATE INDEX ix_outflow_owner_id_date ON public.outflow (owner_id, date);
+CREATE INDEX ix_outflow_owner_id_description ON public.outflow (owner_id, description);
+CREATE INDEX ix_inflow_regular_owner_id ON public.inflow_regular (owner_id);
+CREATE INDEX ix_outflow_regular_owner_id ON public.outflow_regular (owner_id);
+CREATE INDEX ix_assets_owner_id_date_in_date_out ON public.assets (owner_id, date_in, date_out);
+CREATE INDEX ix_liabilities_owner_id_date_in_date_out ON public.liabilities (owner_id, date_in, date_out);
+CREATE INDEX ix_categories_owner_id ON public.categories (owner_id);
+
+
+CREATE TABLE public.inflow_lastsum
+(
+	owner_id integer REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+	description text NOT NULL,
+	date timestamp without time zone NOT NULL,
+	sum integer NOT NULL,
+	flow_id integer NOT NULL,
+	CONSTRAINT pk_inflow_lastsum PRIMARY KEY (owner_id, description)
+)
+
+WITH (
+    OIDS = FALSE
+);
+
+ALTER TABLE IF EXISTS public.inflow_lastsum
+    OWNER to pi;
+
+
+CREATE TABLE public.outflow_lastsum
+(
+	owner_id integer REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+	description text NOT NULL,
+	date timestamp without time zone NOT NULL,
+	sum integer NOT NULL,
+	flow_id integer NOT NULL,
+	CONSTRAINT pk_outflow_lastsum PRIMARY KEY (owner_id, description)
+)
+
+WITH (
+    OIDS = FALSE
+);
+
+ALTER TABLE IF EXISTS public.outflow_lastsum
+    OWNER to pi;
+
+
+CREATE TABLE public.flow_monthly
+(
+	owner_id integer REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+	month timestamp without time zone NOT NULL,
+	kind text NOT NULL,
+	description text NOT NULL,
+	sum integer NOT NULL,
+	count integer NOT NULL,
+	CONSTRAINT pk_flow_monthly PRIMARY KEY (owner_id, month, kind, description)
+)
+
+WITH (
+    OIDS = FALSE
+);
+
+ALTER TABLE IF EXISTS public.flow_monthly
+    OWNER to pi;
+
+
+CREATE TABLE public.outflow_usage
+(
+	owner_id integer REFERENCES users(id) ON DELETE CASCADE NOT NULL,
+	description text NOT NULL,
+	count integer NOT NULL,
+	last_used timestamp without time zone NOT NULL,
+	CONSTRAINT pk_outflow_usage PRIMARY KEY (owner_id, description)
+)
+
+WITH (
+    OIDS = FALSE
+);
+
+ALTER TABLE IF EXISTS public.outflow_usage
+    OWNER to pi;
+
+CREATE INDEX ix_outflow_usage_owner_id_count ON outflow_usage (owner_id, count);
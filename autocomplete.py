@@ -0,0 +1,64 @@
+import heapq
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from cache import TTLCache
+from config import AUTOCOMPLETE_CACHE_SIZE, AUTOCOMPLETE_CACHE_TTL
+
+
+class PrefixIndex:
+    # описания доходов и расходов пользователя, отсортированные по ключу без учета регистра;
+    # поиск по префиксу - бинарный поиск начала диапазона и просмотр подходящих ключей
+    def __init__(self):
+        self.keys = []
+        self.stats = dict()
+
+    def add(self, description: str, date: datetime, count: int = 1):
+        if description not in self.stats:
+            insort(self.keys, (description.casefold(), description))
+            self.stats[description] = (count, date)
+        else:
+            total, last_used = self.stats[description]
+            self.stats[description] = (total + count, max(last_used, date))
+
+    def remove(self, description: str, count: int = 1):
+        if description not in self.stats:
+            return
+        total, last_used = self.stats[description]
+        if total > count:
+            self.stats[description] = (total - count, last_used)
+            return
+        del self.stats[description]
+        key = (description.casefold(), description)
+        self.keys.pop(bisect_left(self.keys, key))
+
+    def matches(self, prefix: str):
+        for position in range(bisect_left(self.keys, (prefix,)), len(self.keys)):
+            key, description = self.keys[position]
+            if not key.startswith(prefix):
+                return
+            yield description
+
+    def search(self, prefix: str, limit: int):
+        # подсказки ранжируются по числу использований, затем по дате последнего использования;
+        # из совпадений отбираются limit лучших кучей, без сортировки всех (короткий префикс - почти весь индекс)
+        return heapq.nlargest(limit, self.matches(prefix.casefold()),
+                              key=lambda description: self.stats[description])
+
+
+# индексы недавно обращавшихся пользователей; ttl ограничивает расхождение с записями,
+# сделанными другими процессами приложения
+indexes = TTLCache(maxsize=AUTOCOMPLETE_CACHE_SIZE, ttl=AUTOCOMPLETE_CACHE_TTL)
+
+
+def flows_created(user_id: int, rows: list):
+    index = indexes.get(user_id)
+    if index is not None:
+        for row in rows:
+            index.add(row['description'], row['date'])
+
+
+def flow_deleted(user_id: int, row):
+    index = indexes.get(user_id)
+    if index is not None:
+        index.remove(row['description'])
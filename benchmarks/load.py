@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import subprocess
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+from benchmarks.seed import OUTFLOWS
+
+
+def month_range(rng: random.Random, months: int):
+    # случайный месяц из последних months, как при листании истории в интерфейсе
+    now = datetime.now()
+    begin = datetime(now.year, now.month, 1)
+    for _ in range(rng.randrange(months)):
+        begin = (begin - timedelta(days=1)).replace(day=1)
+    end = (begin + timedelta(days=31)).replace(day=1) - timedelta(seconds=1)
+    return {"date_in": begin.isoformat(), "date_out": end.isoformat()}
+
+
+async def month_outflow(client, session):
+    return await client.get(f"/users/{session['id']}/outflow/", headers=session["headers"],
+                            params=month_range(session["rng"], session["months"]))
+
+
+async def month_inflow(client, session):
+    return await client.get(f"/users/{session['id']}/inflow/", headers=session["headers"],
+                            params=month_range(session["rng"], session["months"]))
+
+
+async def assets(client, session):
+    return await client.get(f"/users/{session['id']}/assets/", headers=session["headers"])
+
+
+async def reports(client, session):
+    return await client.get(f"/users/{session['id']}/reports/", headers=session["headers"])
+
+
+async def most_popular(client, session):
+    return await client.get(f"/users/{session['id']}/most_popular/", headers=session["headers"])
+
+
+async def export(client, session):
+    return await client.get(f"/users/{session['id']}/export/", headers=session["headers"])
+
+
+async def create_outflow(client, session):
+    return await client.post(f"/users/{session['id']}/outflow/", headers=session["headers"],
+                             json={"description": session["rng"].choice(OUTFLOWS),
+                                   "sum": session["rng"].randrange(50, 15000)})
+
+
+# маршрут в отчете, вес в профиле нагрузки и запрос
+PROFILE = (
+    ("GET /users/{user_id}/outflow/", 30, month_outflow),
+    ("GET /users/{user_id}/inflow/", 10, month_inflow),
+    ("GET /users/{user_id}/assets/", 10, assets),
+    ("GET /users/{user_id}/reports/", 15, reports),
+    ("GET /users/{user_id}/most_popular/", 15, most_popular),
+    ("POST /users/{user_id}/outflow/", 18, create_outflow),
+    ("GET /users/{user_id}/export/", 2, export),
+)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = dict()
+        self.errors = dict()
+
+    async def measure(self, route: str, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            response, failed = None, True
+        self.latencies.setdefault(route, []).append(time.perf_counter() - started)
+        if failed:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+    def report(self, seconds: float):
+        routes = dict()
+        for route, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            routes[route] = {"count": len(latencies), "errors": self.errors.get(route, 0),
+                             "rps": round(len(latencies) / seconds, 1),
+                             **{f"p{rank}_ms": round(percentile(latencies, rank) * 1000, 2) for rank in (50, 95, 99)},
+                             "max_ms": round(latencies[-1] * 1000, 2)}
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {"seconds": round(seconds, 1), "requests": total, "errors": sum(self.errors.values()),
+                "rps": round(total / seconds, 1), "routes": routes}
+
+
+def percentile(values: list, rank: int):
+    # ближайший ранг по отсортированному списку
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+async def virtual_user(client, recorder: Recorder, number: int, deadline: float, args):
+    rng = random.Random(args.seed + number)
+    username = f"{args.prefix}{number % args.users + 1}"
+    response = await recorder.measure("POST /token", client.post("/token", data={"username": username,
+                                                                                  "password": args.password}))
+    if response is None or response.status_code != 200:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await recorder.measure("GET /user", client.get("/user", headers=headers))
+    if response is None or response.status_code != 200:
+        return
+    session = {"id": response.json()["id"], "headers": headers, "rng": rng, "months": args.months}
+    routes, weights, requests = zip(*PROFILE)
+    while time.perf_counter() < deadline:
+        index = rng.choices(range(len(routes)), weights)[0]
+        await recorder.measure(routes[index], requests[index](client, session))
+
+
+async def drive(client, args):
+    recorder = Recorder()
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(client, recorder, number, started + args.duration, args)
+                           for number in range(args.concurrency)))
+    return recorder.report(time.perf_counter() - started)
+
+
+async def load(args):
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+            return await drive(client, args)
+    # без --url приложение работает в этом же процессе, запросы идут через ASGI без сети
+    import main
+    app = main.create_app(database_url=args.database_url)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark",
+                                     timeout=args.timeout) as client:
+            return await drive(client, args)
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    result = {"commit": commit(), "started": datetime.now().isoformat(timespec="seconds"),
+              "target": args.url or "in-process",
+              "concurrency": args.concurrency, "duration": args.duration}
+    result.update(asyncio.run(load(args)))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP load profile against users created by benchmarks.seed")
+    parser.add_argument("--url", help="base URL of a running server; without it the app runs in-process")
+    parser.add_argument("--database-url", help="database of the in-process app (by default from the config)")
+    parser.add_argument("--users", type=int, default=10, help="number of seeded users to log in as")
+    parser.add_argument("--prefix", default="bench")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--concurrency", type=int, default=10, help="virtual users sending requests one by one")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--months", type=int, default=24, help="month views are spread over the last N months")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to a file instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as fileobj:
+            fileobj.write(report + "\n")
+    else:
+        print(report)
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import crud
+import migrations
+import schemas
+import security
+from database import database, metadata
+
+INFLOWS = ["Зарплата", "Премия", "Проценты по вкладу", "Кэшбэк", "Подработка"]
+OUTFLOWS = ["Продукты", "Кафе", "Транспорт", "Такси", "Аптека", "Кино", "Книги", "Одежда", "Связь", "Интернет",
+            "Коммунальные услуги", "Спорт", "Подарки", "Цветы", "Ремонт", "Бытовая химия", "Заправка", "Парковка",
+            "Стрижка", "Путешествия"]
+ASSETS = ["Вклад", "Брокерский счет", "Наличные", "Квартира", "Автомобиль"]
+LIABILITIES = ["Ипотека", "Автокредит", "Кредитная карта"]
+CATEGORIES = ["Деньги", "Инвестиции", "Недвижимость", "Транспорт", "Прочее"]
+
+
+def month_starts(years: int):
+    now = datetime.now()
+    month = datetime(now.year - years, now.month, 1)
+    months = []
+    while month <= now:
+        months.append(month)
+        month = (month + timedelta(days=31)).replace(day=1)
+    return months
+
+
+def revaluations(rng: random.Random, months: list, count: int, amount: int):
+    # цепочка записей актива или пассива: каждая переоценка закрывает предыдущую запись в конце прошлого месяца
+    points = sorted(rng.sample(months[1:], min(count, len(months) - 1)))
+    periods = []
+    for date_in, date_out in zip([months[0]] + points, points + [None]):
+        date_out = date_out - timedelta(seconds=1) if date_out else datetime.now() + timedelta(days=100000)
+        periods.append((date_in, date_out, amount))
+        amount = max(1, round(amount * rng.uniform(0.9, 1.15)))
+    return periods
+
+
+def prepare_schema():
+    if database.dialect == "sqlite":
+        metadata.create_all(database.get_engine())
+    else:
+        migrations.upgrade()
+
+
+async def seed_user(rng: random.Random, number: int, hashed_password: str, args):
+    username = f"{args.prefix}{number}"
+    if await crud.get_user_by_username(username=username) is not None:
+        return None
+    user = await crud.create_user(schemas.UserCreate(username=username, email=f"{username}@example.com",
+                                                     password="", invite=""), hashed_password=hashed_password)
+    months = month_starts(args.years)
+
+    category_ids = []
+    for category in CATEGORIES[:args.categories]:
+        created = await crud.create_user_category(schemas.CategoryCreate(category=category), user_id=user.id)
+        category_ids.append(created["id"])
+    for description in INFLOWS[:1]:
+        await crud.create_user_inflow_regular(schemas.InflowRegularCreate(description=description, sum=100000),
+                                              user_id=user.id)
+    for description in OUTFLOWS[:3]:
+        await crud.create_user_outflow_regular(schemas.OutflowRegularCreate(description=description, sum=10000),
+                                               user_id=user.id)
+
+    # частые описания встречаются чаще редких (веса 1/n), чтобы most_popular и автодополнение работали как в жизни
+    weights = [1 / rank for rank in range(1, len(OUTFLOWS) + 1)]
+    rows = 0
+    for month in months:
+        days = ((month + timedelta(days=31)).replace(day=1) - month).days
+        inflows = [schemas.InflowCreate(date=month + timedelta(days=rng.randrange(days), hours=rng.randrange(24)),
+                                        description=rng.choice(INFLOWS), sum=rng.randrange(1000, 150000))
+                   for _ in range(max(1, args.per_month // 10))]
+        outflows = [schemas.OutflowCreate(date=month + timedelta(days=rng.randrange(days), hours=rng.randrange(24)),
+                                          description=rng.choices(OUTFLOWS, weights)[0], sum=rng.randrange(50, 15000))
+                    for _ in range(args.per_month)]
+        await crud.create_user_inflows(inflow_list=inflows, user_id=user.id)
+        await crud.create_user_outflows(outflow_list=outflows, user_id=user.id)
+        rows += len(inflows) + len(outflows)
+
+    for index, description in enumerate(ASSETS[:args.assets]):
+        category_id = category_ids[index % len(category_ids)] if category_ids else None
+        for date_in, date_out, amount in revaluations(rng, months, args.revaluations, rng.randrange(10000, 5000000)):
+            await crud.create_user_asset(schemas.AssetCreate(date_in=date_in, date_out=date_out,
+                                                             description=description, sum=amount,
+                                                             category_id=category_id), user_id=user.id)
+    for description in LIABILITIES[:args.liabilities]:
+        for date_in, date_out, amount in revaluations(rng, months, args.revaluations, rng.randrange(10000, 3000000)):
+            await crud.create_user_liabilitie(schemas.LiabilitieCreate(date_in=date_in, date_out=date_out,
+                                                                       description=description, sum=amount),
+                                              user_id=user.id)
+    return {"username": username, "id": user.id, "flows": rows}
+
+
+async def seed(args):
+    rng = random.Random(args.seed)
+    hashed_password = await security.get_password_hash(args.password)
+    await database.connect()
+    try:
+        users = []
+        for number in range(1, args.users + 1):
+            user = await seed_user(rng, number, hashed_password, args)
+            if user is not None:
+                users.append(user)
+    finally:
+        await database.disconnect()
+    return users
+
+
+def run(args):
+    if args.database_url:
+        database.configure(args.database_url)
+    started = time.perf_counter()
+    prepare_schema()
+    users = asyncio.run(seed(args))
+    return {"users": len(users), "skipped": args.users - len(users), "flows": sum(user["flows"] for user in users),
+            "seconds": round(time.perf_counter() - started, 1)}
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--database-url", help="by default DATABASE_URL / POSTGRES_* from the config")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--years", type=int, default=2, help="months of history before the current month")
+    parser.add_argument("--per-month", type=int, default=100, help="outflows per user and month (inflows are 1/10)")
+    parser.add_argument("--categories", type=int, default=len(CATEGORIES), choices=range(len(CATEGORIES) + 1))
+    parser.add_argument("--assets", type=int, default=3, choices=range(len(ASSETS) + 1))
+    parser.add_argument("--liabilities", type=int, default=1, choices=range(len(LIABILITIES) + 1))
+    parser.add_argument("--revaluations", type=int, default=6, help="revaluations of every asset and liability")
+    parser.add_argument("--prefix", default="bench", help="users are named <prefix>1..<prefix>N")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed the database with synthetic users and ledgers")
+    add_arguments(parser)
+    print(json.dumps(run(parser.parse_args()), indent=2))
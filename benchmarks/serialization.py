@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import responses
+import schemas
+
+
+def flow_rows(count: int):
+    # строки в том виде, в каком их возвращает crud (словари из asyncpg Record)
+    start = datetime(2020, 1, 1, 12, 0)
+    return [{"id": index, "date": start + timedelta(hours=index), "description": f"Расход {index % 50}",
+             "sum": index % 1000, "owner_id": 1} for index in range(count)]
+
+
+def asset_rows(count: int):
+    start = datetime(2020, 1, 1)
+    return [{"id": index, "date_in": start, "date_out": start + timedelta(days=36500), "description": f"Актив {index}",
+             "sum": index, "category_id": index % 5 or None, "owner_id": 1} for index in range(count)]
+
+
+def pydantic_body(model, content: dict):
+    # то, что делает FastAPI с ответом при response_model: проверка схемой, jsonable_encoder и json.dumps
+    field = create_response_field(name="response", type_=model)
+    return JSONResponse(asyncio.run(serialize_response(field=field, response_content=content))).body
+
+
+def fast_body(model, content: dict):
+    return responses.FastJSONResponse(responses.project(model, content)).body
+
+
+def measure(func, model, content: dict, rows: int, repeat: int):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = func(model, content)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"total_ms": round(best * 1000, 3), "per_row_us": round(best * 1e6 / rows, 3), "bytes": len(body)}
+
+
+def run(rows: int, repeat: int):
+    cases = {"inflow": (schemas.InflowUser, {"inflow": flow_rows(rows), "next_cursor": None}),
+             "assets": (schemas.AssetUser, {"assets": asset_rows(rows)})}
+    result = dict()
+    for name, (model, content) in cases.items():
+        assert json.loads(pydantic_body(model, content)) == json.loads(fast_body(model, content))
+        before = measure(pydantic_body, model, content, rows, repeat)
+        after = measure(fast_body, model, content, rows, repeat)
+        result[name] = {"rows": rows, "response_model": before, "fast_json": after,
+                        "speedup": round(before["total_ms"] / after["total_ms"], 1)}
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-row cost of list response serialization")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if responses.orjson is None:
+        raise SystemExit("orjson is not installed")
+    print(json.dumps(run(args.rows, args.repeat), indent=2))
@@ -0,0 +1,124 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # ограниченный по размеру LRU-кэш, записи которого живут не дольше ttl секунд
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires <= time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self.data[key] = (value, time.monotonic() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class CacheBackend:
+    # хранилище кэша ответов: значения - байты, ключи помечаются тегами для инвалидации;
+    # общий для нескольких процессов бэкенд (например, redis) реализует те же методы
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def generation(self, tags: list):
+        # снимок счетчиков инвалидации тегов до чтения из базы; set с устаревшим снимком ничего не сохраняет,
+        # чтобы ответ, прочитанный до фиксации изменений, не попал в кэш после инвалидации
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, tags: list, generation):
+        raise NotImplementedError
+
+    async def invalidate(self, *tags: str):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    # LRU в памяти процесса с ограничением общего размера значений (байт) и временем жизни записи
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.tags = dict()
+        self.generations = dict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def remove(self, key):
+        value, expires, tags = self.data.pop(key)
+        self.size -= len(value)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    async def get(self, key: str):
+        item = self.data.get(key)
+        if item is None or item[1] <= time.monotonic():
+            if item is not None:
+                self.remove(key)
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    async def generation(self, tags: list):
+        return tuple(self.generations.get(tag, 0) for tag in tags)
+
+    async def set(self, key: str, value: bytes, tags: list, generation):
+        if len(value) > self.max_bytes or generation != await self.generation(tags):
+            return
+        if key in self.data:
+            self.remove(key)
+        self.data[key] = (value, time.monotonic() + self.ttl, tags)
+        self.size += len(value)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.data)))
+            self.evictions += 1
+
+    async def invalidate(self, *tags: str):
+        for tag in tags:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+            for key in list(self.tags.get(tag, ())):
+                self.remove(key)
+                self.invalidations += 1
+
+    def stats(self):
+        return {"backend": "memory", "entries": len(self.data), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations}
@@ -3,19 +3,75 @@ import schemas
 
 config = Config(schemas.Settings.Config.env_file)
 
-POSTGRES_USER = config('POSTGRES_USER')
-POSTGRES_PASSWORD = config('POSTGRES_PASSWORD')
-POSTGRES_HOST = config('POSTGRES_HOST')
-POSTGRES_PORT = config('POSTGRES_PORT', cast=int)
-DATABASE_NAME = config('DATABASE_NAME')
-MY_INVITE = config('MY_INVITE')
-DEMO_USER_ID = config('DEMO_USER_ID', cast=int)
-EXCEPTION_PER_SEC_LIMIT = config('EXCEPTION_PER_SEC_LIMIT', cast=int)
+POSTGRES_USER = config('POSTGRES_USER', default='postgres')
+POSTGRES_PASSWORD = config('POSTGRES_PASSWORD', default='')
+POSTGRES_HOST = config('POSTGRES_HOST', default='localhost')
+POSTGRES_PORT = config('POSTGRES_PORT', cast=int, default=5432)
+DATABASE_NAME = config('DATABASE_NAME', default='cashflow')
+# без приглашения регистрация закрыта, без демо-пользователя (id 0 не бывает) демо-режима нет
+MY_INVITE = config('MY_INVITE', default=None)
+DEMO_USER_ID = config('DEMO_USER_ID', cast=int, default=0)
+EXCEPTION_PER_SEC_LIMIT = config('EXCEPTION_PER_SEC_LIMIT', cast=int, default=1)
+
+# фоновая выгрузка xlsx: каталог готовых файлов, число одновременных выгрузок и время жизни задач (сек)
+EXPORT_DIR = config('EXPORT_DIR', default='export')
+EXPORT_WORKERS = config('EXPORT_WORKERS', cast=int, default=2)
+EXPORT_JOB_TTL = config('EXPORT_JOB_TTL', cast=int, default=3600)
+
+# кэш проверенных токенов и записей пользователей: размер и время жизни записи (сек)
+AUTH_CACHE_SIZE = config('AUTH_CACHE_SIZE', cast=int, default=10000)
+AUTH_CACHE_TTL = config('AUTH_CACHE_TTL', cast=int, default=60)
+
+# стоимость bcrypt (подбирается командой python security.py calibrate), число потоков хэширования
+# и длина очереди запросов на хэширование, после которой /token и /register отвечают 503
+BCRYPT_ROUNDS = config('BCRYPT_ROUNDS', cast=int, default=12)
+HASH_WORKERS = config('HASH_WORKERS', cast=int, default=2)
+HASH_QUEUE_LIMIT = config('HASH_QUEUE_LIMIT', cast=int, default=32)
+
+# максимальное число записей в одном запросе на массовое добавление доходов/расходов
+BULK_MAX_ITEMS = config('BULK_MAX_ITEMS', cast=int, default=10000)
+
+# максимальный размер страницы при постраничной выдаче доходов/расходов
+PAGE_MAX_LIMIT = config('PAGE_MAX_LIMIT', cast=int, default=1000)
+
+# индексы подсказок по описаниям: число пользователей в памяти и время жизни индекса (сек)
+AUTOCOMPLETE_CACHE_SIZE = config('AUTOCOMPLETE_CACHE_SIZE', cast=int, default=1000)
+AUTOCOMPLETE_CACHE_TTL = config('AUTOCOMPLETE_CACHE_TTL', cast=int, default=600)
+
+# кэш ответов читающих запросов: общий размер значений (байт) и время жизни записи (сек)
+RESPONSE_CACHE_BYTES = config('RESPONSE_CACHE_BYTES', cast=int, default=64 * 1024 * 1024)
+RESPONSE_CACHE_TTL = config('RESPONSE_CACHE_TTL', cast=int, default=300)
+
+# списки отдаются через orjson (если установлен) без построения pydantic-объектов для каждой строки
+FAST_JSON = config('FAST_JSON', cast=bool, default=False)
+
+# пул соединений PostgreSQL: размер, ожидание свободного соединения (сек), кэш подготовленных запросов
+# на соединение и время (сек), после которого простаивающее соединение закрывается
+DB_POOL_MIN_SIZE = config('DB_POOL_MIN_SIZE', cast=int, default=2)
+DB_POOL_MAX_SIZE = config('DB_POOL_MAX_SIZE', cast=int, default=10)
+DB_POOL_ACQUIRE_TIMEOUT = config('DB_POOL_ACQUIRE_TIMEOUT', cast=float, default=10.0)
+DB_STATEMENT_CACHE_SIZE = config('DB_STATEMENT_CACHE_SIZE', cast=int, default=100)
+# сколько чтений всех открытых сводок месяца (dashboard) процесса идут одновременно, каждое на своем соединении
+DASHBOARD_CONCURRENCY = config('DASHBOARD_CONCURRENCY', cast=int, default=3)
+DB_CONNECTION_LIFETIME = config('DB_CONNECTION_LIFETIME', cast=float, default=300.0)
+
+# журнал медленных запросов: порог (мс, 0 - выключен), доля записываемых медленных запросов, записей в минуту
+# и интервал (сек), чаще которого план одного и того же запроса не снимается
+SLOW_QUERY_MS = config('SLOW_QUERY_MS', cast=float, default=500.0)
+SLOW_QUERY_SAMPLE_RATE = config('SLOW_QUERY_SAMPLE_RATE', cast=float, default=1.0)
+SLOW_QUERY_LOG_PER_MINUTE = config('SLOW_QUERY_LOG_PER_MINUTE', cast=int, default=10)
+SLOW_QUERY_EXPLAIN_INTERVAL = config('SLOW_QUERY_EXPLAIN_INTERVAL', cast=int, default=600)
+
+# каталог со сборкой frontend; если его нет, статика не подключается
+STATIC_DIR = config('STATIC_DIR', default='static')
 
 # to get a string like this run:
 # openssl rand -hex 32
-SECRET_KEY = config('SECRET_KEY')
+# обязателен для PostgreSQL; только в режиме SQLite без него ключ генерируется при запуске (см. main.check_secret_key)
+SECRET_KEY = config('SECRET_KEY', default=None)
 
-SQLALCHEMY_DATABASE_URL = \
-    f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{DATABASE_NAME}"
+# DATABASE_URL задает базу целиком, например sqlite:///./cashflow.db для тестов и бенчмарков
+SQLALCHEMY_DATABASE_URL = config(
+    'DATABASE_URL',
+    default=f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{DATABASE_NAME}")
 
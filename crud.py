@@ -1,13 +1,96 @@
-import os
+import asyncio
+import base64
+import contextvars
+import functools
+import inspect
+import json
+import pickle
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-
-from database import database
-from sqlalchemy import and_, func
-from models import users, inflows, inflows_regular, outflows, outflows_regular, assets, liabilities, categories
+from typing import List, Optional
+
+from database import carried_contextvars, database, gather
+from sqlalchemy import DateTime, and_, case, cast, func, literal, literal_column, select, tuple_, type_coerce
+from models import users, inflows, inflows_regular, outflows, outflows_regular, assets, liabilities, categories, \
+    data_versions, flows_monthly
+import autocomplete
+import metrics
 import schemas
+from cache import MemoryCache, TTLCache
+from config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL, DASHBOARD_CONCURRENCY, RESPONSE_CACHE_BYTES, \
+    RESPONSE_CACHE_TTL
+
+BULK_BATCH_SIZE = 1000
+
+users_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+# кэш результатов читающих функций; теги вида "user_id:ресурс" сбрасываются после фиксации изменений
+response_cache = MemoryCache(max_bytes=RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL)
+pending_invalidations = contextvars.ContextVar("pending_invalidations", default=None)
+# изменения данных в памяти процесса (индекс подсказок), отложенные до фиксации транзакции
+pending_commit_actions = contextvars.ContextVar("pending_commit_actions", default=None)
+# версии данных пользователя, уже прочитанные в этом запросе для ETag: (user_id, {ресурс: версия})
+request_versions = contextvars.ContextVar("request_versions", default=None)
+carried_contextvars.append(request_versions)
+
+
+def cache_tag(user_id: int, resource: str):
+    return f"{user_id}:{resource}"
+
+
+def cached(*resources: str):
+    # результат кэшируется по пользователю и параметрам вызова до изменения любого из ресурсов; кэш у каждого
+    # процесса свой, а теги сбрасываются только в процессе, который писал, поэтому в ключ входят и версии
+    # ресурсов из базы - запись через другой процесс меняет ключ
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            user_id = arguments.arguments['user_id']
+            versions = await get_request_versions(user_id)
+            key = f"{func.__name__}:{sorted(arguments.arguments.items())!r}:" \
+                  f"{[versions.get(resource, 0) for resource in resources]!r}"
+            tags = [cache_tag(user_id, resource) for resource in resources]
+            value = await response_cache.get(key)
+            if value is not None:
+                return pickle.loads(value)
+            generation = await response_cache.generation(tags)
+            result = await func(*args, **kwargs)
+            await response_cache.set(key, pickle.dumps(result), tags, generation)
+            return result
+        return wrapper
+    return decorator
+
+
+@asynccontextmanager
+async def transaction():
+    # транзакция, после фиксации которой из кэша удаляются ответы по ресурсам, отмеченным в bump_data_version,
+    # и выполняются действия after_commit; при откате не происходит ни того, ни другого
+    pending = []
+    actions = []
+    token = pending_invalidations.set(pending)
+    actions_token = pending_commit_actions.set(actions)
+    try:
+        async with database.transaction():
+            yield
+    finally:
+        pending_commit_actions.reset(actions_token)
+        pending_invalidations.reset(token)
+    for action, args in actions:
+        action(*args)
+    await response_cache.invalidate(*pending)
+
+
+def after_commit(action, *args):
+    pending = pending_commit_actions.get()
+    if pending is None:
+        action(*args)
+    else:
+        pending.append((action, args))
 
-from openpyxl import load_workbook
-from openpyxl.styles import Font
 
 async def get_user(user_id: int):
     result = await database.fetch_one(users.select().where(users.c.id == user_id))
@@ -25,6 +108,20 @@ async def get_user_by_username(username: str):
     return await database.fetch_one(users.select().where(users.c.username == username))
 
 
+async def get_cached_user_by_username(username: str):
+    user = users_cache.get(username)
+    if user is None:
+        result = await get_user_by_username(username)
+        if result:
+            user = dict(result)
+            users_cache.set(username, user)
+    return user
+
+
+def invalidate_user(username: str):
+    users_cache.pop(username)
+
+
 async def get_users(skip: int = 0, limit: int = 100):
      results = await database.fetch_all(users.select().offset(skip).limit(limit))
      return [dict(result) for result in results]
@@ -33,50 +130,376 @@ async def get_users(skip: int = 0, limit: int = 100):
 async def create_user(user: schemas.UserCreate, hashed_password: str):
     db_user = users.insert().values(username=user.username, email=user.email, hashed_password=hashed_password, is_active=user.is_active)
     user_id = await database.execute(db_user)
+    invalidate_user(user.username)
     return schemas.User(**user.dict(), id=user_id)
 
 
-async def create_user_inflow(inflow: schemas.InflowCreate, user_id: int):
-    query = inflows.insert().values(**inflow.dict(), owner_id=user_id)
-    inflow_id = await database.execute(query)
-    return schemas.InflowInDB(**inflow.dict(), id=inflow_id, owner_id=user_id)
+async def update_user_password(user_id: int, username: str, hashed_password: str):
+    query = users.update().where(users.c.id == user_id).values(hashed_password=hashed_password)
+    await database.execute(query)
+    invalidate_user(username)
 
 
-async def get_inflow_user(user_id: int, date_in: datetime, date_out: datetime):
-    result = dict()
-    list_inflows = await database.fetch_all(inflows.select().where(and_(inflows.c.owner_id == user_id,
-                                                                        inflows.c.date >= date_in,
-                                                                        inflows.c.date <= date_out)))
-    result.update({"inflow": [dict(result) for result in list_inflows]})
+async def bump_data_version(user_id: int, *resources: str):
+    query = "INSERT INTO data_versions (owner_id, resource, version) VALUES (:owner_id, :resource, 1) " \
+            "ON CONFLICT (owner_id, resource) DO UPDATE SET version = data_versions.version + 1"
+    await database.execute_many(query=query, values=[{"owner_id": user_id, "resource": resource}
+                                                     for resource in resources])
+    tags = [cache_tag(user_id, resource) for resource in resources]
+    pending = pending_invalidations.get()
+    if pending is None:
+        await response_cache.invalidate(*tags)
+    else:
+        pending.extend(tags)
+
+
+async def get_data_versions(user_id: int):
+    list_versions = await database.fetch_all(data_versions.select().where(data_versions.c.owner_id == user_id))
+    return {result['resource']: result['version'] for result in list_versions}
+
+
+async def get_request_versions(user_id: int):
+    # версии, прочитанные для ETag этого запроса, иначе из базы
+    known = request_versions.get()
+    if known is not None and known[0] == user_id:
+        return known[1]
+    return await get_data_versions(user_id)
+
+
+def rows_source(rows: list, columns: dict):
+    # записи пачки как таблица batch в одном запросе: в PostgreSQL - unnest массивов по столбцам (число
+    # параметров не зависит от размера пачки), в SQLite - json_each; columns - {имя: тип PostgreSQL}
+    names = list(columns)
+    if database.dialect == "postgresql":
+        arrays = ", ".join(f"CAST(:{name} AS {type}[])" for name, type in columns.items())
+        return f"unnest({arrays}) AS batch({', '.join(names)})", \
+            {name: [row[name] for row in rows] for name in names}
+    fields = ", ".join(f"json_extract(value, '$[{number}]') AS {name}" for number, name in enumerate(names))
+    # даты в том же текстовом виде, в котором их хранит SQLAlchemy
+    values = json.dumps([[row[name] for name in names] for row in rows],
+                        default=lambda value: value.isoformat(" ", "microseconds"))
+    return f"(SELECT {fields} FROM json_each(:batch)) AS batch", {"batch": values}
+
+
+async def update_lastsum(flow: str, user_id: int, rows: list):
+    # последняя по дате сумма для (owner_id, description), при равных датах побеждает более поздняя запись
+    source, values = rows_source(rows, {"date": "timestamp", "description": "varchar", "sum": "integer",
+                                        "id": "integer"})
+    query = f"INSERT INTO {flow}_lastsum (owner_id, description, date, sum, flow_id) " \
+            "SELECT CAST(:owner_id AS integer), description, date, sum, id FROM (" \
+            "SELECT description, date, sum, id, " \
+            f"row_number() OVER (PARTITION BY description ORDER BY date DESC, id DESC) AS position FROM {source}" \
+            ") AS latest WHERE position = 1 ORDER BY description " \
+            "ON CONFLICT (owner_id, description) DO UPDATE " \
+            "SET date = excluded.date, sum = excluded.sum, flow_id = excluded.flow_id " \
+            f"WHERE ({flow}_lastsum.date, {flow}_lastsum.flow_id) <= (excluded.date, excluded.flow_id)"
+    await database.execute(query=query, values=dict(values, owner_id=user_id))
+
+
+async def refresh_lastsum(flow: str, user_id: int, description: str, flow_id: int):
+    # если удалена последняя запись, ее место занимает предыдущая по дате
+    query = f"DELETE FROM {flow}_lastsum " \
+            "WHERE owner_id = :owner_id AND description = :description AND flow_id = :flow_id RETURNING flow_id"
+    if await database.fetch_one(query=query, values={"owner_id": user_id, "description": description,
+                                                      "flow_id": flow_id}):
+        query = f"INSERT INTO {flow}_lastsum (owner_id, description, date, sum, flow_id) " \
+                f"SELECT owner_id, description, date, sum, id FROM {flow} " \
+                "WHERE owner_id = :owner_id AND description = :description " \
+                "ORDER BY date DESC, id DESC LIMIT 1 ON CONFLICT (owner_id, description) DO NOTHING"
+        await database.execute(query=query, values={"owner_id": user_id, "description": description})
+
+
+def month_of(date: datetime):
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+async def update_monthly(flow: str, user_id: int, rows: list):
+    # помесячные суммы и количество записей по описаниям; ключи идут в одном порядке,
+    # чтобы параллельные пачки не блокировали друг друга; WHERE true нужен SQLite, иначе ON CONFLICT
+    # после SELECT разбирается неоднозначно
+    source, values = rows_source([dict(row, month=month_of(row['date'])) for row in rows],
+                                 {"month": "timestamp", "description": "varchar", "sum": "integer"})
+    query = "INSERT INTO flow_monthly (owner_id, month, kind, description, sum, count) " \
+            "SELECT CAST(:owner_id AS integer), month, CAST(:kind AS varchar), description, sum(sum), count(*) " \
+            f"FROM {source} WHERE true GROUP BY month, description ORDER BY month, description " \
+            "ON CONFLICT (owner_id, month, kind, description) DO UPDATE " \
+            "SET sum = flow_monthly.sum + excluded.sum, count = flow_monthly.count + excluded.count"
+    await database.execute(query=query, values=dict(values, owner_id=user_id, kind=flow))
+
+
+async def subtract_monthly(flow: str, user_id: int, row):
+    values = {"owner_id": user_id, "month": month_of(row['date']), "kind": flow, "description": row['description']}
+    query = "UPDATE flow_monthly SET sum = sum - :sum, count = count - 1 " \
+            "WHERE owner_id = :owner_id AND month = :month AND kind = :kind AND description = :description"
+    await database.execute(query=query, values=dict(values, sum=row['sum']))
+    query = "DELETE FROM flow_monthly " \
+            "WHERE owner_id = :owner_id AND month = :month AND kind = :kind AND description = :description " \
+            "AND count <= 0"
+    await database.execute(query=query, values=values)
+
+
+async def update_usage(user_id: int, rows: list):
+    # сколько раз и когда последний раз использовалось описание расхода
+    source, values = rows_source(rows, {"description": "varchar", "date": "timestamp"})
+    query = "INSERT INTO outflow_usage (owner_id, description, count, last_used) " \
+            f"SELECT CAST(:owner_id AS integer), description, count(*), max(date) FROM {source} " \
+            "WHERE true GROUP BY description ORDER BY description " \
+            "ON CONFLICT (owner_id, description) DO UPDATE " \
+            "SET count = outflow_usage.count + excluded.count, " \
+            "last_used = CASE WHEN excluded.last_used > outflow_usage.last_used " \
+            "THEN excluded.last_used ELSE outflow_usage.last_used END"
+    await database.execute(query=query, values=dict(values, owner_id=user_id))
+
+
+async def subtract_usage(user_id: int, row):
+    # дата последнего использования берется из уже обновленной outflow_lastsum
+    values = {"owner_id": user_id, "description": row['description']}
+    query = "UPDATE outflow_usage SET count = count - 1, last_used = coalesce(" \
+            "(SELECT date FROM outflow_lastsum WHERE owner_id = :owner_id AND description = :description), " \
+            "last_used) WHERE owner_id = :owner_id AND description = :description"
+    await database.execute(query=query, values=values)
+    query = "DELETE FROM outflow_usage WHERE owner_id = :owner_id AND description = :description AND count <= 0"
+    await database.execute(query=query, values=values)
+
+
+async def flows_created(flow: str, user_id: int, rows: list):
+    # производные данные по доходам/расходам обновляются в той же транзакции, что и сами записи
+    await update_lastsum(flow, user_id, rows)
+    await update_monthly(flow, user_id, rows)
+    if flow == "outflow":
+        await update_usage(user_id, rows)
+    await bump_data_version(user_id, flow)
+    after_commit(autocomplete.flows_created, user_id, rows)
+
+
+async def flow_deleted(flow: str, user_id: int, row):
+    await refresh_lastsum(flow, user_id, row['description'], row['id'])
+    await subtract_monthly(flow, user_id, row)
+    if flow == "outflow":
+        await subtract_usage(user_id, row)
+    await bump_data_version(user_id, flow)
+    after_commit(autocomplete.flow_deleted, user_id, row)
+
+
+async def insert_rows(table, rows: list):
+    # многострочные INSERT ... RETURNING пачками; возвращаются вставленные записи целиком
+    result = []
+    if database.dialect == "postgresql":
+        for begin in range(0, len(rows), BULK_BATCH_SIZE):
+            query = table.insert().values(rows[begin:begin + BULK_BATCH_SIZE]).returning(table)
+            result += [dict(row) for row in await database.fetch_all(query)]
+    else:
+        # SQLAlchemy не строит RETURNING для SQLite, записи вставляются по одной
+        for row in rows:
+            result.append(dict(row, id=await database.execute(table.insert().values(**row))))
     return result
 
 
-async def delete_inflow_user(inflow_id: int, user_id: int):
-    query = inflows.select().where(and_(inflows.c.id == inflow_id, inflows.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        query = inflows.delete().where(and_(inflows.c.id == inflow_id, inflows.c.owner_id == user_id))
-        await database.execute(query)
-        result = {"result": "inflow deleted"}
-    else:
-        result = {"result": "inflow for delete not found"}
+async def insert_owned(table, item, user_id: int):
+    return (await insert_rows(table, [dict(**item.dict(), owner_id=user_id)]))[0]
+
+
+async def update_owned(table, row_id: int, user_id: int, values: dict):
+    # проверка владельца и изменение одним запросом: UPDATE ... WHERE id AND owner_id RETURNING
+    condition = and_(table.c.id == row_id, table.c.owner_id == user_id)
+    if database.dialect == "postgresql":
+        return await database.fetch_one(table.update().where(condition).values(**values).returning(table))
+    await database.execute(table.update().where(condition).values(**values))
+    return await database.fetch_one(table.select().where(condition))
+
+
+async def delete_owned(table, row_id: int, user_id: int, *conditions):
+    # удаленная запись или None, если записи нет, она чужая или не выполнены дополнительные условия
+    condition = and_(table.c.id == row_id, table.c.owner_id == user_id, *conditions)
+    if database.dialect == "postgresql":
+        return await database.fetch_one(table.delete().where(condition).returning(table))
+    row = await database.fetch_one(table.select().where(condition))
+    if row is not None:
+        await database.execute(table.delete().where(condition))
+    return row
+
+
+async def close_owned(table, user_id: int, date_out: dict):
+    # закрытие нескольких своих записей одним UPDATE ... SET date_out = CASE id ... END RETURNING
+    condition = and_(table.c.owner_id == user_id, table.c.id.in_(list(date_out)))
+    # asyncpg без приведения типа считает параметр в CASE текстом, sqlite от CAST AS DATETIME оставляет только год
+    typed = cast if database.dialect == "postgresql" else literal
+    whens = {row_id: typed(value, table.c.date_out.type) for row_id, value in date_out.items()}
+    query = table.update().where(condition).values(date_out=case(whens, value=table.c.id))
+    if database.dialect == "postgresql":
+        return [dict(row) for row in await database.fetch_all(query.returning(table))]
+    await database.execute(query)
+    return [dict(row) for row in await database.fetch_all(table.select().where(condition))]
+
+
+async def revalue_owned(table, resource: str, user_id: int, revaluations: list):
+    # переоценка: запись закрывается концом месяца перед date, при ненулевой сумме с начала этого месяца
+    # открывается новая с той же категорией (описание и категорию можно заменить); закрытие и вставка -
+    # по одному запросу на всю пачку в одной транзакции; если хоть одной записи нет, не меняется ничего
+    async with transaction():
+        closed = {row['id']: row for row in await close_owned(
+            table, user_id, {item['id']: month_of(item['date']) - timedelta(seconds=1) for item in revaluations})}
+        missing = [item['id'] for item in revaluations if item['id'] not in closed]
+        if missing:
+            raise LookupError(missing)
+        rows = [{"date_in": month_of(item['date']), "date_out": datetime.now() + timedelta(days=100000),
+                 "description": item.get('description') or closed[item['id']]['description'], "sum": item['sum'],
+                 "category_id": item.get('category_id') or closed[item['id']]['category_id'], "owner_id": user_id}
+                for item in revaluations if item['sum'] > 0]
+        created = await insert_rows(table, rows)
+        await bump_data_version(user_id, resource)
+    return created
+
+
+async def create_flows(table, flow: str, items: list, user_id: int):
+    async with transaction():
+        result = await insert_rows(table, [dict(**item.dict(), owner_id=user_id) for item in items])
+        await flows_created(flow, user_id, result)
     return result
 
 
+async def import_flows(flow: str, user_id: int, batches):
+    # строки выписки копируются через COPY во временную таблицу и переносятся одним INSERT ... SELECT;
+    # строка пропускается, если такая же (дата, описание, сумма) уже есть у пользователя столько же раз,
+    # сколько она встретилась в файле до этого места - повторный импорт той же выписки ничего не добавит.
+    # Пачки разбираются по мере копирования, в памяти одна пачка (main передает уже принятую выгрузку)
+    total = 0
+    async with transaction():
+        # импорты одного пользователя идут по очереди, иначе два одинаковых файла оба пройдут проверку на повторы
+        await database.execute(query="SELECT pg_advisory_xact_lock(hashtext(:lock), :owner_id)",
+                               values={"lock": f"{flow}_import", "owner_id": user_id})
+        connection = database.connection().raw_connection
+        await connection.execute("CREATE TEMP TABLE import_staging (line bigint, date timestamp, "
+                                 "description varchar, sum integer, row_hash varchar) ON COMMIT DROP")
+        async for batch in batches:
+            total += len(batch)
+            await connection.copy_records_to_table("import_staging", records=batch,
+                                                   columns=["line", "date", "description", "sum", "row_hash"])
+        query = f"WITH staging AS (SELECT line, date, description, sum, " \
+                f"row_number() OVER (PARTITION BY row_hash ORDER BY line) AS occurrence FROM import_staging) " \
+                f"INSERT INTO {flow} (date, description, sum, owner_id) " \
+                f"SELECT date, description, sum, :owner_id FROM staging " \
+                f"WHERE occurrence > (SELECT count(*) FROM {flow} WHERE {flow}.owner_id = :owner_id " \
+                f"AND {flow}.date = staging.date AND {flow}.description = staging.description " \
+                f"AND {flow}.sum = staging.sum) " \
+                f"ORDER BY line RETURNING id, date, description, sum, owner_id"
+        rows = [dict(row) for row in await database.fetch_all(query=query, values={"owner_id": user_id})]
+        if rows:
+            await flows_created(flow, user_id, rows)
+    return {"total": total, "imported": len(rows), "skipped": total - len(rows)}
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(f"{row['date'].isoformat()}|{row['id']}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    # курсор - позиция (date, id) последней выданной записи; испорченный курсор дает ValueError
+    date, flow_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(date), int(flow_id)
+
+
+def flows_query(table, user_id: int, date_in: datetime, date_out: datetime, limit: Optional[int] = None,
+                after: Optional[tuple] = None):
+    # постраничная выдача по ключу (date, id) идет по индексу (owner_id, date) без OFFSET
+    query = table.select().where(and_(table.c.owner_id == user_id, table.c.date >= date_in, table.c.date <= date_out))
+    if after is not None:
+        query = query.where(tuple_(table.c.date, table.c.id) > tuple_(*after))
+    return query.order_by(table.c.date, table.c.id).limit(limit)
+
+
+async def get_flows(table, flow: str, user_id: int, date_in: datetime, date_out: datetime,
+                    limit: Optional[int] = None, after: Optional[tuple] = None):
+    rows = [dict(row) for row in await database.fetch_all(flows_query(table, user_id, date_in, date_out,
+                                                                      limit, after))]
+    next_cursor = encode_cursor(rows[-1]) if limit is not None and len(rows) == limit else None
+    return {flow: rows, "next_cursor": next_cursor}
+
+
+def flow_period(table, group_by: str):
+    # начало дня или недели (с понедельника); единица подставляется в SQL текстом, иначе
+    # date_trunc в SELECT и GROUP BY получают разные параметры и PostgreSQL не считает их одним выражением
+    if database.dialect == "postgresql":
+        return func.date_trunc(literal_column(f"'{group_by}'"), table.c.date)
+    modifiers = ("weekday 0", "-6 days") if group_by == "week" else ()
+    return type_coerce(func.datetime(table.c.date, "start of day", *modifiers), DateTime)
+
+
+async def get_flow_groups(table, flow: str, user_id: int, date_in: datetime, date_out: datetime, group_by: str):
+    # суммы и число записей за период по описанию (частые сначала) или по дням/неделям
+    if group_by == "description":
+        key = table.c.description
+        order = [func.count().desc(), key]
+    else:
+        key = flow_period(table, group_by).label("date")
+        order = [key]
+    query = select([key, func.sum(table.c.sum).label("sum"), func.count().label("count")]) \
+        .where(and_(table.c.owner_id == user_id, table.c.date >= date_in, table.c.date <= date_out)) \
+        .group_by(key).order_by(*order)
+    return {flow: [dict(row) for row in await database.fetch_all(query)]}
+
+
+async def iterate_flows(table, user_id: int, date_in: datetime, date_out: datetime, limit: Optional[int] = None,
+                        after: Optional[tuple] = None):
+    # записи читаются серверным курсором по мере отправки ответа, без загрузки всего периода в память
+    async for row in database.iterate(flows_query(table, user_id, date_in, date_out, limit, after)):
+        yield dict(row)
+
+
+async def create_user_inflow(inflow: schemas.InflowCreate, user_id: int):
+    async with transaction():
+        row = await insert_owned(inflows, inflow, user_id)
+        await flows_created("inflow", user_id, [row])
+    return row
+
+
+async def create_user_inflows(inflow_list: List[schemas.InflowCreate], user_id: int):
+    return {"inflow": await create_flows(inflows, "inflow", inflow_list, user_id)}
+
+
+def iterate_inflow_user(user_id: int, date_in: datetime, date_out: datetime, limit: Optional[int] = None,
+                        after: Optional[tuple] = None):
+    return iterate_flows(inflows, user_id, date_in, date_out, limit, after)
+
+
+async def import_user_inflows(batches, user_id: int):
+    return await import_flows("inflow", user_id, batches)
+
+
+@cached("inflow")
+async def get_inflow_user(user_id: int, date_in: datetime, date_out: datetime, limit: Optional[int] = None,
+                          after: Optional[tuple] = None):
+    return await get_flows(inflows, "inflow", user_id, date_in, date_out, limit, after)
+
+
+@cached("inflow")
+async def get_inflow_groups_user(user_id: int, date_in: datetime, date_out: datetime, group_by: str):
+    return await get_flow_groups(inflows, "inflow", user_id, date_in, date_out, group_by)
+
+
+async def delete_inflow_user(inflow_id: int, user_id: int):
+    async with transaction():
+        row = await delete_owned(inflows, inflow_id, user_id)
+        if row is not None:
+            await flow_deleted("inflow", user_id, row)
+    return {"result": "inflow deleted" if row is not None else "inflow for delete not found"}
+
+
 async def create_user_inflow_regular(inflow_regular: schemas.InflowRegularCreate, user_id: int):
-    query = inflows_regular.insert().values(**inflow_regular.dict(), owner_id=user_id)
-    inflow_regular_id = await database.execute(query)
-    return schemas.InflowRegularInDB(**inflow_regular.dict(), id=inflow_regular_id, owner_id=user_id)
+    async with transaction():
+        row = await insert_owned(inflows_regular, inflow_regular, user_id)
+        await bump_data_version(user_id, "inflow_regular")
+    return row
 
 
 async def get_inflow_regular_user(user_id: int):
     result = dict()
-    query = "SELECT inflow_regular.description, inflow_lastsum.sum, inflow_regular.id, inflow_regular.owner_id " \
-            "FROM inflow_regular, inflow_lastsum WHERE inflow_regular.owner_id = :owner_id " \
-            "AND inflow_regular.owner_id = inflow_lastsum.owner_id " \
-            "AND inflow_regular.description = inflow_lastsum.description " \
-            "UNION SELECT description, sum, id, owner_id FROM inflow_regular WHERE description NOT IN (" \
-            "SELECT description FROM inflow WHERE owner_id = :owner_id) AND owner_id = :owner_id"
+    # сумма регулярного дохода - последняя фактическая, если такие записи уже были
+    query = "SELECT inflow_regular.description, coalesce(inflow_lastsum.sum, inflow_regular.sum) AS sum, " \
+            "inflow_regular.id, inflow_regular.owner_id FROM inflow_regular " \
+            "LEFT JOIN inflow_lastsum ON inflow_lastsum.owner_id = inflow_regular.owner_id " \
+            "AND inflow_lastsum.description = inflow_regular.description " \
+            "WHERE inflow_regular.owner_id = :owner_id"
 
     list_inflows_regular = await database.fetch_all(query=query, values={"owner_id": user_id})
     '''
@@ -88,85 +511,76 @@ async def get_inflow_regular_user(user_id: int):
 
 
 async def update_user_inflow_regular(user_id: int, inflow_regular: schemas.InflowRegularOut):
-    query = inflows_regular.select().where(and_(inflows_regular.c.id == inflow_regular.id,
-                                           inflows_regular.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        query = inflows_regular.update().where(
-            and_(inflows_regular.c.id == inflow_regular.id, inflows_regular.c.owner_id == user_id)).values(
-            description=inflow_regular.description, sum=inflow_regular.sum)
-        await database.execute(query)
-        result = {"result": "inflow regular updated"}
-    else:
-        result = {"result": "inflow regular for update not found"}
-    return result
+    async with transaction():
+        row = await update_owned(inflows_regular, inflow_regular.id, user_id,
+                                 {"description": inflow_regular.description, "sum": inflow_regular.sum})
+        if row is not None:
+            await bump_data_version(user_id, "inflow_regular")
+    return {"result": "inflow regular updated" if row is not None else "inflow regular for update not found"}
 
 
 async def delete_inflow_regular_user(inflow_regular_id: int, user_id: int):
-    query = inflows_regular.select().where(and_(inflows_regular.c.id == inflow_regular_id,
-                                                inflows_regular.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        query = inflows_regular.delete().where(and_(inflows_regular.c.id == inflow_regular_id,
-                                               inflows_regular.c.owner_id == user_id))
-        await database.execute(query)
-        result = {"result": "regular inflow deleted"}
-    else:
-        result = {"result": "regular inflow for delete not found"}
-    return result
+    async with transaction():
+        row = await delete_owned(inflows_regular, inflow_regular_id, user_id)
+        if row is not None:
+            await bump_data_version(user_id, "inflow_regular")
+    return {"result": "regular inflow deleted" if row is not None else "regular inflow for delete not found"}
 
 
 async def create_user_outflow(outflow: schemas.OutflowCreate, user_id: int):
-    query = outflows.insert().values(**outflow.dict(), owner_id=user_id)
-    outflow_id = await database.execute(query)
-    return schemas.OutflowInDB(**outflow.dict(), id=outflow_id, owner_id=user_id)
+    async with transaction():
+        row = await insert_owned(outflows, outflow, user_id)
+        await flows_created("outflow", user_id, [row])
+    return row
 
 
-async def get_outflow_user(user_id: int, date_in: datetime, date_out: datetime):
-    '''
-    # вариант c группировкой и суммированием по аналогичным расходам за период
-    result = dict()
-    query = "SELECT description, sum(sum) as sum, count(description) as count FROM outflow " \
-            "WHERE owner_id = :owner_id AND date >= :date_in AND date <= :date_out " \
-            "GROUP BY description, owner_id " \
-            "ORDER BY count DESC"
-    list_outflows = await database.fetch_all(query=query, values={"owner_id": user_id, "date_in": date_in,
-                                                                  "date_out": date_out})
-    '''
-    # вариант без группировки и суммирования по аналогичным расходам за период
-    result = dict()
-    list_outflows = await database.fetch_all(outflows.select().where(
-        and_(outflows.c.owner_id == user_id, outflows.c.date >= date_in, outflows.c.date <= date_out)))
-    result.update({"outflow": [dict(result) for result in list_outflows]})
-    return result
+async def create_user_outflows(outflow_list: List[schemas.OutflowCreate], user_id: int):
+    return {"outflow": await create_flows(outflows, "outflow", outflow_list, user_id)}
+
+
+async def import_user_outflows(batches, user_id: int):
+    return await import_flows("outflow", user_id, batches)
+
+
+def iterate_outflow_user(user_id: int, date_in: datetime, date_out: datetime, limit: Optional[int] = None,
+                         after: Optional[tuple] = None):
+    return iterate_flows(outflows, user_id, date_in, date_out, limit, after)
+
+
+@cached("outflow")
+async def get_outflow_user(user_id: int, date_in: datetime, date_out: datetime, limit: Optional[int] = None,
+                           after: Optional[tuple] = None):
+    return await get_flows(outflows, "outflow", user_id, date_in, date_out, limit, after)
+
+
+@cached("outflow")
+async def get_outflow_groups_user(user_id: int, date_in: datetime, date_out: datetime, group_by: str):
+    return await get_flow_groups(outflows, "outflow", user_id, date_in, date_out, group_by)
 
 
 async def delete_outflow_user(outflow_id: int, user_id: int):
-    query = outflows.select().where(and_(outflows.c.id == outflow_id, outflows.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        query = outflows.delete().where(and_(outflows.c.id == outflow_id, outflows.c.owner_id == user_id))
-        await database.execute(query)
-        result = {"result": "outflow deleted"}
-    else:
-        result = {"result": "outflow for delete not found"}
-    return result
+    async with transaction():
+        row = await delete_owned(outflows, outflow_id, user_id)
+        if row is not None:
+            await flow_deleted("outflow", user_id, row)
+    return {"result": "outflow deleted" if row is not None else "outflow for delete not found"}
 
 
 async def create_user_outflow_regular(outflow_regular: schemas.OutflowRegularCreate, user_id: int):
-    query = outflows_regular.insert().values(**outflow_regular.dict(), owner_id=user_id)
-    outflow_regular_id = await database.execute(query)
-    return schemas.OutflowRegularInDB(**outflow_regular.dict(), id=outflow_regular_id, owner_id=user_id)
+    async with transaction():
+        row = await insert_owned(outflows_regular, outflow_regular, user_id)
+        await bump_data_version(user_id, "outflow_regular")
+    return row
 
 
 async def get_outflow_regular_user(user_id: int):
     result = dict()
-    query = "SELECT outflow_regular.description, outflow_lastsum.sum, outflow_regular.id, outflow_regular.owner_id " \
-            "FROM outflow_regular, outflow_lastsum WHERE outflow_regular.owner_id = :owner_id " \
-            "AND outflow_regular.owner_id = outflow_lastsum.owner_id " \
-            "AND outflow_regular.description = outflow_lastsum.description " \
-            "UNION SELECT description, sum, id, owner_id FROM outflow_regular WHERE description NOT IN (" \
-            "SELECT description FROM outflow WHERE owner_id = :owner_id) AND owner_id = :owner_id"
+    # сумма регулярного расхода - последняя фактическая, если такие записи уже были
+    query = "SELECT outflow_regular.description, coalesce(outflow_lastsum.sum, outflow_regular.sum) AS sum, " \
+            "outflow_regular.id, outflow_regular.owner_id FROM outflow_regular " \
+            "LEFT JOIN outflow_lastsum ON outflow_lastsum.owner_id = outflow_regular.owner_id " \
+            "AND outflow_lastsum.description = outflow_regular.description " \
+            "WHERE outflow_regular.owner_id = :owner_id"
 
     list_outflows_regular = await database.fetch_all(query=query, values={"owner_id": user_id})
     '''
@@ -178,40 +592,30 @@ async def get_outflow_regular_user(user_id: int):
 
 
 async def update_user_outflow_regular(user_id: int, outflow_regular: schemas.OutflowRegularOut):
-    query = outflows_regular.select().where(and_(outflows_regular.c.id == outflow_regular.id,
-                                                 outflows_regular.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        query = outflows_regular.update().where(
-            and_(outflows_regular.c.id == outflow_regular.id, outflows_regular.c.owner_id == user_id)).values(
-            description=outflow_regular.description, sum=outflow_regular.sum)
-        await database.execute(query)
-        result = {"result": "outflow regular updated"}
-    else:
-        result = {"result": "outflow regular for update not found"}
-    return result
+    async with transaction():
+        row = await update_owned(outflows_regular, outflow_regular.id, user_id,
+                                 {"description": outflow_regular.description, "sum": outflow_regular.sum})
+        if row is not None:
+            await bump_data_version(user_id, "outflow_regular")
+    return {"result": "outflow regular updated" if row is not None else "outflow regular for update not found"}
 
 
 async def delete_outflow_regular_user(outflow_regular_id: int, user_id: int):
-    query = outflows_regular.select().where(and_(outflows_regular.c.id == outflow_regular_id,
-                                                 outflows_regular.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        query = outflows_regular.delete().where(and_(outflows_regular.c.id == outflow_regular_id,
-                                                outflows_regular.c.owner_id == user_id))
-        await database.execute(query)
-        result = {"result": "regular outflow deleted"}
-    else:
-        result = {"result": "regular outflow for delete not found"}
-    return result
+    async with transaction():
+        row = await delete_owned(outflows_regular, outflow_regular_id, user_id)
+        if row is not None:
+            await bump_data_version(user_id, "outflow_regular")
+    return {"result": "regular outflow deleted" if row is not None else "regular outflow for delete not found"}
 
 
 async def create_user_asset(asset: schemas.AssetCreate, user_id: int):
-    query = assets.insert().values(**asset.dict(), owner_id=user_id)
-    asset_id = await database.execute(query)
-    return schemas.AssetInDB(**asset.dict(), id=asset_id, owner_id=user_id)
+    async with transaction():
+        row = await insert_owned(assets, asset, user_id)
+        await bump_data_version(user_id, "assets")
+    return row
 
 
+@cached("assets")
 async def get_assets_user(user_id: int, date: datetime):
     result = dict()
     list_assets = await database.fetch_all(assets.select().where(and_(assets.c.owner_id == user_id,
@@ -222,36 +626,31 @@ async def get_assets_user(user_id: int, date: datetime):
 
 
 async def update_user_asset(asset: schemas.AssetOut, user_id: int):
-    query = assets.select().where(and_(assets.c.id == asset.id, assets.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        dt = asset.date
-        dt_end = datetime.strptime(f"{dt.timetuple().tm_year}-{dt.timetuple().tm_mon}-01 00:00:00", "%Y-%m-%d %H:%M:%S") \
-                 - timedelta(seconds=1)
-        query = assets.update().where(and_(assets.c.id == asset.id, assets.c.owner_id == user_id)).values(
-            date_out=dt_end)
-        await database.execute(query)
-        if hasattr(asset, 'sum') and asset.sum > 0:
-            dt = datetime.now()
-            dt_begin = datetime.strptime(f"{dt.timetuple().tm_year}-{dt.timetuple().tm_mon}-01 00:00:00",
-                                         "%Y-%m-%d %H:%M:%S")
-            query = assets.insert().values(date_in=dt_begin, date_out=datetime.now() + timedelta(days=100000),
-                                           description=asset.description, sum=asset.sum, owner_id=user_id)
-            await database.execute(query)
-            result = {"result": "asset updated"}
-        else:
-            result = {"result": "asset deleted"}
-    else:
-        result = {"result": "asset for update/delete not found"}
-    return result
+    # переоценка с начала месяца даты записи; у AssetOut даты нет, поэтому PUT закрывает запись концом
+    # прошлого месяца и открывает новую с начала текущего (month_of(now)) с той же категорией, если она
+    # не передана; DELETE (AssetDelete) закрывает запись концом месяца перед asset.date
+    revaluation = {"id": asset.id, "sum": getattr(asset, 'sum', 0), "date": getattr(asset, 'date', datetime.now()),
+                   "description": getattr(asset, 'description', None),
+                   "category_id": getattr(asset, 'category_id', None)}
+    try:
+        await revalue_owned(assets, "assets", user_id, [revaluation])
+    except LookupError:
+        return {"result": "asset for update/delete not found"}
+    return {"result": "asset updated" if revaluation['sum'] > 0 else "asset deleted"}
+
+
+async def revalue_user_assets(revaluations: List[schemas.Revaluation], user_id: int):
+    return {"assets": await revalue_owned(assets, "assets", user_id, [item.dict() for item in revaluations])}
 
 
 async def create_user_liabilitie(liabilitie: schemas.LiabilitieCreate, user_id: int):
-    query = liabilities.insert().values(**liabilitie.dict(), owner_id=user_id)
-    liabilitie_id = await database.execute(query)
-    return schemas.LiabilitieInDB(**liabilitie.dict(), id=liabilitie_id, owner_id=user_id)
+    async with transaction():
+        row = await insert_owned(liabilities, liabilitie, user_id)
+        await bump_data_version(user_id, "liabilities")
+    return row
 
 
+@cached("liabilities")
 async def get_liabilities_user(user_id: int, date: datetime):
     result = dict()
     list_liabilities = await database.fetch_all(liabilities.select().where(and_(liabilities.c.owner_id == user_id,
@@ -262,40 +661,31 @@ async def get_liabilities_user(user_id: int, date: datetime):
 
 
 async def update_user_liabilitie(liabilitie: schemas.LiabilitieOut, user_id: int):
-    query = liabilities.select().where(and_(liabilities.c.id == liabilitie.id, liabilities.c.owner_id == user_id))
-    result = await database.execute(query)
-    if result:
-        dt = liabilitie.date
-        dt_end = datetime.strptime(f"{dt.timetuple().tm_year}-{dt.timetuple().tm_mon}-01 00:00:00", "%Y-%m-%d %H:%M:%S")\
-                 - timedelta(seconds=1)
-        query = liabilities.update().where(
-            and_(liabilities.c.id == liabilitie.id, liabilities.c.owner_id == user_id))\
-            .values(date_out=dt_end)
-        await database.execute(query)
-        if hasattr(liabilitie, 'sum') and liabilitie.sum > 0:
-            dt = datetime.now()
-            dt_begin = datetime.strptime(f"{dt.timetuple().tm_year}-{dt.timetuple().tm_mon}-01 00:00:00",
-                                         "%Y-%m-%d %H:%M:%S")
-            query = liabilities.insert().values(date_in=dt_begin,
-                                                date_out=datetime.now() + timedelta(days=100000),
-                                                description=liabilitie.description,
-                                                sum=liabilitie.sum,
-                                                owner_id=user_id)
-            await database.execute(query)
-            result = {"result": "liabilitie updated"}
-        else:
-            result = {"result": "liabilitie deleted"}
-    else:
-        result = {"result": "liabilitie for update/delete not found"}
-    return result
+    # как update_user_asset: PUT открывает новую запись с начала текущего месяца, DELETE закрывает по date
+    revaluation = {"id": liabilitie.id, "sum": getattr(liabilitie, 'sum', 0),
+                   "date": getattr(liabilitie, 'date', datetime.now()),
+                   "description": getattr(liabilitie, 'description', None),
+                   "category_id": getattr(liabilitie, 'category_id', None)}
+    try:
+        await revalue_owned(liabilities, "liabilities", user_id, [revaluation])
+    except LookupError:
+        return {"result": "liabilitie for update/delete not found"}
+    return {"result": "liabilitie updated" if revaluation['sum'] > 0 else "liabilitie deleted"}
+
+
+async def revalue_user_liabilities(revaluations: List[schemas.Revaluation], user_id: int):
+    return {"liabilities": await revalue_owned(liabilities, "liabilities", user_id,
+                                               [item.dict() for item in revaluations])}
 
 
 async def create_user_category(category: schemas.CategoryCreate, user_id: int):
-    query = categories.insert().values(**category.dict(), owner_id=user_id)
-    category_id = await database.execute(query)
-    return schemas.CategoryInDB(**category.dict(), id=category_id, owner_id=user_id)
+    async with transaction():
+        row = await insert_owned(categories, category, user_id)
+        await bump_data_version(user_id, "categories")
+    return row
 
 
+@cached("categories")
 async def get_user_categories(user_id: int):
     result = dict()
     list_categories = await database.fetch_all(categories.select().where(categories.c.owner_id == user_id))
@@ -304,24 +694,19 @@ async def get_user_categories(user_id: int):
 
 
 async def delete_user_category(category_id: int, user_id: int):
-    query = "SELECT category_id FROM assets WHERE owner_id = :owner_id AND category_id = :category_id"
-    categories_in_asset = await database.fetch_all(query=query, values={"owner_id": user_id,
-                                                                        "category_id": category_id})
-    query = "SELECT category_id FROM liabilities WHERE owner_id = :owner_id AND category_id = :category_id"
-    categories_in_liabilities = await database.fetch_all(query=query, values={"owner_id": user_id,
-                                                                              "category_id": category_id})
-    if categories_in_asset or categories_in_liabilities:
-        result = {"result": "category in use, not deleted"}
-    else:
-        query = categories.select().where(and_(categories.c.id == category_id, categories.c.owner_id == user_id))
-        result = await database.execute(query)
-        if result:
-            query = categories.delete().where(and_(categories.c.id == category_id, categories.c.owner_id == user_id))
-            await database.execute(query)
-            result = {"result": "category deleted"}
-        else:
-            result = {"result": "category for delete not found"}
-    return result
+    # категория удаляется одним запросом, только если на нее не ссылаются активы и пассивы пользователя
+    in_use = [select([table.c.id]).where(and_(table.c.owner_id == user_id, table.c.category_id == category_id))
+              .exists() for table in (assets, liabilities)]
+    async with transaction():
+        row = await delete_owned(categories, category_id, user_id, ~in_use[0], ~in_use[1])
+        if row is not None:
+            await bump_data_version(user_id, "categories")
+    if row is not None:
+        return {"result": "category deleted"}
+    # причина отказа выясняется только на редком пути, когда ничего не удалено
+    if await database.fetch_val(select([in_use[0] | in_use[1]])):
+        return {"result": "category in use, not deleted"}
+    return {"result": "category for delete not found"}
 
 
 async def get_assets_by_categories(user_id: int, date: datetime, asset: str):
@@ -334,360 +719,184 @@ async def get_assets_by_categories(user_id: int, date: datetime, asset: str):
     return result
 
 
-async def get_reports(user_id: int):
+def regular_monthly_query(flow: str, regular, user_id: int):
+    return select([flows_monthly.c.month.label("date"), flows_monthly.c.description, flows_monthly.c.sum]) \
+        .where(and_(flows_monthly.c.owner_id == user_id, flows_monthly.c.kind == flow,
+                    flows_monthly.c.description.in_(select([regular.c.description])
+                                                    .where(regular.c.owner_id == user_id)))) \
+        .order_by(flows_monthly.c.month)
+
+
+async def build_balance_series(user_id: int, date: datetime):
+    # тот же помесячный ряд, что и в get_balance_series, для баз без generate_series (режим SQLite)
+    periods = []
+    for table in (assets, liabilities):
+        query = select([table.c.date_in, table.c.date_out, table.c.sum]).where(table.c.owner_id == user_id)
+        periods.append(await database.fetch_all(query))
+    if not periods[0] and not periods[1]:
+        return []
+    month = month_of(min(row['date_in'] for rows in periods for row in rows))
+    series = []
+    while month <= month_of(date):
+        day = month + timedelta(days=14)
+        values = [[row['sum'] for row in rows if row['date_in'] <= day <= row['date_out']] for rows in periods]
+        if not values[0] and not values[1]:
+            series = []
+        else:
+            series.append({"date": day, "assets": sum(values[0]), "liabilities": sum(values[1])})
+        month = (month + timedelta(days=31)).replace(day=1)
+    return series[::-1]
+
+
+async def get_balance_series(user_id: int, date: datetime):
+    if database.dialect != "postgresql":
+        return await build_balance_series(user_id, date)
+    # помесячный календарь от первой записи до текущего месяца (на 15-е число) соединяется
+    # с интервалами активов и пассивов; ряд обрывается на последнем месяце без записей
+    query = "WITH bounds AS (" \
+            "SELECT min(date_in) AS date_in FROM (" \
+            "SELECT date_in FROM assets WHERE owner_id = :owner_id " \
+            "UNION ALL SELECT date_in FROM liabilities WHERE owner_id = :owner_id) AS periods), " \
+            "months AS (" \
+            "SELECT generate_series(date_trunc('month', bounds.date_in), date_trunc('month', CAST(:date AS timestamp)), " \
+            "interval '1 month') + interval '14 days' AS date FROM bounds), " \
+            "month_assets AS (" \
+            "SELECT months.date, count(assets.id) AS count, coalesce(sum(assets.sum), 0) AS sum FROM months " \
+            "LEFT JOIN assets ON assets.owner_id = :owner_id " \
+            "AND assets.date_in <= months.date AND months.date <= assets.date_out " \
+            "GROUP BY months.date), " \
+            "month_liabilities AS (" \
+            "SELECT months.date, count(liabilities.id) AS count, coalesce(sum(liabilities.sum), 0) AS sum FROM months " \
+            "LEFT JOIN liabilities ON liabilities.owner_id = :owner_id " \
+            "AND liabilities.date_in <= months.date AND months.date <= liabilities.date_out " \
+            "GROUP BY months.date), " \
+            "series AS (" \
+            "SELECT month_assets.date, month_assets.count + month_liabilities.count AS count, " \
+            "month_assets.sum AS assets, month_liabilities.sum AS liabilities " \
+            "FROM month_assets JOIN month_liabilities ON month_assets.date = month_liabilities.date) " \
+            "SELECT date, assets, liabilities FROM series " \
+            "WHERE date > (SELECT coalesce(max(date), '-infinity') FROM series WHERE count = 0) " \
+            "ORDER BY date DESC"
+    return [dict(row) for row in await database.fetch_all(query=query, values={"owner_id": user_id,
+                                                                                "date": date})]
+
+
+@cached("assets", "liabilities", "inflow", "outflow", "inflow_regular", "outflow_regular")
+async def get_reports(user_id: int, month: datetime):
+    # месяц входит в ключ кэша: с его сменой ряд активов и пассивов продолжается без изменения данных
     out = dict()
-    assets_result = []
-    liabilities_result = []
-
-    dt = datetime.now()
-    while True:
-        date = datetime.strptime(f"{dt.timetuple().tm_year}-{dt.timetuple().tm_mon}-15 00:00:00", "%Y-%m-%d %H:%M:%S")
-        this_month_begin = datetime.strptime(f"{dt.timetuple().tm_year}-{dt.timetuple().tm_mon}-01 00:00:00",
-                                             "%Y-%m-%d %H:%M:%S")
-
-        list_assets = await database.fetch_all(assets.select().where(and_(assets.c.owner_id == user_id,
-                                                                          assets.c.date_in <= date,
-                                                                          date <= assets.c.date_out)))
-        month_assets = [dict(result) for result in list_assets]
-        month_assets_sum = 0
-        for month_asset in month_assets:
-            month_assets_sum += month_asset['sum']
-        month_date = str(date)[5:7] + "." + str(date)[2:4]
-        if month_assets_sum > 0:
-            assets_result.append({"description": month_date, "sum": month_assets_sum})
-
-        list_liabilities = await database.fetch_all(liabilities.select().where(and_(liabilities.c.owner_id == user_id,
-                                                                                    liabilities.c.date_in <= date,
-                                                                                    date <= liabilities.c.date_out)))
-        month_liabilities = [dict(result) for result in list_liabilities]
-        month_liabilities_sum = 0
-        for month_asset in month_liabilities:
-            month_liabilities_sum += month_asset['sum']
-        month_date = str(date)[5:7] + "." + str(date)[2:4]
-        if month_liabilities_sum > 0:
-            liabilities_result.append({ "description": month_date, "sum": month_liabilities_sum})
-
-        dt = this_month_begin - timedelta(seconds=1)
-        if len(list_assets) == 0 and len(list_liabilities) == 0:
-            break
-
-    out.update({"assets": assets_result})
-    out.update({"liabilities": liabilities_result})
-
-    inflow_regular_result = dict()
-    query = "SELECT date, description, sum FROM inflow WHERE owner_id = :owner_id AND description IN " \
-            "(SELECT description FROM inflow_regular WHERE owner_id = :owner_id)"
-    inflow_regular_result = await database.fetch_all(query=query, values={"owner_id": user_id})
-    out.update({"inflow_regular": [dict(result) for result in inflow_regular_result]})
 
-    outflow_regular_result = dict()
-    query = "SELECT date, description, sum FROM outflow WHERE owner_id = :owner_id AND description IN " \
-            "(SELECT description FROM outflow_regular WHERE owner_id = :owner_id)"
-    outflow_regular_result = await database.fetch_all(query=query, values={"owner_id": user_id})
-    out.update({"outflow_regular": [dict(result) for result in outflow_regular_result]})
+    series_query = get_balance_series(user_id, month)
 
-    return out
+    # регулярные доходы и расходы по месяцам из помесячных сумм
+    inflow_regular_query = database.fetch_all(regular_monthly_query("inflow", inflows_regular, user_id))
+    outflow_regular_query = database.fetch_all(regular_monthly_query("outflow", outflows_regular, user_id))
+
+    series_result, inflow_regular_result, outflow_regular_result = \
+        await gather(series_query, inflow_regular_query, outflow_regular_query)
 
+    out.update({"assets": [{"description": month['date'].strftime("%m.%y"), "sum": month['assets']}
+                           for month in series_result if month['assets'] > 0]})
+    out.update({"liabilities": [{"description": month['date'].strftime("%m.%y"), "sum": month['liabilities']}
+                                for month in series_result if month['liabilities'] > 0]})
+    out.update({"inflow_regular": [dict(result) for result in inflow_regular_result]})
+    out.update({"outflow_regular": [dict(result) for result in outflow_regular_result]})
 
-async def get_export(user_id: int):
-    wb = load_workbook('.' + os.sep + 'static' + os.sep + 'export' + os.sep + 'template.xlsx')
-    bold = Font(bold=True)
+    return out
 
-    this_month_end = datetime.now()
-    report = dict()
 
-    # забираем категории пользователя
-    db_user_categories = await get_user_categories(user_id)
-    user_categories = {result['id']:result['category'] for result in db_user_categories['categories']}
-    user_categories[None]='Без категории'
+async def get_monthly_totals(user_id: int):
+    # итоги доходов и расходов по месяцам: {месяц: {"inflow": сумма, "outflow": сумма}}
+    query = select([flows_monthly.c.month, flows_monthly.c.kind, func.sum(flows_monthly.c.sum).label("sum")]) \
+        .where(flows_monthly.c.owner_id == user_id).group_by(flows_monthly.c.month, flows_monthly.c.kind)
+    result = dict()
+    for row in await database.fetch_all(query):
+        result.setdefault(row['month'], {"inflow": 0, "outflow": 0})[row['kind']] = row['sum']
+    return result
 
-    while True:
-        this_month_begin = datetime.strptime(f"{this_month_end.timetuple().tm_year}-{this_month_end.timetuple().tm_mon}"
-                                             f"-01 00:00:00", "%Y-%m-%d %H:%M:%S")
 
-        if this_month_end.timetuple().tm_mon < 10:
-            this_month = f'0{this_month_end.timetuple().tm_mon}'
-        else:
-            this_month = f'{this_month_end.timetuple().tm_mon}'
-        this_year_month = f"{this_month_end.timetuple().tm_year}-{this_month}"
-
-        report[this_year_month] = dict()
-
-        wb.create_sheet(this_year_month)
-        sht = wb[this_year_month]
-        sht.column_dimensions["A"].width = 32
-        sht.column_dimensions["B"].width = 10
-        sht.column_dimensions["C"].width = 8
-        sht.column_dimensions["D"].width = 32
-        sht.column_dimensions["E"].width = 12
-
-        # экспорт доходов
-        cashflow = 0
-        inflows = await get_inflow_user(user_id, this_month_begin, this_month_end)
-        cell = sht.cell(row=1, column=1)
-        cell.value = 'Доходы'
-        cell.font = bold
-        inflow_row = 1
-        inflow_sum = 0
-        row = 2
-        column = 1
-        for month_inflows in inflows['inflow']:
-            cell = sht.cell(row=row, column=column)
-            cell.value = month_inflows['description']
-            cell = sht.cell(row=row, column=column+1)
-            cell.value = month_inflows['sum']
-            inflow_sum += month_inflows['sum']
-            cashflow += month_inflows['sum']
-            row += 1
-
-        # экспорт расходов
-        row += 1
-        outflows = await get_outflow_user(user_id, this_month_begin, this_month_end)
-        cell = sht.cell(row=row, column=column)
-        cell.value = 'Расходы'
-        cell.font = bold
-        outflow_row = row
-        outflow_sum = 0
-        row += 1
-        for month_outflows in outflows['outflow']:
-            cell = sht.cell(row=row, column=column)
-            cell.value = month_outflows['description']
-            cell = sht.cell(row=row, column=column+1)
-            cell.value = month_outflows['sum']
-            outflow_sum += month_outflows['sum']
-            cashflow -= month_outflows['sum']
-            row += 1
-
-        # расчте денежного потока и общих сумм доходов и расходов
-        row += 1
-        cell = sht.cell(row=row, column=column)
-        cell.value = 'Денежный поток'
-        cell.font = bold
-        cell = sht.cell(row=row, column=column+1)
-        cell.value = cashflow
-        cell.font = bold
-
-        cell = sht.cell(row=inflow_row, column=column+1)
-        cell.value = inflow_sum
-        cell.font = bold
-        cell = sht.cell(row=outflow_row, column=column+1)
-        cell.value = outflow_sum
-        cell.font = bold
-
-        # экспорт активов
-        capital = 0
-        assets = await get_assets_user(user_id, this_month_begin+timedelta(days=15))
-        cell = sht.cell(row=1, column=4)
-        cell.value = 'Активы'
-        cell.font = bold
-        assets_row = 1
-        assets_sum = 0
-        row = 2
-        column = 4
-        for month_assets in assets['assets']:
-            cell = sht.cell(row=row, column=column)
-            cell.value = month_assets['description']
-            cell = sht.cell(row=row, column=column+1)
-            cell.value = month_assets['sum']
-            assets_sum += month_assets['sum']
-            capital += month_assets['sum']
-            row += 1
-
-        # экспорт пассивов
-        row += 1
-        liabilities = await get_liabilities_user(user_id, this_month_begin+timedelta(days=15))
-        cell = sht.cell(row=row, column=column)
-        cell.value = 'Пассивы'
-        cell.font = bold
-        liabilities_row = row
-        liabilities_sum = 0
-        row += 1
-        for month_liabilities in liabilities['liabilities']:
-            cell = sht.cell(row=row, column=column)
-            cell.value = month_liabilities['description']
-            cell = sht.cell(row=row, column=column+1)
-            cell.value = month_liabilities['sum']
-            liabilities_sum += month_liabilities['sum']
-            capital -= month_liabilities['sum']
-            row += 1
-
-        # расчет капитала и общих сумм активов и пассивов
-        row += 1
-        cell = sht.cell(row=row, column=column)
-        cell.value = 'Капитал'
-        cell.font = bold
-        cell = sht.cell(row=row, column=column+1)
-        cell.value = capital
-        cell.font = bold
-
-        # суммы по категориям активов и пассивов
-        row += 2
-        cell = sht.cell(row=row, column=column)
-        cell.value = 'По категориям'
-        cell.font = bold
-
-        asset_by_categories = await get_assets_by_categories(user_id, this_month_begin+timedelta(days=15), "assets")
-        row += 1
-        for month_asset_by_categories in asset_by_categories['categories']:
-            cell = sht.cell(row=row, column=column)
-            if month_asset_by_categories['category_id'] is not None:
-                cell.value = user_categories[month_asset_by_categories['category_id']]
-                report[this_year_month][user_categories[month_asset_by_categories['category_id']]] = \
-                    month_asset_by_categories['sum']
-            else:
-                cell.value = "Активы без категории"
-                report[this_year_month]["Активы без категории"] = month_asset_by_categories['sum']
-            cell = sht.cell(row=row, column=column + 1)
-            cell.value = month_asset_by_categories['sum']
-            row += 1
-
-        liabilities_by_categories = await get_assets_by_categories(user_id, this_month_begin+timedelta(days=15),
-                                                                   "liabilities")
-        for month_liabilities_by_categories in liabilities_by_categories['categories']:
-            cell = sht.cell(row=row, column=column)
-            if month_liabilities_by_categories['category_id'] is not None:
-                cell.value = user_categories[month_liabilities_by_categories['category_id']]
-                report[this_year_month][user_categories[month_liabilities_by_categories['category_id']]] = \
-                    month_liabilities_by_categories['sum']
-            else:
-                cell.value = "Пассивы без категории"
-                report[this_year_month]["Пассивы без категории"] = month_liabilities_by_categories['sum']
-            cell = sht.cell(row=row, column=column + 1)
-            cell.value = month_liabilities_by_categories['sum']
-            row += 1
-
-        cell = sht.cell(row=assets_row, column=column+1)
-        cell.value = assets_sum
-        cell.font = bold
-        cell = sht.cell(row=liabilities_row, column=column+1)
-        cell.value = liabilities_sum
-        cell.font = bold
-
-        # переход к следующему месяцу
-        this_month_end = this_month_begin - timedelta(seconds=1)
-        if inflow_sum + outflow_sum == 0:
-            sht = wb.get_sheet_by_name(this_year_month)
-            wb.remove_sheet(sht)
-            report.pop(this_year_month)
-            break
-        else:
-            report[this_year_month]['inflow'] = inflow_sum
-            report[this_year_month]['outflow'] = outflow_sum
-            report[this_year_month]['assets'] = assets_sum
-            report[this_year_month]['liabilities'] = liabilities_sum
-
-    sht = wb.get_sheet_by_name('clear')
-    wb.remove_sheet(sht)
-
-    wb.create_sheet('Свод', 0)
-    sht = wb['Свод']
-
-    for symbol in range(65, 80):
-        sht.column_dimensions[chr(symbol)].width = 10
-
-    cell = sht.cell(row=1, column=1)
-    cell.value = 'Дата'
-    cell.font = bold
-    cell = sht.cell(row=1, column=2)
-    cell.value = 'Доходы'
-    cell.font = bold
-    cell = sht.cell(row=1, column=3)
-    cell.value = 'Расходы'
-    cell.font = bold
-    cell = sht.cell(row=1, column=4)
-    cell.value = 'Cahflow'
-    cell.font = bold
-    cell = sht.cell(row=1, column=5)
-    cell.value = 'Активы'
-    cell.font = bold
-    cell = sht.cell(row=1, column=6)
-    cell.value = 'Пассивы'
-    cell.font = bold
-    cell = sht.cell(row=1, column=7)
-    cell.value = 'Капитал'
-    cell.font = bold
-
-    column = 8
-    for category in user_categories:
-        if user_categories[category] != "Без категории":
-            cell = sht.cell(row=1, column=column)
-            cell.value = user_categories[category]
-            cell.font = bold
-            column += 1
-        else:
-            cell = sht.cell(row=1, column=column)
-            cell.value = "Активы без категории"
-            cell.font = bold
-            column += 1
-            cell = sht.cell(row=1, column=column)
-            cell.value = "Пассивы без категории"
-            cell.font = bold
-            column += 1
-
-    report = dict(sorted(report.items(), key=lambda x: x[0]))
-    row = 1
-    for month in report:
-        row += 1
-        cell = sht.cell(row=row, column=1)
-        cell.value = month
-        cell = sht.cell(row=row, column=2)
-        cell.value = report[month]['inflow']
-        cell = sht.cell(row=row, column=3)
-        cell.value = report[month]['outflow']
-        cell = sht.cell(row=row, column=4)
-        cell.value = report[month]['inflow'] - report[month]['outflow']
-        cell = sht.cell(row=row, column=5)
-        cell.value = report[month]['assets']
-        cell = sht.cell(row=row, column=6)
-        cell.value = report[month]['liabilities']
-        cell = sht.cell(row=row, column=7)
-        cell.value = report[month]['assets'] - report[month]['liabilities']
-
-        column = 8
-        for category in user_categories:
-            if user_categories[category] != "Без категории":
-                if user_categories[category] in report[month]:
-                    cell = sht.cell(row=row, column=column)
-                    cell.value = report[month][user_categories[category]]
-                else:
-                    cell = sht.cell(row=row, column=column)
-                    cell.value = 0
-                column += 1
-            else:
-                if "Активы без категории" in report[month]:
-                    cell = sht.cell(row=row, column=column)
-                    cell.value = report[month]["Активы без категории"]
-                else:
-                    cell = sht.cell(row=row, column=column)
-                    cell.value = 0
-                column += 1
-                if "Пассивы без категории" in report[month]:
-                    cell = sht.cell(row=row, column=column)
-                    cell.value = report[month]["Пассивы без категории"]
-                else:
-                    cell = sht.cell(row=row, column=column)
-                    cell.value = 0
-                column += 1
-
-    wb.save('.' + os.sep + 'static' + os.sep + 'export' + os.sep + f'cashflow{user_id}.xlsx')
+async def get_autocomplete(user_id: int, prefix: str, limit: int):
+    # индекс строится из помесячных сумм при первом обращении и дальше обновляется при записи
+    index = autocomplete.indexes.get(user_id)
+    if index is None:
+        index = autocomplete.PrefixIndex()
+        query = select([flows_monthly.c.description, func.sum(flows_monthly.c.count).label("count"),
+                        func.max(flows_monthly.c.month).label("month")]) \
+            .where(flows_monthly.c.owner_id == user_id).group_by(flows_monthly.c.description)
+        for row in await database.fetch_all(query):
+            index.add(row['description'], row['month'], row['count'])
+        autocomplete.indexes.set(user_id, index)
+    return {"autocomplete": index.search(prefix, limit)}
 
 
 async def get_most_popular(user_id: int, date_in: datetime, date_out: datetime):
     result = dict()
-    query = "SELECT description, COUNT(description) AS sum FROM outflow " \
-            "WHERE owner_id = :owner_id AND description NOT IN " \
-            "(SELECT description FROM outflow WHERE owner_id = :owner_id " \
-            "AND :date_in < date AND date < :date_out) " \
-            "AND description NOT IN (SELECT description FROM outflow_regular WHERE owner_id = :owner_id)" \
-            "GROUP BY description " \
-            "ORDER BY sum DESC LIMIT 3"
-
-    list_most_popular = await database.fetch_all(query=query, values={"owner_id": user_id, "date_in": date_in,
-                                                                      "date_out": date_out})
+    # самые частые нерегулярные расходы, которых еще не было в периоде; счетчики просматриваются по индексу
+    # в порядке убывания, а проверка периода нужна только для описаний, использованных после date_in
+    query = "SELECT description, count AS sum FROM outflow_usage " \
+            "WHERE owner_id = :owner_id " \
+            "AND (last_used <= :date_in OR NOT EXISTS (SELECT 1 FROM outflow WHERE outflow.owner_id = :owner_id " \
+            "AND outflow.description = outflow_usage.description AND :date_in < date AND date < :date_out)) " \
+            "AND NOT EXISTS (SELECT 1 FROM outflow_regular WHERE outflow_regular.owner_id = :owner_id " \
+            "AND outflow_regular.description = outflow_usage.description) " \
+            "ORDER BY count DESC, last_used DESC LIMIT 3"
+    most_popular_query = database.fetch_all(query=query, values={"owner_id": user_id, "date_in": date_in,
+                                                                 "date_out": date_out})
+
+    query = "SELECT description FROM outflow_usage WHERE owner_id = :owner_id ORDER BY description"
+    autocomplete_query = database.fetch_all(query=query, values={"owner_id": user_id})
+
+    list_most_popular, list_autocomplete = await gather(most_popular_query, autocomplete_query)
     result.update({"most_popular": [dict(result) for result in list_most_popular]})
-
-    query = "SELECT DISTINCT description FROM outflow WHERE owner_id = :owner_id"
-    list_autocomplete = await database.fetch_all(query=query, values={"owner_id": user_id})
     result.update({"autocomplete": list_autocomplete})
 
-    return result
\ No newline at end of file
+    return result
+
+
+# семафор чтений сводок месяца и цикл событий, в котором он создан
+dashboard_reads = None
+
+
+async def dashboard_read(coroutine):
+    # восемь чтений каждой сводки без ограничения заняли бы почти весь пул уже на двух одновременных сводках
+    global dashboard_reads
+    loop = asyncio.get_running_loop()
+    if dashboard_reads is None or dashboard_reads[0] is not loop:
+        dashboard_reads = (loop, asyncio.Semaphore(DASHBOARD_CONCURRENCY))
+    async with dashboard_reads[1]:
+        return await coroutine
+
+
+async def get_dashboard(user_id: int, date_in: datetime, date_out: datetime, date: datetime):
+    # все данные месяца для первой отрисовки: чтения идут параллельно на разных соединениях пула (не больше
+    # DASHBOARD_CONCURRENCY на процесс), каждое через свой кэш ответов
+    reads = (get_inflow_user(user_id=user_id, date_in=date_in, date_out=date_out),
+             get_outflow_user(user_id=user_id, date_in=date_in, date_out=date_out),
+             get_inflow_regular_user(user_id=user_id),
+             get_outflow_regular_user(user_id=user_id),
+             get_assets_user(user_id=user_id, date=date),
+             get_liabilities_user(user_id=user_id, date=date),
+             get_user_categories(user_id=user_id),
+             get_most_popular(user_id=user_id, date_in=date_in, date_out=date_out))
+    inflow, outflow, inflow_regular, outflow_regular, user_assets, user_liabilities, categories, most_popular = \
+        await gather(*(dashboard_read(read) for read in reads))
+
+    totals = {"inflow": sum(row['sum'] for row in inflow['inflow']),
+              "outflow": sum(row['sum'] for row in outflow['outflow']),
+              "assets": sum(row['sum'] for row in user_assets['assets']),
+              "liabilities": sum(row['sum'] for row in user_liabilities['liabilities'])}
+    totals.update({"cashflow": totals['inflow'] - totals['outflow'],
+                   "capital": totals['assets'] - totals['liabilities']})
+    return {"date_in": date_in, "date_out": date_out, "inflow": inflow['inflow'], "outflow": outflow['outflow'],
+            **inflow_regular, **outflow_regular, **user_assets, **user_liabilities, **categories,
+            "most_popular": most_popular['most_popular'], "totals": totals}
+
+
+def instrument(namespace: dict):
+    # каждая корутина модуля замеряется (время и число строк); вызовы внутри модуля тоже идут через обертки
+    for name, value in list(namespace.items()):
+        if inspect.iscoroutinefunction(value) and value.__module__ == __name__:
+            namespace[name] = metrics.timed(value)
+
+
+instrument(globals())
@@ -0,0 +1,124 @@
+import codecs
+import csv
+import hashlib
+import io
+import math
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+import schemas
+
+IMPORT_BATCH_SIZE = 5000
+# выгрузка до этого размера держится в памяти, больше - во временном файле на диске
+IMPORT_SPOOL_SIZE = 1024 * 1024
+IMPORT_CHUNK_SIZE = 64 * 1024
+# суммы хранятся в integer
+SUM_MAX = 2 ** 31 - 1
+# неполная строка длиннее этого числа символов - скорее всего незакрытая кавычка, дальше файл не читается
+IMPORT_MAX_PENDING = 64 * 1024
+
+
+@asynccontextmanager
+async def spooled(stream):
+    # выгрузка принимается целиком до начала транзакции, чтобы соединение из пула не ждало клиента;
+    # разбор идет потом из файла кусками, размер выгрузки не ограничивает память
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as file:
+        async for chunk in stream:
+            await run_in_threadpool(file.write, chunk)
+        file.seek(0)
+        yield read_chunks(file)
+
+
+async def read_chunks(file):
+    while True:
+        chunk = await run_in_threadpool(file.read, IMPORT_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def complete_part_end(text: str, quotechar: str = '"'):
+    # конец последней полной строки: перевод строки, перед которым четное число кавычек
+    # (поле в кавычках может содержать переводы строк)
+    end = text.rfind('\n')
+    while end >= 0 and text.count(quotechar, 0, end) % 2:
+        end = text.rfind('\n', 0, end)
+    return end + 1
+
+
+async def iter_lines(stream, profile: schemas.ImportProfile):
+    # выгрузка читается кусками и декодируется инкрементально, в памяти только неполная последняя строка
+    try:
+        decoder = codecs.getincrementaldecoder(profile.encoding)()
+    except LookupError:
+        raise HTTPException(status_code=400, detail=f"Unknown encoding {profile.encoding}")
+    pending = ''
+    async for chunk in stream:
+        try:
+            pending += decoder.decode(chunk)
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail=f"File is not in {profile.encoding} encoding")
+        end = complete_part_end(pending)
+        if end:
+            for row in csv.reader(io.StringIO(pending[:end], newline=''), delimiter=profile.delimiter):
+                yield row
+            pending = pending[end:]
+        if len(pending) > IMPORT_MAX_PENDING:
+            raise HTTPException(status_code=400, detail="CSV line is too long or has an unmatched quote")
+    pending += decoder.decode(b'', final=True)
+    for row in csv.reader(io.StringIO(pending, newline=''), delimiter=profile.delimiter):
+        yield row
+
+
+def column_index(columns: list, column: str):
+    if column.isdigit():
+        return int(column)
+    if column not in columns:
+        raise HTTPException(status_code=400, detail=f"Column '{column}' not found in CSV header")
+    return columns.index(column)
+
+
+def parse_sum(value: str):
+    # суммы в выписках бывают вида "-1 234,56"; храним целые без знака (доход или расход задает тип импорта)
+    value = float(value.replace('\xa0', '').replace(' ', '').replace(',', '.'))
+    # inf, nan и суммы больше integer - ошибка разбора строки, а не базы
+    if not math.isfinite(value) or abs(round(value)) > SUM_MAX:
+        raise ValueError(f"Sum {value} is out of range")
+    return abs(round(value))
+
+
+def row_hash(user_id: int, date: datetime, description: str, sum: int):
+    return hashlib.sha1(f"{user_id}|{date.isoformat()}|{description}|{sum}".encode()).hexdigest()
+
+
+async def iter_batches(stream, profile: schemas.ImportProfile, user_id: int):
+    # пачки записей (line, date, description, sum, row_hash) для COPY во временную таблицу
+    batch = []
+    indexes = None
+    line = 0
+    async for row in iter_lines(stream, profile):
+        line += 1
+        if line <= profile.skip_rows or not any(value.strip() for value in row):
+            continue
+        if indexes is None:
+            columns = [value.strip() for value in row] if profile.header else []
+            indexes = [column_index(columns, column) for column in
+                       (profile.date_column, profile.description_column, profile.sum_column)]
+            if profile.header:
+                continue
+        try:
+            date = datetime.strptime(row[indexes[0]].strip(), profile.date_format)
+            description = row[indexes[1]].strip()
+            sum = parse_sum(row[indexes[2]])
+        except (IndexError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Cannot parse CSV line {line}")
+        batch.append((line, date, description, sum, row_hash(user_id, date, description, sum)))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
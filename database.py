@@ -1,9 +1,259 @@
+import asyncio
+import contextvars
+import logging
+import random
+import re
+import sqlite3
+import time
+from datetime import datetime
+
 import databases
+from databases.backends.postgres import PostgresBackend, PostgresConnection
 from sqlalchemy import create_engine, MetaData
 
-from config import SQLALCHEMY_DATABASE_URL
+import metrics
+from cache import TTLCache
+from config import SQLALCHEMY_DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT, \
+    DB_STATEMENT_CACHE_SIZE, DB_CONNECTION_LIFETIME, SLOW_QUERY_MS, SLOW_QUERY_SAMPLE_RATE, SLOW_QUERY_LOG_PER_MINUTE, \
+    SLOW_QUERY_EXPLAIN_INTERVAL
 
-database = databases.Database(SQLALCHEMY_DATABASE_URL)
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+logger = logging.getLogger(__name__)
 
 metadata = MetaData()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolMetrics:
+    # ожидание соединения из пула и таймауты; занятость берется из самого пула asyncpg
+    def __init__(self):
+        self.pool = None
+        self.wait = metrics.Histogram("cashflow_db_pool_acquire_seconds", "Time spent waiting for a pool connection")
+        self.timeouts = metrics.Counter("cashflow_db_pool_acquire_timeouts_total", "Connection acquire timeouts")
+
+    def connections(self):
+        if self.pool is None:
+            return {"size": 0, "in_use": 0, "idle": 0}
+        size, idle = self.pool.get_size(), self.pool.get_idle_size()
+        return {"size": size, "in_use": size - idle, "idle": idle}
+
+    def stats(self):
+        counts, total = self.wait.values.get((), ([0] * (len(self.wait.buckets) + 1), 0.0))
+        return dict(self.connections(), min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                    acquire_attempts=sum(counts), acquire_wait_seconds=total,
+                    acquire_wait_buckets={str(bound): count for bound, count in zip(self.wait.buckets + ("+Inf",),
+                                                                                    counts)},
+                    acquire_timeouts=self.timeouts.values.get((), 0))
+
+    def render(self):
+        connections = self.connections()
+        return self.wait.render() + self.timeouts.render() + \
+            metrics.gauges("cashflow_db_pool_connections", "Database pool connections by state",
+                           {state: connections[state] for state in ("in_use", "idle")}, "state")
+
+
+pool_metrics = PoolMetrics()
+
+
+class RateLimit:
+    # не больше per_minute событий в календарную минуту
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.minute = None
+        self.count = 0
+
+    def allow(self):
+        minute = int(time.monotonic() // 60)
+        if minute != self.minute:
+            self.minute, self.count = minute, 0
+        self.count += 1
+        return self.count <= self.per_minute
+
+
+def redact(value):
+    # в журнал попадают только типы параметров: в них описания и суммы пользователей
+    if value is None or isinstance(value, bool):
+        return value
+    return f"<{type(value).__name__}>"
+
+
+def mask_literals(text: str):
+    # строковые и числовые константы заменяются многоточием; $1 и имена вроде anon_1 не затрагиваются
+    text = re.sub(r"'(?:[^']|'')*'", "'...'", text)
+    return re.sub(r"(?<![\w$.])-?\d+(?:\.\d+)?(?![\w.])", "...", text)
+
+
+def mask_plan(plan: str):
+    # значения параметров подставляются в план константами: строки скрываются везде, числа - в условиях,
+    # а оценки стоимости и строк остаются как есть
+    plan = re.sub(r"'(?:[^']|'')*'", "'...'", plan)
+    return "\n".join(re.sub(r"^(\s*(?:->\s*)?[\w -]*(?:Cond|Filter|Key|Output|Default)): (.*)$",
+                            lambda match: f"{match.group(1)}: {mask_literals(match.group(2))}", line)
+                     for line in plan.split("\n"))
+
+
+class SlowQueryLog:
+    def __init__(self):
+        self.limit = RateLimit(SLOW_QUERY_LOG_PER_MINUTE)
+        # запросы, план которых уже записан недавно
+        self.explained = TTLCache(maxsize=1000, ttl=SLOW_QUERY_EXPLAIN_INTERVAL)
+        self.count = metrics.Counter("cashflow_db_slow_queries_total", "Statements slower than SLOW_QUERY_MS",
+                                     ("function",))
+        metrics.registry.append(self.count)
+
+    def observe(self, connection, query, seconds: float):
+        if SLOW_QUERY_MS <= 0 or seconds * 1000 < SLOW_QUERY_MS:
+            return
+        function = metrics.current_function.get() or "unknown"
+        self.count.inc(function)
+        if random.random() >= SLOW_QUERY_SAMPLE_RATE or not self.limit.allow():
+            return
+        query_str, args, _ = connection._compile(query)
+        params = ", ".join(f"${number}={redact(value)}" for number, value in enumerate(args, start=1))
+        if self.explained.get(query_str) is not None:
+            logger.warning("slow query %.1f ms in %s: %s [%s] (plan logged recently)",
+                           seconds * 1000, function, mask_literals(query_str), params)
+            return
+        self.explained.set(query_str, True)
+        # план снимается в фоне на отдельном соединении, чтобы не задерживать запрос пользователя
+        task = spawn(self.explain(connection._database._pool, query_str, args, seconds, function, params))
+        explain_tasks.add(task)
+        task.add_done_callback(explain_tasks.discard)
+
+    async def explain(self, pool, query_str: str, args: list, seconds: float, function: str, params: str):
+        # ANALYZE выполняет запрос повторно, поэтому только для чтения и в транзакции только для чтения
+        # (WITH ... INSERT изменяет данные, хотя начинается как чтение)
+        analyze = query_str.lstrip().split(None, 1)[0].upper() in ("SELECT", "WITH") and \
+            re.search(r"\b(INSERT|UPDATE|DELETE)\b", query_str, re.IGNORECASE) is None
+        try:
+            async with pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as connection:
+                async with connection.transaction(readonly=True):
+                    rows = await connection.fetch(f"EXPLAIN {'(ANALYZE, BUFFERS) ' if analyze else ''}{query_str}",
+                                                  *args)
+            plan = mask_plan("\n".join(row[0] for row in rows))
+        except Exception as exc:
+            plan = f"EXPLAIN failed: {exc!r}"
+        logger.warning("slow query %.1f ms in %s: %s [%s]\n%s", seconds * 1000, function, mask_literals(query_str),
+                       params, plan)
+
+
+slow_queries = SlowQueryLog()
+# фоновые EXPLAIN: asyncio держит на задачу только слабую ссылку
+explain_tasks = set()
+
+
+class MeasuredPostgresConnection(PostgresConnection):
+    async def acquire(self) -> None:
+        # databases ждет соединение без ограничения, здесь ожидание ограничено и замеряется
+        assert self._connection is None, "Connection is already acquired"
+        started = time.perf_counter()
+        try:
+            self._connection = await self._database._pool.acquire(timeout=self._database.acquire_timeout)
+        except asyncio.TimeoutError:
+            pool_metrics.timeouts.inc()
+            raise PoolTimeout(f"No free database connection in {self._database.acquire_timeout} s")
+        finally:
+            pool_metrics.wait.observe(value=time.perf_counter() - started)
+
+    # fetch_val выполняется через fetch_one; execute_many и iterate не замеряются
+    async def fetch_all(self, query):
+        started = time.perf_counter()
+        result = await super().fetch_all(query)
+        slow_queries.observe(self, query, time.perf_counter() - started)
+        return result
+
+    async def fetch_one(self, query):
+        started = time.perf_counter()
+        result = await super().fetch_one(query)
+        slow_queries.observe(self, query, time.perf_counter() - started)
+        return result
+
+    async def execute(self, query):
+        started = time.perf_counter()
+        result = await super().execute(query)
+        slow_queries.observe(self, query, time.perf_counter() - started)
+        return result
+
+
+class MeasuredPostgresBackend(PostgresBackend):
+    def __init__(self, database_url, acquire_timeout: float = None, **options):
+        super().__init__(database_url, **options)
+        self.acquire_timeout = acquire_timeout
+
+    async def connect(self) -> None:
+        await super().connect()
+        pool_metrics.pool = self._pool
+
+    async def disconnect(self) -> None:
+        pool_metrics.pool = None
+        await super().disconnect()
+
+    def connection(self) -> MeasuredPostgresConnection:
+        return MeasuredPostgresConnection(self, self._dialect)
+
+
+class PooledDatabase(databases.Database):
+    SUPPORTED_BACKENDS = dict(databases.Database.SUPPORTED_BACKENDS,
+                              postgresql="database:MeasuredPostgresBackend",
+                              postgres="database:MeasuredPostgresBackend")
+
+
+class LazyDatabase:
+    # databases.Database создается при первом обращении, поэтому импорт модулей не требует базы,
+    # а create_app может подменить адрес до запуска приложения
+    def __init__(self, url: str):
+        self.url = databases.DatabaseURL(url)
+        self.instance = None
+        self.engine = None
+
+    def configure(self, url: str):
+        if self.instance is not None and self.instance.is_connected:
+            raise RuntimeError("Cannot change the database of a connected application")
+        self.url = databases.DatabaseURL(url)
+        self.instance = None
+        self.engine = None
+
+    @property
+    def dialect(self):
+        return self.url.dialect
+
+    def get_engine(self):
+        # синхронный engine нужен только миграциям и созданию схемы в режиме SQLite
+        if self.engine is None:
+            self.engine = create_engine(str(self.url))
+        return self.engine
+
+    def __getattr__(self, name):
+        if self.instance is None:
+            if self.dialect == "sqlite":
+                # даты в запросах на чистом SQL пишутся в том же формате, что и через SQLAlchemy
+                sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "microseconds"))
+                self.instance = databases.Database(self.url)
+            else:
+                self.instance = PooledDatabase(self.url, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                                               acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                                               statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                                               max_inactive_connection_lifetime=DB_CONNECTION_LIFETIME)
+        return getattr(self.instance, name)
+
+
+database = LazyDatabase(SQLALCHEMY_DATABASE_URL)
+
+
+# переменные контекста, которые spawn переносит в новую корутину
+carried_contextvars = [metrics.current_function]
+
+
+def spawn(coroutine):
+    # databases хранит соединение в contextvar, поэтому корутина запускается
+    # в чистом контексте и получает собственное соединение из пула; переносятся только carried_contextvars
+    context = contextvars.Context()
+    for var in carried_contextvars:
+        context.run(var.set, var.get())
+    return context.run(asyncio.ensure_future, coroutine)
+
+
+def gather(*coroutines):
+    return asyncio.gather(*(spawn(coroutine) for coroutine in coroutines))
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+from itertools import zip_longest
+
+from anyio import from_thread
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+import crud
+
+bold = Font(bold=True)
+
+
+async def get_export_flows(user_id: int, date_in: datetime, date_out: datetime):
+    inflows = await crud.get_inflow_user(user_id, date_in, date_out)
+    outflows = await crud.get_outflow_user(user_id, date_in, date_out)
+    return inflows['inflow'], outflows['outflow']
+
+
+async def get_export_balance(user_id: int, date: datetime):
+    assets = await crud.get_assets_user(user_id, date)
+    liabilities = await crud.get_liabilities_user(user_id, date)
+    assets_by_categories = await crud.get_assets_by_categories(user_id, date, "assets")
+    liabilities_by_categories = await crud.get_assets_by_categories(user_id, date, "liabilities")
+    return assets['assets'], liabilities['liabilities'], \
+        assets_by_categories['categories'], liabilities_by_categories['categories']
+
+
+def cell(sht, value, font=None):
+    if font is None:
+        return value
+    result = WriteOnlyCell(sht, value=value)
+    result.font = font
+    return result
+
+
+def flow_block(sht, title: str, rows: list):
+    # заголовок блока с итоговой суммой и строки "описание - сумма"
+    total = sum(row['sum'] for row in rows)
+    block = [[cell(sht, title, bold), cell(sht, total, bold)]]
+    block += [[row['description'], row['sum']] for row in rows]
+    return block, total
+
+
+def render_export(user_id: int, fileobj):
+    # выполняется в рабочем потоке: данные по месяцам запрашиваются в event loop через from_thread,
+    # строки листов пишутся последовательно в write-only книгу, поэтому в памяти только текущий месяц
+    wb = Workbook(write_only=True)
+
+    # забираем категории пользователя
+    db_user_categories = from_thread.run(crud.get_user_categories, user_id)
+    user_categories = {result['id']: result['category'] for result in db_user_categories['categories']}
+    user_categories[None] = 'Без категории'
+
+    # итоги по месяцам берутся из помесячных сумм, записи читаются только для листов месяцев
+    totals = from_thread.run(crud.get_monthly_totals, user_id)
+
+    report = dict()
+    this_month_begin = crud.month_of(datetime.now())
+    while True:
+        this_month_end = (this_month_begin + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
+        this_year_month = this_month_begin.strftime("%Y-%m")
+
+        month_totals = totals.get(this_month_begin, {"inflow": 0, "outflow": 0})
+        if month_totals['inflow'] + month_totals['outflow'] == 0:
+            break
+        month_inflows, month_outflows = from_thread.run(get_export_flows, user_id, this_month_begin, this_month_end)
+        month_assets, month_liabilities, asset_by_categories, liabilities_by_categories = \
+            from_thread.run(get_export_balance, user_id, this_month_begin + timedelta(days=15))
+
+        sht = wb.create_sheet(this_year_month)
+        sht.column_dimensions["A"].width = 32
+        sht.column_dimensions["B"].width = 10
+        sht.column_dimensions["C"].width = 8
+        sht.column_dimensions["D"].width = 32
+        sht.column_dimensions["E"].width = 12
+
+        # доходы, расходы и денежный поток
+        inflow_block, inflow_sum = flow_block(sht, 'Доходы', month_inflows)
+        outflow_block, outflow_sum = flow_block(sht, 'Расходы', month_outflows)
+        left = inflow_block + [[]] + outflow_block + [[]] + \
+            [[cell(sht, 'Денежный поток', bold), cell(sht, inflow_sum - outflow_sum, bold)]]
+
+        # активы, пассивы, капитал и суммы по категориям
+        assets_block, assets_sum = flow_block(sht, 'Активы', month_assets)
+        liabilities_block, liabilities_sum = flow_block(sht, 'Пассивы', month_liabilities)
+        right = assets_block + [[]] + liabilities_block + [[]] + \
+            [[cell(sht, 'Капитал', bold), cell(sht, assets_sum - liabilities_sum, bold)], [],
+             [cell(sht, 'По категориям', bold)]]
+
+        report[this_year_month] = dict()
+        for categories, uncategorized in ((asset_by_categories, "Активы без категории"),
+                                          (liabilities_by_categories, "Пассивы без категории")):
+            for month_by_categories in categories:
+                if month_by_categories['category_id'] is not None:
+                    description = user_categories[month_by_categories['category_id']]
+                else:
+                    description = uncategorized
+                report[this_year_month][description] = month_by_categories['sum']
+                right.append([description, month_by_categories['sum']])
+
+        for left_row, right_row in zip_longest(left, right, fillvalue=[]):
+            sht.append((list(left_row) + [None, None])[:2] + [None] + list(right_row))
+
+        report[this_year_month]['inflow'] = month_totals['inflow']
+        report[this_year_month]['outflow'] = month_totals['outflow']
+        report[this_year_month]['assets'] = assets_sum
+        report[this_year_month]['liabilities'] = liabilities_sum
+
+        # переход к предыдущему месяцу
+        this_month_begin = crud.month_of(this_month_begin - timedelta(days=1))
+
+    sht = wb.create_sheet('Свод', 0)
+    for symbol in range(65, 80):
+        sht.column_dimensions[chr(symbol)].width = 10
+
+    header = ['Дата', 'Доходы', 'Расходы', 'Cahflow', 'Активы', 'Пассивы', 'Капитал']
+    columns = []
+    for category in user_categories:
+        if user_categories[category] != "Без категории":
+            columns.append(user_categories[category])
+        else:
+            columns += ["Активы без категории", "Пассивы без категории"]
+    sht.append([cell(sht, title, bold) for title in header + columns])
+
+    for month in sorted(report):
+        month_report = report[month]
+        sht.append([month, month_report['inflow'], month_report['outflow'],
+                    month_report['inflow'] - month_report['outflow'],
+                    month_report['assets'], month_report['liabilities'],
+                    month_report['assets'] - month_report['liabilities']] +
+                   [month_report.get(column, 0) for column in columns])
+
+    wb.save(fileobj)
+
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from anyio import to_thread
+from fastapi.responses import FileResponse
+
+import crud
+from database import spawn
+from config import EXPORT_DIR, EXPORT_WORKERS, EXPORT_JOB_TTL
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# ресурсы, от которых зависит содержимое выгрузки
+EXPORT_RESOURCES = ("inflow", "outflow", "assets", "liabilities", "categories")
+
+
+class ExportJob:
+    def __init__(self, user_id: int, key: str, path: str):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.key = key
+        self.path = path
+        self.status = "pending"
+        self.created = datetime.now()
+        self.finished = None
+        self.done = asyncio.Event()
+        # ответы, которые сейчас отдают файл выгрузки
+        self.readers = 0
+
+    def finish(self, status: str):
+        self.status = status
+        self.finished = datetime.now()
+        self.done.set()
+
+
+jobs = dict()
+jobs_by_key = dict()
+tasks = set()
+workers = None
+
+
+def export_key(user_id: int, versions: dict):
+    # выгрузка зависит от версий данных пользователя и от текущей даты (месяцы считаются от сегодня)
+    parts = [str(user_id), datetime.now().strftime("%Y-%m-%d")] + \
+            [f"{resource}:{versions.get(resource, 0)}" for resource in EXPORT_RESOURCES]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+def artifact_path(user_id: int, key: str):
+    return os.path.join(EXPORT_DIR, f"{user_id}-{key}.xlsx")
+
+
+def remove_expired_jobs():
+    # задача, файл которой сейчас отдается, не истекает
+    expired = datetime.now() - timedelta(seconds=EXPORT_JOB_TTL)
+    for job in list(jobs.values()):
+        if job.finished is not None and job.finished < expired and job.readers == 0:
+            jobs.pop(job.id, None)
+            if jobs_by_key.get(job.key) is job:
+                jobs_by_key.pop(job.key)
+
+
+def remove_stale_artifacts(user_id: int):
+    # удаляются только выгрузки без живой задачи: их уже не вернет ни /export/, ни /export/jobs/{id}/file
+    expired = time.time() - EXPORT_JOB_TTL
+    in_use = {job.path for job in jobs.values()}
+    prefix = f"{user_id}-"
+    for filename in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, filename)
+        if filename.startswith(prefix) and filename.endswith(".xlsx") and path not in in_use:
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class ArtifactResponse(FileResponse):
+    # пока файл отправляется, задача считается занятой и файл не удаляется; счетчик меняется только
+    # в __call__, ответ, который так и не был отправлен, задачу не занимает
+    def __init__(self, job: ExportJob, filename: str):
+        super().__init__(path=job.path, filename=filename, media_type=MEDIA_TYPE)
+        self.job = job
+
+    async def __call__(self, scope, receive, send):
+        self.job.readers += 1
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.job.readers -= 1
+
+
+def render_artifact(job: ExportJob):
+    # openpyxl загружается только при первой выгрузке
+    import export
+
+    tmp_path = f"{job.path}.{job.id}.tmp"
+    try:
+        with open(tmp_path, "wb") as fileobj:
+            export.render_export(job.user_id, fileobj)
+        os.replace(tmp_path, job.path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def run_export(job: ExportJob):
+    global workers
+    if workers is None:
+        workers = asyncio.Semaphore(EXPORT_WORKERS)
+    try:
+        async with workers:
+            job.status = "running"
+            await to_thread.run_sync(render_artifact, job)
+        job.finish("done")
+    except Exception:
+        logger.exception("export job %s for user %s failed", job.id, job.user_id)
+        job.finish("failed")
+
+
+async def submit_export(user_id: int):
+    remove_expired_jobs()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_stale_artifacts(user_id)
+    versions = await crud.get_data_versions(user_id)
+    key = export_key(user_id, versions)
+
+    # одинаковые запросы на выгрузку схлопываются в одну задачу
+    job = jobs_by_key.get(key)
+    if job is not None and job.status != "failed" and (job.status != "done" or os.path.exists(job.path)):
+        return job
+
+    job = ExportJob(user_id, key, artifact_path(user_id, key))
+    jobs[job.id] = job
+    jobs_by_key[key] = job
+    if os.path.exists(job.path):
+        job.finish("done")
+    else:
+        task = spawn(run_export(job))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    return job
+
+
+def get_job(user_id: int, job_id: str):
+    job = jobs.get(job_id)
+    if job is None or job.user_id != user_id:
+        return None
+    return job
@@ -1,36 +1,48 @@
 #!/usr/bin/python3
 
+import logging
 import os
+import secrets
+import time
 import asyncio
 import uvicorn
 
 from datetime import datetime, timedelta
 import calendar
+import hashlib
+import json
 
-from typing import Optional
+from typing import List, Literal, Optional, Union
 
-from database import database, engine, metadata
-from fastapi import Depends, FastAPI, HTTPException, status
+from database import database, metadata, pool_metrics, PoolTimeout
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 
 import crud
+import csv_import
+import jobs
+import metrics
+import responses
 import schemas
+import security
+from cache import TTLCache
 
-from config import SECRET_KEY, MY_INVITE, DEMO_USER_ID, EXCEPTION_PER_SEC_LIMIT
+from config import SECRET_KEY, MY_INVITE, DEMO_USER_ID, EXCEPTION_PER_SEC_LIMIT, AUTH_CACHE_SIZE, AUTH_CACHE_TTL, \
+    BULK_MAX_ITEMS, PAGE_MAX_LIMIT, FAST_JSON, STATIC_DIR
 
 
+logger = logging.getLogger(__name__)
+
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 181 * 60 * 24
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-metadata.create_all(bind=engine)
+tokens_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
 
 tags_metadata = [
     {
@@ -81,36 +93,17 @@ tags_metadata = [
         "name": "Most polular",
         "description": "Самые популярные доходы/расходы (для подсказок)",
     },
+    {
+        "name": "Autocomplete",
+        "description": "Подсказки по описаниям доходов и расходов",
+    },
 ]
 
-app = FastAPI(
-    title="Cashflow Api",
-    version="1.0.0",
-    openapi_tags=tags_metadata,
-)
-
-
-@app.on_event("startup")
-async def startup():
-    await database.connect()
-
-
-@app.on_event("shutdown")
-async def shutdown():
-    await database.disconnect()
-
-
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
-
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    #print(get_password_hash(plain_password))
-    return pwd_context.verify(plain_password, hashed_password)
+router = APIRouter()
 
 
 async def get_user(username: str):
-    user = await crud.get_user_by_username(username)
+    user = await crud.get_cached_user_by_username(username)
     if user:
         return schemas.UserInDB(**user)
 
@@ -119,8 +112,11 @@ async def authenticate_user(username: str, password: str):
     user = await crud.get_user_by_username(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await security.verify_password(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        await crud.update_user_password(user.id, user.username, new_hash)
     return user
 
 
@@ -141,14 +137,18 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    username: str = tokens_cache.get(token)
+    if username is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-        token_data = schemas.TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
+        # проверенный токен кэшируется не дольше срока его действия
+        tokens_cache.set(token, username, ttl=payload["exp"] - time.time() if "exp" in payload else None)
+    token_data = schemas.TokenData(username=username)
     user = await get_user(username=token_data.username)
     if user is None:
         raise credentials_exception
@@ -161,15 +161,114 @@ async def get_current_active_user(current_user: schemas.User = Depends(get_curre
     return current_user
 
 
-async def is_user(user_id: int, email: str):
-    db_user = await crud.get_user(user_id=user_id)
-    if db_user is None:
-        await asyncio.sleep(EXCEPTION_PER_SEC_LIMIT)
-        raise HTTPException(status_code=404, detail="User not found")
-    if db_user['email'] != email:
+async def get_current_owner(user_id: int, current_user: schemas.User = Depends(get_current_active_user)):
+    # запрос к чужому user_id - единственный случай, когда нужен поиск пользователя в базе
+    if user_id != current_user.id:
+        db_user = await crud.get_user(user_id=user_id)
         await asyncio.sleep(EXCEPTION_PER_SEC_LIMIT)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail="User not found")
         raise HTTPException(status_code=404, detail="Query for other user prohibited")
-    return db_user
+    return current_user
+
+
+def check_import_supported():
+    # импорт идет через COPY во временную таблицу, это есть только в PostgreSQL
+    if database.dialect != "postgresql":
+        raise HTTPException(status_code=501, detail="CSV import requires PostgreSQL")
+
+
+def check_bulk_size(size: int):
+    if size > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"Too many records in one request, maximum is {BULK_MAX_ITEMS}")
+
+
+def check_revaluations(revaluations: List[schemas.Revaluation]):
+    check_bulk_size(len(revaluations))
+    if len({revaluation.id for revaluation in revaluations}) != len(revaluations):
+        raise HTTPException(status_code=400, detail="Each record can be revalued only once per request")
+
+
+def data_etag(*resources: str):
+    # ETag ответа - хэш версий данных, от которых он зависит, запроса и текущей даты (периоды по умолчанию
+    # и отчеты считаются от сегодняшнего дня); при совпадении с If-None-Match ответ 304 без запросов к таблицам
+    async def check_etag(user_id: int, request: Request, response: Response,
+                         current_user: schemas.User = Depends(get_current_owner)):
+        versions = await crud.get_data_versions(user_id)
+        # те же версии входят в ключи кэша ответов crud, второй раз они не читаются
+        crud.request_versions.set((user_id, versions))
+        parts = [request.url.path, request.url.query, request.headers.get("accept", ""),
+                 datetime.now().strftime("%Y-%m-%d")] + \
+                [f"{resource}:{versions.get(resource, 0)}" for resource in resources]
+        etag = f'"{hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if_none_match = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+        if etag in if_none_match or "*" in if_none_match:
+            raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        response.headers.update(headers)
+        request.state.etag_headers = headers
+    return check_etag
+
+
+def respond(request: Request, model, content: dict):
+    # в режиме FAST_JSON ответ crud кодируется сразу в байты по полям схемы ответа,
+    # заголовки ETag переносятся в ответ явно (FastAPI не добавляет их к возвращенному Response)
+    if not FAST_JSON or responses.orjson is None:
+        return content
+    return responses.FastJSONResponse(responses.project(model, content),
+                                      headers=getattr(request.state, "etag_headers", None))
+
+
+def respond_grouped(request: Request, model, content: dict):
+    # сгруппированная выдача не совпадает с основной схемой маршрута, поэтому ответ собирается здесь
+    headers = getattr(request.state, "etag_headers", None)
+    if FAST_JSON and responses.orjson is not None:
+        return responses.FastJSONResponse(responses.project(model, content), headers=headers)
+    return JSONResponse(jsonable_encoder(model(**content)), headers=headers)
+
+
+# тело запроса на импорт - CSV-выписка, параметры разбора передаются в query
+IMPORT_OPENAPI = {"requestBody": {"required": True, "content": {"text/csv": {"schema": {"type": "string"}}}}}
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class FlowPage:
+    # limit и cursor для постраничной выдачи; без limit выдается весь период, как раньше
+    def __init__(self, request: Request, limit: Optional[int] = Query(None, ge=1, le=PAGE_MAX_LIMIT),
+                 cursor: Optional[str] = None):
+        self.limit = limit
+        self.after = None
+        if cursor is not None:
+            try:
+                self.after = crud.decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        self.stream = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+class FlowGroupBy:
+    # group_by=description|day|week - суммы за период вместо записей, без постраничной выдачи
+    def __init__(self, group_by: Optional[Literal["description", "day", "week"]] = None,
+                 page: FlowPage = Depends()):
+        if group_by is not None and (page.limit is not None or page.after is not None):
+            raise HTTPException(status_code=400, detail="group_by cannot be combined with limit or cursor")
+        self.group_by = group_by
+
+    def model(self, by_description, by_period):
+        # у строк по описанию нет даты, у строк по дням и неделям - описания
+        return by_description if self.group_by == "description" else by_period
+
+
+def ndjson_response(request: Request, rows):
+    # по записи на строку, первые байты уходят клиенту до того, как прочитан весь период
+    async def lines():
+        async for row in rows:
+            yield json.dumps(row, ensure_ascii=False, default=datetime.isoformat) + "\n"
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE,
+                             headers=getattr(request.state, "etag_headers", None))
 
 
 def month_begin():
@@ -184,64 +283,64 @@ def month_end():
                              "%Y-%m-%d %H:%M:%S")
 
 
-@app.get("/inflow")
+@router.get("/inflow")
 async def redirect_inflow():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/outflow")
+@router.get("/outflow")
 async def redirect_outflow():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/assets")
+@router.get("/assets")
 async def redirect_assets():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/liabilities")
+@router.get("/liabilities")
 async def redirect_liabilities():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/preferences")
+@router.get("/preferences")
 async def redirect_preferences():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/reports")
+@router.get("/reports")
 async def redirect_preferences():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/login")
+@router.get("/login")
 async def redirect_login():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/register")
+@router.get("/register")
 async def redirect_login():
     return RedirectResponse(url=f"/", status_code=303)
 
 
-@app.get("/")
+@router.get("/")
 async def redirect_login():
     return RedirectResponse(url=f"/index.html", status_code=303)
 
 
-@app.post("/register", response_model=schemas.User, tags=["Register"])
+@router.post("/register", response_model=schemas.User, tags=["Register"])
 async def create_user(user: schemas.UserCreate):
     db_user = await crud.get_user_by_email(email=user.email)
-    hashed_password: str = get_password_hash(user.password)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     if user.invite != MY_INVITE:
         await asyncio.sleep(EXCEPTION_PER_SEC_LIMIT)
         raise HTTPException(status_code=400, detail="Invite is broken")
+    hashed_password: str = await security.get_password_hash(user.password)
     return await crud.create_user(user=user, hashed_password=hashed_password)
 
 
-@app.post("/token", response_model=schemas.Token , tags=["Token"])
+@router.post("/token", response_model=schemas.Token , tags=["Token"])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     user = await authenticate_user(form_data.username, form_data.password)
     if not user:
@@ -258,245 +357,443 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-@app.get("/user", response_model=schemas.User, tags=["User"])
-async def read_user(current_user: schemas.User = Depends(get_current_active_user)):
-    return await is_user(current_user.id, current_user.email)
+@router.get("/cache/stats", include_in_schema=False)
+async def read_cache_stats(current_user: schemas.User = Depends(get_current_active_user)):
+    return crud.response_cache.stats()
+
+
+@router.get("/pool/stats", include_in_schema=False)
+async def read_pool_stats(current_user: schemas.User = Depends(get_current_active_user)):
+    return pool_metrics.stats()
+
 
+@router.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    # формат Prometheus: запросы и время по шаблонам маршрутов, время и строки корутин crud, состояние пула
+    return PlainTextResponse(metrics.render(pool_metrics.render()), media_type="text/plain; version=0.0.4")
 
-@app.get("/users/{user_id}/inflow/", response_model=schemas.InflowUser, tags=["Inflow"])
-async def get_inflow_for_user(user_id: int, date_in: Optional[datetime] = month_begin(),
-                              date_out: Optional[datetime] = month_end(),
-                              current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_inflow_user(user_id=user_id, date_in=date_in, date_out=date_out)
+
+@router.get("/user", response_model=schemas.User, tags=["User"])
+async def read_user(current_user: schemas.User = Depends(get_current_active_user)):
+    return current_user
 
 
-@app.post("/users/{user_id}/inflow/", response_model=schemas.InflowInDB, tags=["Inflow"])
+@router.get("/users/{user_id}/inflow/", tags=["Inflow"],
+            response_model=Union[schemas.InflowUser, schemas.InflowDescriptionGroupUser,
+                                 schemas.InflowPeriodGroupUser],
+            responses={200: {"content": {NDJSON_MEDIA_TYPE: {}}}},
+            dependencies=[Depends(data_etag("inflow"))])
+async def get_inflow_for_user(user_id: int, request: Request, date_in: Optional[datetime] = month_begin(),
+                              date_out: Optional[datetime] = month_end(), page: FlowPage = Depends(),
+                              grouping: FlowGroupBy = Depends(),
+                              current_user: schemas.User = Depends(get_current_owner)):
+    if grouping.group_by is not None:
+        return respond_grouped(request, grouping.model(schemas.InflowDescriptionGroupUser,
+                                                       schemas.InflowPeriodGroupUser),
+                               await crud.get_inflow_groups_user(user_id=user_id, date_in=date_in, date_out=date_out,
+                                                                 group_by=grouping.group_by))
+    if page.stream:
+        return ndjson_response(request, crud.iterate_inflow_user(user_id=user_id, date_in=date_in,
+                                                                 date_out=date_out, limit=page.limit,
+                                                                 after=page.after))
+    return respond(request, schemas.InflowUser,
+                   await crud.get_inflow_user(user_id=user_id, date_in=date_in, date_out=date_out, limit=page.limit,
+                                              after=page.after))
+
+
+@router.post("/users/{user_id}/inflow/", response_model=schemas.InflowInDB, tags=["Inflow"])
 async def create_inflow_for_user(user_id: int, inflow: schemas.InflowCreate,
-                                 current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                 current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.InflowInDB(**inflow.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_inflow(inflow=inflow, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/inflow/", tags=["Inflow"])
+@router.post("/users/{user_id}/inflow/bulk", response_model=schemas.InflowBulkUser, tags=["Inflow"])
+async def create_inflows_for_user(user_id: int, inflows: List[schemas.InflowCreate],
+                                  current_user: schemas.User = Depends(get_current_owner)):
+    check_bulk_size(len(inflows))
+    if (user_id == DEMO_USER_ID):
+        return {"inflow": [schemas.InflowInDB(**inflow.dict(), id=9999999, owner_id=DEMO_USER_ID) for inflow in inflows]}
+    return await crud.create_user_inflows(inflow_list=inflows, user_id=user_id)
+
+
+@router.post("/users/{user_id}/inflow/import", response_model=schemas.ImportResult, tags=["Inflow"],
+             openapi_extra=IMPORT_OPENAPI)
+async def import_inflows_for_user(user_id: int, request: Request, profile: schemas.ImportProfile = Depends(),
+                                  current_user: schemas.User = Depends(get_current_owner)):
+    if (user_id == DEMO_USER_ID):
+        return {"total": 0, "imported": 0, "skipped": 0}
+    check_import_supported()
+    async with csv_import.spooled(request.stream()) as upload:
+        batches = csv_import.iter_batches(upload, profile, user_id)
+        return await crud.import_user_inflows(batches=batches, user_id=user_id)
+
+
+@router.delete("/users/{user_id}/inflow/", tags=["Inflow"])
 async def delete_inflow_for_user(user_id: int, inflow_id: int,
-                                 current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                 current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "inflow for demo user conditionally deleted"}
     return await crud.delete_inflow_user(inflow_id=inflow_id, user_id=user_id)
 
 
-@app.get("/users/{user_id}/inflow_regular/", response_model=schemas.InflowRegularUser, tags=["Inflow regular"])
-async def get_inflow_regular_for_user(user_id: int, current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_inflow_regular_user(user_id=user_id)
+@router.get("/users/{user_id}/inflow_regular/", response_model=schemas.InflowRegularUser, tags=["Inflow regular"],
+            dependencies=[Depends(data_etag("inflow_regular", "inflow"))])
+async def get_inflow_regular_for_user(user_id: int, request: Request,
+                                      current_user: schemas.User = Depends(get_current_owner)):
+    return respond(request, schemas.InflowRegularUser, await crud.get_inflow_regular_user(user_id=user_id))
 
 
-@app.post("/users/{user_id}/inflow_regular/", response_model=schemas.InflowRegularInDB, tags=["Inflow regular"])
+@router.post("/users/{user_id}/inflow_regular/", response_model=schemas.InflowRegularInDB, tags=["Inflow regular"])
 async def create_inflow_regular_for_user(user_id: int, inflow_regular: schemas.InflowRegularCreate,
-                                         current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                         current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.InflowRegularInDB(**inflow_regular.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_inflow_regular(inflow_regular=inflow_regular, user_id=user_id)
 
 
-@app.put("/users/{user_id}/inflow_regular/", tags=["Inflow regular"])
+@router.put("/users/{user_id}/inflow_regular/", tags=["Inflow regular"])
 async def update_inflow_regular_for_user(user_id: int, inflow_regular: schemas.InflowRegularOut,
-                                         current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                         current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "inflow regular updated"}
     return await crud.update_user_inflow_regular(inflow_regular=inflow_regular, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/inflow_regular/", tags=["Inflow regular"])
+@router.delete("/users/{user_id}/inflow_regular/", tags=["Inflow regular"])
 async def delete_inflow_regular_for_user(user_id: int, inflow_regular_id: int,
-                                         current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                         current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "inflow regular for demo user conditionally deleted"}
     return await crud.delete_inflow_regular_user(inflow_regular_id=inflow_regular_id, user_id=user_id)
 
 
-@app.get("/users/{user_id}/outflow/", response_model=schemas.OutflowUser, tags=["Outflow"])
-async def get_outflow_for_user(user_id: int, date_in: datetime = month_begin(), date_out: datetime = month_end(),
-                               current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_outflow_user(user_id=user_id, date_in=date_in, date_out=date_out)
-
-
-@app.post("/users/{user_id}/outflow/", response_model=schemas.OutflowInDB, tags=["Outflow"])
+@router.get("/users/{user_id}/outflow/", tags=["Outflow"],
+            response_model=Union[schemas.OutflowUser, schemas.OutflowDescriptionGroupUser,
+                                 schemas.OutflowPeriodGroupUser],
+            responses={200: {"content": {NDJSON_MEDIA_TYPE: {}}}},
+            dependencies=[Depends(data_etag("outflow"))])
+async def get_outflow_for_user(user_id: int, request: Request, date_in: datetime = month_begin(),
+                               date_out: datetime = month_end(), page: FlowPage = Depends(),
+                               grouping: FlowGroupBy = Depends(),
+                               current_user: schemas.User = Depends(get_current_owner)):
+    if grouping.group_by is not None:
+        return respond_grouped(request, grouping.model(schemas.OutflowDescriptionGroupUser,
+                                                       schemas.OutflowPeriodGroupUser),
+                               await crud.get_outflow_groups_user(user_id=user_id, date_in=date_in, date_out=date_out,
+                                                                  group_by=grouping.group_by))
+    if page.stream:
+        return ndjson_response(request, crud.iterate_outflow_user(user_id=user_id, date_in=date_in,
+                                                                  date_out=date_out, limit=page.limit,
+                                                                  after=page.after))
+    return respond(request, schemas.OutflowUser,
+                   await crud.get_outflow_user(user_id=user_id, date_in=date_in, date_out=date_out, limit=page.limit,
+                                               after=page.after))
+
+
+@router.post("/users/{user_id}/outflow/", response_model=schemas.OutflowInDB, tags=["Outflow"])
 async def create_outflow_for_user(user_id: int, outflow: schemas.OutflowCreate,
-                                  current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                  current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.OutflowInDB(**outflow.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_outflow(outflow=outflow, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/outflow/", tags=["Outflow"])
+@router.post("/users/{user_id}/outflow/bulk", response_model=schemas.OutflowBulkUser, tags=["Outflow"])
+async def create_outflows_for_user(user_id: int, outflows: List[schemas.OutflowCreate],
+                                  current_user: schemas.User = Depends(get_current_owner)):
+    check_bulk_size(len(outflows))
+    if (user_id == DEMO_USER_ID):
+        return {"outflow": [schemas.OutflowInDB(**outflow.dict(), id=9999999, owner_id=DEMO_USER_ID) for outflow in outflows]}
+    return await crud.create_user_outflows(outflow_list=outflows, user_id=user_id)
+
+
+@router.post("/users/{user_id}/outflow/import", response_model=schemas.ImportResult, tags=["Outflow"],
+             openapi_extra=IMPORT_OPENAPI)
+async def import_outflows_for_user(user_id: int, request: Request, profile: schemas.ImportProfile = Depends(),
+                                  current_user: schemas.User = Depends(get_current_owner)):
+    if (user_id == DEMO_USER_ID):
+        return {"total": 0, "imported": 0, "skipped": 0}
+    check_import_supported()
+    async with csv_import.spooled(request.stream()) as upload:
+        batches = csv_import.iter_batches(upload, profile, user_id)
+        return await crud.import_user_outflows(batches=batches, user_id=user_id)
+
+
+@router.delete("/users/{user_id}/outflow/", tags=["Outflow"])
 async def delete_outflow_for_user(user_id: int, outflow_id: int,
-                                  current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                  current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "outflow for demo user conditionally deleted"}
     return await crud.delete_outflow_user(outflow_id=outflow_id, user_id=user_id)
 
 
-@app.get("/users/{user_id}/outflow_regular/", response_model=schemas.OutflowRegularUser, tags=["Outflow regular"])
-async def get_outflow_regular_for_user(user_id: int, current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_outflow_regular_user(user_id=user_id)
+@router.get("/users/{user_id}/outflow_regular/", response_model=schemas.OutflowRegularUser, tags=["Outflow regular"],
+            dependencies=[Depends(data_etag("outflow_regular", "outflow"))])
+async def get_outflow_regular_for_user(user_id: int, request: Request,
+                                       current_user: schemas.User = Depends(get_current_owner)):
+    return respond(request, schemas.OutflowRegularUser, await crud.get_outflow_regular_user(user_id=user_id))
 
 
-@app.post("/users/{user_id}/outflow_regular/", response_model=schemas.OutflowRegularInDB, tags=["Outflow regular"])
+@router.post("/users/{user_id}/outflow_regular/", response_model=schemas.OutflowRegularInDB, tags=["Outflow regular"])
 async def create_outflow_regular_for_user(user_id: int, outflow_regular: schemas.OutflowRegularCreate,
-                                  current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                  current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.OutflowRegularInDB(**outflow_regular.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_outflow_regular(outflow_regular=outflow_regular, user_id=user_id)
 
 
-@app.put("/users/{user_id}/outflow_regular/", tags=["Outflow regular"])
+@router.put("/users/{user_id}/outflow_regular/", tags=["Outflow regular"])
 async def update_outflow_regular_for_user(user_id: int, outflow_regular: schemas.OutflowRegularOut,
-                                          current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                          current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "outflow regular updated"}
     return await crud.update_user_outflow_regular(outflow_regular=outflow_regular, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/outflow_regular/", tags=["Outflow regular"])
+@router.delete("/users/{user_id}/outflow_regular/", tags=["Outflow regular"])
 async def delete_outflow_regular_for_user(user_id: int, outflow_regular_id: int,
-                                          current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                          current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "outflow regular for demo user conditionally deleted"}
     return await crud.delete_outflow_regular_user(outflow_regular_id=outflow_regular_id, user_id=user_id)
 
 
-@app.post("/users/{user_id}/assets/", response_model=schemas.AssetInDB, tags=["Assets"])
+@router.post("/users/{user_id}/assets/", response_model=schemas.AssetInDB, tags=["Assets"])
 async def create_asset_for_user(user_id: int, asset: schemas.AssetCreate,
-                                current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.AssetInDB(**asset.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_asset(asset=asset, user_id=user_id)
 
 
-@app.get("/users/{user_id}/assets/", response_model=schemas.AssetUser, tags=["Assets"])
-async def get_assets_for_user(user_id: int, date: datetime = datetime.now(),
-                              current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_assets_user(user_id=user_id, date=date)
+@router.get("/users/{user_id}/assets/", response_model=schemas.AssetUser, tags=["Assets"],
+            dependencies=[Depends(data_etag("assets"))])
+async def get_assets_for_user(user_id: int, request: Request, date: datetime = datetime.now(),
+                              current_user: schemas.User = Depends(get_current_owner)):
+    return respond(request, schemas.AssetUser, await crud.get_assets_user(user_id=user_id, date=date))
 
 
-@app.put("/users/{user_id}/assets/", tags=["Assets"])
+@router.put("/users/{user_id}/assets/", tags=["Assets"])
 async def update_asset_for_user(user_id: int, asset: schemas.AssetOut,
-                                current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "asset updated"}
     return await crud.update_user_asset(asset=asset, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/assets/", tags=["Assets"])
+@router.delete("/users/{user_id}/assets/", tags=["Assets"])
 async def delete_asset_for_user(user_id: int, asset: schemas.AssetDelete,
-                                current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "asset for demo user conditionally deleted"}
     return await crud.update_user_asset(asset=asset, user_id=user_id)
 
 
-@app.post("/users/{user_id}/liabilities/", response_model=schemas.LiabilitieInDB, tags=["Liabilities"])
+@router.put("/users/{user_id}/assets/revaluation", response_model=schemas.AssetUser, tags=["Assets"])
+async def revalue_assets_for_user(user_id: int, revaluations: List[schemas.Revaluation],
+                                  current_user: schemas.User = Depends(get_current_owner)):
+    # все переоценки применяются в одной транзакции; если хоть одной записи нет, не меняется ничего
+    check_revaluations(revaluations)
+    if (user_id == DEMO_USER_ID):
+        return {"assets": []}
+    try:
+        return await crud.revalue_user_assets(revaluations=revaluations, user_id=user_id)
+    except LookupError as exc:
+        raise HTTPException(status_code=404, detail=f"Assets {exc.args[0]} not found")
+
+
+@router.post("/users/{user_id}/liabilities/", response_model=schemas.LiabilitieInDB, tags=["Liabilities"])
 async def create_liabilitie_for_user(user_id: int, liabilitie: schemas.LiabilitieCreate,
-                                     current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                     current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.LiabilitieInDB(**liabilitie.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_liabilitie(liabilitie=liabilitie, user_id=user_id)
 
 
-@app.get("/users/{user_id}/liabilities/", response_model=schemas.LiabilitieUser, tags=["Liabilities"])
-async def get_liabilities_for_user(user_id: int, date: datetime = datetime.now(),
-                                   current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_liabilities_user(user_id=user_id, date=date)
+@router.get("/users/{user_id}/liabilities/", response_model=schemas.LiabilitieUser, tags=["Liabilities"],
+            dependencies=[Depends(data_etag("liabilities"))])
+async def get_liabilities_for_user(user_id: int, request: Request, date: datetime = datetime.now(),
+                                   current_user: schemas.User = Depends(get_current_owner)):
+    return respond(request, schemas.LiabilitieUser, await crud.get_liabilities_user(user_id=user_id, date=date))
 
 
-@app.put("/users/{user_id}/liabilities/", tags=["Liabilities"])
+@router.put("/users/{user_id}/liabilities/", tags=["Liabilities"])
 async def update_liabilitie_for_user(user_id: int, liabilitie: schemas.LiabilitieOut,
-                                     current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                     current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "liabilities regular updated"}
     return await crud.update_user_liabilitie(liabilitie=liabilitie, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/liabilities/", tags=["Liabilities"])
+@router.delete("/users/{user_id}/liabilities/", tags=["Liabilities"])
 async def delete_liabilitie_for_user(user_id: int, liabilitie: schemas.LiabilitieDelete,
-                                     current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                     current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "liabilitie for demo user conditionally deleted"}
     return await crud.update_user_liabilitie(liabilitie=liabilitie, user_id=user_id)
 
 
-@app.get("/users/{user_id}/categories/", response_model=schemas.CategoryUser, tags=["Categories"])
-async def get_categories_for_user(user_id: int, current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_user_categories(user_id=user_id)
+@router.put("/users/{user_id}/liabilities/revaluation", response_model=schemas.LiabilitieUser, tags=["Liabilities"])
+async def revalue_liabilities_for_user(user_id: int, revaluations: List[schemas.Revaluation],
+                                       current_user: schemas.User = Depends(get_current_owner)):
+    # все переоценки применяются в одной транзакции; если хоть одной записи нет, не меняется ничего
+    check_revaluations(revaluations)
+    if (user_id == DEMO_USER_ID):
+        return {"liabilities": []}
+    try:
+        return await crud.revalue_user_liabilities(revaluations=revaluations, user_id=user_id)
+    except LookupError as exc:
+        raise HTTPException(status_code=404, detail=f"Liabilities {exc.args[0]} not found")
+
+
+@router.get("/users/{user_id}/categories/", response_model=schemas.CategoryUser, tags=["Categories"],
+            dependencies=[Depends(data_etag("categories"))])
+async def get_categories_for_user(user_id: int, request: Request,
+                                  current_user: schemas.User = Depends(get_current_owner)):
+    return respond(request, schemas.CategoryUser, await crud.get_user_categories(user_id=user_id))
 
 
-@app.post("/users/{user_id}/categories/", response_model=schemas.CategoryInDB, tags=["Categories"])
+@router.post("/users/{user_id}/categories/", response_model=schemas.CategoryInDB, tags=["Categories"])
 async def create_category_for_user(user_id: int, category: schemas.CategoryCreate,
-                                   current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                   current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return schemas.CategoryInDB(**category.dict(), id=9999999, owner_id=DEMO_USER_ID)
     return await crud.create_user_category(category=category, user_id=user_id)
 
 
-@app.delete("/users/{user_id}/categories/", tags=["Categories"])
+@router.delete("/users/{user_id}/categories/", tags=["Categories"])
 async def delete_category_for_user(user_id: int, category_id: int,
-                                   current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                                   current_user: schemas.User = Depends(get_current_owner)):
     if (user_id == DEMO_USER_ID):
         return {"result": "category for demo user conditionally deleted"}
     return await crud.delete_user_category(category_id=category_id, user_id=user_id)
 
 
-@app.get("/users/{user_id}/reports/", response_model=schemas.ReportsUser, tags=["Reports"])
-async def get_reports(user_id: int, current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    return await crud.get_reports(user_id=user_id)
+@router.get("/users/{user_id}/reports/", response_model=schemas.ReportsUser, tags=["Reports"],
+            dependencies=[Depends(data_etag("assets", "liabilities", "inflow", "outflow", "inflow_regular",
+                                            "outflow_regular"))])
+async def get_reports(user_id: int, request: Request, current_user: schemas.User = Depends(get_current_owner)):
+    return respond(request, schemas.ReportsUser,
+                   await crud.get_reports(user_id=user_id, month=crud.month_of(datetime.now())))
+
+
+@router.get("/users/{user_id}/dashboard", response_model=schemas.Dashboard, tags=["Reports"],
+            dependencies=[Depends(data_etag("inflow", "outflow", "inflow_regular", "outflow_regular", "assets",
+                                            "liabilities", "categories"))])
+async def get_dashboard(user_id: int, request: Request, month: Optional[datetime] = None,
+                        current_user: schemas.User = Depends(get_current_owner)):
+    # один запрос вместо восьми при открытии месяца; активы и пассивы - на конец месяца или на сегодня
+    month = month or datetime.now()
+    _, num_days = calendar.monthrange(month.year, month.month)
+    date_in = datetime(month.year, month.month, 1)
+    date_out = datetime(month.year, month.month, num_days, 23, 59, 59)
+    return respond(request, schemas.Dashboard,
+                   await crud.get_dashboard(user_id=user_id, date_in=date_in, date_out=date_out,
+                                            date=min(date_out, datetime.now())))
+
+
+@router.get("/users/{user_id}/export/", tags=["Reports"])
+async def get_export(user_id: int, current_user: schemas.User = Depends(get_current_owner)):
+    job = await jobs.submit_export(user_id=user_id)
+    await job.done.wait()
+    if job.status != "done":
+        raise HTTPException(status_code=500, detail="Export failed")
+    this_month = str(datetime.now())
+    filename = f'cashflow{this_month[:10]}.xlsx'
+    return jobs.ArtifactResponse(job, filename)
 
 
-@app.get("/users/{user_id}/export/", tags=["Reports"])
-async def get_export(user_id: int, current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
-    await crud.get_export(user_id=user_id)
-    this_month = str(datetime.now())
+@router.post("/users/{user_id}/export/jobs", response_model=schemas.ExportJob, status_code=202, tags=["Reports"])
+async def create_export_job(user_id: int, current_user: schemas.User = Depends(get_current_owner)):
+    return await jobs.submit_export(user_id=user_id)
+
+
+@router.get("/users/{user_id}/export/jobs/{job_id}", response_model=schemas.ExportJob, tags=["Reports"])
+async def get_export_job(user_id: int, job_id: str, current_user: schemas.User = Depends(get_current_owner)):
+    job = jobs.get_job(user_id=user_id, job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return job
+
+
+@router.get("/users/{user_id}/export/jobs/{job_id}/file", tags=["Reports"])
+async def get_export_job_file(user_id: int, job_id: str,
+                              current_user: schemas.User = Depends(get_current_owner)):
+    job = jobs.get_job(user_id=user_id, job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Export job is {job.status}")
+    this_month = str(job.created)
     filename = f'cashflow{this_month[:10]}.xlsx'
-    return FileResponse(path='.' + os.sep + 'static' + os.sep + 'export' + os.sep + f'cashflow{user_id}.xlsx',
-                        filename=filename,
-                        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return jobs.ArtifactResponse(job, filename)
 
 
-@app.get("/users/{user_id}/most_popular/", response_model=schemas.MostPopular, tags=["Most polular"])
+@router.get("/users/{user_id}/most_popular/", response_model=schemas.MostPopular, tags=["Most polular"],
+            dependencies=[Depends(data_etag("outflow", "outflow_regular"))])
 async def get_most_popular(user_id: int, date_in: datetime = month_begin(), date_out: datetime = month_end(),
-                           current_user: schemas.User = Depends(get_current_active_user)):
-    await is_user(user_id, current_user.email)
+                           current_user: schemas.User = Depends(get_current_owner)):
     return await crud.get_most_popular(user_id=user_id, date_in=date_in, date_out=date_out)
 
 
-app.mount("/", StaticFiles(directory="static"), name="static")
+@router.get("/users/{user_id}/autocomplete", response_model=schemas.Autocomplete, tags=["Autocomplete"],
+            dependencies=[Depends(data_etag("inflow", "outflow"))])
+async def get_autocomplete(user_id: int, prefix: str = "", limit: int = Query(10, ge=1, le=100),
+                           current_user: schemas.User = Depends(get_current_owner)):
+    return await crud.get_autocomplete(user_id=user_id, prefix=prefix, limit=limit)
+
+
+def check_secret_key():
+    # случайный ключ у каждого процесса сделал бы токены одного недействительными в другом и после перезапуска,
+    # поэтому без SECRET_KEY запускается только режим SQLite для разработки
+    global SECRET_KEY
+    if SECRET_KEY:
+        return
+    if database.dialect != "sqlite":
+        raise RuntimeError("SECRET_KEY is not set; generate one with `openssl rand -hex 32`")
+    logger.warning("SECRET_KEY is not set: tokens are signed with a random key and expire on restart "
+                   "(allowed only for SQLite development mode)")
+    SECRET_KEY = secrets.token_hex(32)
+
+
+def create_app(database_url: Optional[str] = None, static_dir: str = STATIC_DIR):
+    # база подключается при запуске приложения; в режиме SQLite схема создается из models.py
+    if database_url is not None:
+        database.configure(database_url)
+
+    app = FastAPI(
+        title="Cashflow Api",
+        version="1.0.0",
+        openapi_tags=tags_metadata,
+    )
+    app.include_router(router)
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.exception_handler(PoolTimeout)
+    async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+        # все соединения пула заняты дольше DB_POOL_ACQUIRE_TIMEOUT
+        return JSONResponse(status_code=503, content={"detail": "Database is busy, try again later"},
+                            headers={"Retry-After": "1"})
+
+    @app.on_event("startup")
+    async def startup():
+        check_secret_key()
+        if database.dialect == "sqlite":
+            metadata.create_all(database.get_engine())
+        await database.connect()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await database.disconnect()
+
+    if os.path.isdir(static_dir):
+        app.mount("/", StaticFiles(directory=static_dir), name="static")
+    return app
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
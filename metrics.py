@@ -0,0 +1,152 @@
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+
+# верхние границы корзин гистограмм времени (сек)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple):
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}" if names else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict()
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        values = self.values if self.values or self.labels else {(): 0}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    # для каждого набора меток хранятся счетчики корзин (не накопленные), сумма и число наблюдений
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = dict()
+
+    def observe(self, *labels, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labels + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def gauges(name: str, help: str, values: dict, label: str):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{format_labels((label,), (key,))} {value}" for key, value in values.items()]
+    return lines
+
+
+requests_total = Counter("cashflow_requests_total", "HTTP requests by route template and status",
+                         ("method", "route", "status"))
+request_duration = Histogram("cashflow_request_duration_seconds", "HTTP request latency by route template",
+                             ("method", "route"))
+crud_duration = Histogram("cashflow_crud_duration_seconds", "crud coroutine latency", ("function",))
+crud_rows = Counter("cashflow_crud_rows_total", "Rows returned by crud coroutines", ("function",))
+crud_errors = Counter("cashflow_crud_errors_total", "crud coroutines finished with an exception", ("function",))
+
+registry = [requests_total, request_duration, crud_duration, crud_rows, crud_errors]
+
+# корутина crud, которая выполняется сейчас; по ней запросы к базе связываются с вызывающей функцией
+current_function = contextvars.ContextVar("current_function", default=None)
+
+
+def render(*extra: list):
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    for metric in extra:
+        lines += metric
+    return "\n".join(lines) + "\n"
+
+
+def count_rows(result):
+    # записи в ответах crud лежат в списках, в том числе внутри словарей вида {"inflow": [...]}
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        lists = [len(value) for value in result.values() if isinstance(value, list)]
+        return sum(lists) if lists else 1
+    return 1
+
+
+def timed(func):
+    # время выполнения и число строк результата корутины crud
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_function.set(name)
+        started = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException:
+            crud_errors.inc(name)
+            raise
+        finally:
+            crud_duration.observe(name, value=time.perf_counter() - started)
+            current_function.reset(token)
+        crud_rows.inc(name, value=count_rows(result))
+        return result
+    return wrapper
+
+
+class MetricsMiddleware:
+    # ASGI-middleware без буферизации ответа: статус берется из http.response.start, шаблон пути -
+    # из маршрута, который FastAPI кладет в scope при сопоставлении
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            requests_total.inc(scope["method"], path, status)
+            request_duration.observe(scope["method"], path, value=time.perf_counter() - started)
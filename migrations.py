@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import argparse
+import sys
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+from database import database, metadata
+import models
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied", DateTime, nullable=False)
+)
+
+migrations = []
+# проверки данных перед миграциями: {версия: функция, возвращающая список проблем}
+prechecks = dict()
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+def migration(version: int, description: str):
+    def register(func):
+        migrations.append((version, description, func))
+        return func
+    return register
+
+
+def precheck(version: int):
+    def register(func):
+        prechecks[version] = func
+        return func
+    return register
+
+
+def execute(connection, *statements: str):
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+@migration(1, "initial schema")
+def initial_schema(connection):
+    # таблицы, которые раньше создавались через metadata.create_all при импорте main
+    for table in (models.users, models.inflows, models.inflows_regular, models.outflows, models.outflows_regular,
+                  models.categories, models.assets, models.liabilities, models.data_versions):
+        table.create(connection, checkfirst=True)
+    # в базе из CreateDB.sql или после create_all на месте представлений уже таблицы миграции 3
+    existing = set(inspect(connection).get_table_names()) | set(inspect(connection).get_view_names())
+    for flow in ("inflow", "outflow"):
+        if f"{flow}_lastsum" in existing:
+            continue
+        execute(connection,
+                f"CREATE OR REPLACE VIEW {flow}_lastsum AS "
+                f"SELECT {flow}.description, {flow}.sum, {flow}.owner_id FROM {flow} "
+                f"WHERE {flow}.date = (SELECT max({flow}_1.date) AS max FROM {flow} {flow}_1 "
+                f"WHERE {flow}_1.description = {flow}.description AND {flow}.owner_id = {flow}_1.owner_id)")
+
+
+@precheck(2)
+def duplicate_emails(connection):
+    # уникальный индекс по email не создать, пока в старой базе есть пользователи с одинаковым email
+    inspector = inspect(connection)
+    if not inspector.has_table("users") or \
+            "ix_users_email" in {index['name'] for index in inspector.get_indexes("users")}:
+        return []
+    rows = connection.execute(text("SELECT email, count(*) AS count FROM users GROUP BY email "
+                                   "HAVING count(*) > 1 ORDER BY email LIMIT 10")).fetchall()
+    return [f"users.email {row.email!r} belongs to {row.count} users; unique index ix_users_email "
+            f"needs one user per email, change or merge these accounts" for row in rows]
+
+
+@migration(2, "indexes for owner/date and owner/description lookups")
+def owner_indexes(connection):
+    execute(connection,
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)",
+            "CREATE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+            "CREATE INDEX IF NOT EXISTS ix_inflow_owner_id_date ON inflow (owner_id, date)",
+            "CREATE INDEX IF NOT EXISTS ix_inflow_owner_id_description ON inflow (owner_id, description)",
+            "CREATE INDEX IF NOT EXISTS ix_outflow_owner_id_date ON outflow (owner_id, date)",
+            "CREATE INDEX IF NOT EXISTS ix_outflow_owner_id_description ON outflow (owner_id, description)",
+            "CREATE INDEX IF NOT EXISTS ix_inflow_regular_owner_id ON inflow_regular (owner_id)",
+            "CREATE INDEX IF NOT EXISTS ix_outflow_regular_owner_id ON outflow_regular (owner_id)",
+            "CREATE INDEX IF NOT EXISTS ix_assets_owner_id_date_in_date_out ON assets (owner_id, date_in, date_out)",
+            "CREATE INDEX IF NOT EXISTS ix_liabilities_owner_id_date_in_date_out "
+            "ON liabilities (owner_id, date_in, date_out)",
+            "CREATE INDEX IF NOT EXISTS ix_categories_owner_id ON categories (owner_id)")
+
+
+@migration(3, "latest amount tables instead of the inflow_lastsum/outflow_lastsum views")
+def lastsum_tables(connection):
+    views = set(inspect(connection).get_view_names())
+    for flow, table in (("inflow", models.inflows_lastsum), ("outflow", models.outflows_lastsum)):
+        if f"{flow}_lastsum" in views:
+            execute(connection, f"DROP VIEW {flow}_lastsum")
+        table.create(connection, checkfirst=True)
+        execute(connection,
+                f"INSERT INTO {flow}_lastsum (owner_id, description, date, sum, flow_id) "
+                f"SELECT DISTINCT ON (owner_id, description) owner_id, description, date, sum, id FROM {flow} "
+                f"WHERE owner_id IS NOT NULL ORDER BY owner_id, description, date DESC, id DESC "
+                f"ON CONFLICT (owner_id, description) DO NOTHING")
+
+
+@migration(4, "monthly inflow/outflow sums by description")
+def monthly_rollup(connection):
+    models.flows_monthly.create(connection, checkfirst=True)
+    rebuild_monthly(connection)
+
+
+@migration(5, "outflow usage counters for the most popular suggestions")
+def outflow_usage(connection):
+    models.outflows_usage.create(connection, checkfirst=True)
+    rebuild_usage(connection)
+
+
+def rebuild_monthly(connection):
+    execute(connection, "DELETE FROM flow_monthly")
+    for flow in ("inflow", "outflow"):
+        execute(connection,
+                f"INSERT INTO flow_monthly (owner_id, month, kind, description, sum, count) "
+                f"SELECT owner_id, date_trunc('month', date), '{flow}', description, sum(sum), count(*) FROM {flow} "
+                f"WHERE owner_id IS NOT NULL GROUP BY owner_id, date_trunc('month', date), description")
+
+
+def rebuild_usage(connection):
+    execute(connection,
+            "DELETE FROM outflow_usage",
+            "INSERT INTO outflow_usage (owner_id, description, count, last_used) "
+            "SELECT owner_id, description, count(*), max(date) FROM outflow "
+            "WHERE owner_id IS NOT NULL GROUP BY owner_id, description")
+
+
+def rebuild_rollups(connection):
+    # пересчет помесячных сумм и счетчиков расходов с нуля; на время пересчета запись в inflow и outflow блокируется
+    execute(connection, "LOCK TABLE inflow, outflow IN SHARE MODE")
+    rebuild_monthly(connection)
+    rebuild_usage(connection)
+
+
+def applied_versions(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return {row.version for row in connection.execute(select(schema_migrations.c.version))}
+
+
+def upgrade():
+    # проверки данных выполняются до первой миграции, чтобы ошибка не оставила схему обновленной наполовину
+    with database.get_engine().begin() as connection:
+        applied = applied_versions(connection)
+        problems = [problem for version, check_data in sorted(prechecks.items()) if version not in applied
+                    for problem in check_data(connection)]
+    if problems:
+        raise MigrationError("cannot upgrade, no migrations applied:\n" + "\n".join(problems))
+    for version, description, func in sorted(migrations, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        # каждая миграция применяется в своей транзакции вместе с отметкой о применении
+        with database.get_engine().begin() as connection:
+            func(connection)
+            connection.execute(schema_migrations.insert().values(version=version, description=description,
+                                                                 applied=datetime.now()))
+        print(f"applied {version}: {description}")
+
+
+def status():
+    with database.get_engine().begin() as connection:
+        applied = applied_versions(connection)
+    for version, description, _ in sorted(migrations, key=lambda item: item[0]):
+        print(f"[{'x' if version in applied else ' '}] {version}: {description}")
+
+
+def check():
+    # неприменённые миграции и индексы из models.py, которых нет в базе
+    problems = []
+    with database.get_engine().begin() as connection:
+        applied = applied_versions(connection)
+        problems += [f"migration {version} is not applied: {description}"
+                     for version, description, _ in sorted(migrations, key=lambda item: item[0])
+                     if version not in applied]
+        inspector = inspect(connection)
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                problems.append(f"table {table.name} is missing")
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            problems += [f"index {index.name} on {table.name} is missing"
+                         for index in sorted(table.indexes, key=lambda index: index.name)
+                         if index.name not in existing]
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("schema is up to date")
+    return not problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("command", choices=["upgrade", "status", "check", "rebuild-rollups"])
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        try:
+            upgrade()
+        except MigrationError as exc:
+            print(exc, file=sys.stderr)
+            sys.exit(1)
+    elif args.command == "status":
+        status()
+    elif args.command == "rebuild-rollups":
+        with database.get_engine().begin() as connection:
+            rebuild_rollups(connection)
+    elif not check():
+        sys.exit(1)
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Table, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Table, DateTime, Index
 from database import metadata
 
 users = Table(
@@ -8,7 +8,8 @@ users = Table(
     Column("username", String),
     Column("email", String, unique=True, index=True),
     Column("hashed_password", String),
-    Column("is_active", Boolean, default=True)
+    Column("is_active", Boolean, default=True),
+    Index("ix_users_username", "username")
 )
 
 
@@ -19,7 +20,9 @@ inflows = Table(
     Column("date", DateTime, nullable=False),
     Column("description", String, nullable=False, default='unknown'),
     Column("sum", Integer, nullable=False, default=0),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_inflow_owner_id_date", "owner_id", "date"),
+    Index("ix_inflow_owner_id_description", "owner_id", "description")
 )
 
 
@@ -29,7 +32,19 @@ inflows_regular = Table(
     Column("id", Integer, unique=True, primary_key=True, autoincrement=True),
     Column("description", String, nullable=False, default='unknown'),
     Column("sum", Integer, nullable=False, default=0),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_inflow_regular_owner_id", "owner_id")
+)
+
+
+inflows_lastsum = Table(
+    "inflow_lastsum",
+    metadata,
+    Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column("description", String, primary_key=True),
+    Column("date", DateTime, nullable=False),
+    Column("sum", Integer, nullable=False, default=0),
+    Column("flow_id", Integer, nullable=False)
 )
 
 
@@ -40,7 +55,9 @@ outflows = Table(
     Column("date", DateTime, nullable=False),
     Column("description", String, nullable=False, default='unknown'),
     Column("sum", Integer, nullable=False, default=0),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_outflow_owner_id_date", "owner_id", "date"),
+    Index("ix_outflow_owner_id_description", "owner_id", "description")
 )
 
 
@@ -50,7 +67,42 @@ outflows_regular = Table(
     Column("id", Integer, unique=True, primary_key=True, autoincrement=True),
     Column("description", String, nullable=False, default='unknown'),
     Column("sum", Integer, nullable=False, default=0),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_outflow_regular_owner_id", "owner_id")
+)
+
+
+outflows_lastsum = Table(
+    "outflow_lastsum",
+    metadata,
+    Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column("description", String, primary_key=True),
+    Column("date", DateTime, nullable=False),
+    Column("sum", Integer, nullable=False, default=0),
+    Column("flow_id", Integer, nullable=False)
+)
+
+
+outflows_usage = Table(
+    "outflow_usage",
+    metadata,
+    Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column("description", String, primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+    Column("last_used", DateTime, nullable=False),
+    Index("ix_outflow_usage_owner_id_count", "owner_id", "count")
+)
+
+
+flows_monthly = Table(
+    "flow_monthly",
+    metadata,
+    Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column("month", DateTime, primary_key=True),
+    Column("kind", String, primary_key=True),
+    Column("description", String, primary_key=True),
+    Column("sum", Integer, nullable=False, default=0),
+    Column("count", Integer, nullable=False, default=0)
 )
 
 
@@ -63,7 +115,8 @@ assets = Table(
     Column("description", String, nullable=False, default='unknown'),
     Column("sum", Integer, nullable=False, default=0),
     Column("category_id", Integer, nullable=True),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_assets_owner_id_date_in_date_out", "owner_id", "date_in", "date_out")
 )
 
 
@@ -76,7 +129,8 @@ liabilities = Table(
     Column("description", String, nullable=False, default='unknown'),
     Column("sum", Integer, nullable=False, default=0),
     Column("category_id", Integer, nullable=True),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_liabilities_owner_id_date_in_date_out", "owner_id", "date_in", "date_out")
 )
 
 
@@ -85,5 +139,15 @@ categories = Table(
     metadata,
     Column("id", Integer, unique=True, primary_key=True, autoincrement=True),
     Column("category", String, nullable=False, default='unknown'),
-    Column("owner_id", Integer, ForeignKey("users.id"))
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Index("ix_categories_owner_id", "owner_id")
+)
+
+
+data_versions = Table(
+    "data_versions",
+    metadata,
+    Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column("resource", String, primary_key=True),
+    Column("version", Integer, nullable=False, default=0)
 )
@@ -0,0 +1,33 @@
+from inspect import isclass
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def project(model, content: dict):
+    # ответ crud приводится к полям схемы ответа без создания pydantic-объектов: у списков моделей
+    # остаются только поля модели, значения не проверяются (строки уже пришли из базы нужных типов)
+    result = dict()
+    for name, field in model.__fields__.items():
+        value = content.get(name, field.get_default())
+        if field.shape == SHAPE_LIST and isclass(field.type_) and issubclass(field.type_, BaseModel):
+            columns = list(field.type_.__fields__)
+            value = [{column: row.get(column) for column in columns} for row in value]
+        result[name] = value
+    return result
+
+
+def fast_json(model, content: dict) -> bytes:
+    return orjson.dumps(project(model, content))
+
+
+class FastJSONResponse(JSONResponse):
+    # ответ, уже приведенный к схеме через project, сериализуется orjson сразу в байты
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
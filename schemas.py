@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from typing import List, Union
+from typing import List, Optional, Union
 from pydantic import BaseModel, BaseSettings, Field
 
 
@@ -56,6 +56,20 @@ class TokenData(BaseModel):
     username: str | None = None
 
 
+class FlowDescriptionGroup(BaseModel):
+    # строка выдачи с group_by=description: описание, сумма и число записей
+    description: str
+    sum: int
+    count: int
+
+
+class FlowPeriodGroup(BaseModel):
+    # строка выдачи с group_by=day|week: начало дня или недели, сумма и число записей
+    date: datetime
+    sum: int
+    count: int
+
+
 class InflowBase(BaseModel):
     date: datetime = Field(default_factory=datetime.now)
     description: str = 'Прочие доходы'
@@ -77,11 +91,28 @@ class InflowInDB(InflowBase):
 
 class InflowUser(BaseModel):
     inflow: List[InflowInDB] = []
+    next_cursor: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
+
+class InflowBulkUser(BaseModel):
+    # созданные записи; курсора у ответа на пакетную запись нет
+    inflow: List[InflowInDB] = []
 
     class Config:
         orm_mode = True
 
 
+class InflowDescriptionGroupUser(BaseModel):
+    inflow: List[FlowDescriptionGroup] = []
+
+
+class InflowPeriodGroupUser(BaseModel):
+    inflow: List[FlowPeriodGroup] = []
+
+
 class InflowRegularBase(BaseModel):
     description: str = 'Ежемесячные доходы'
     sum: int = 0
@@ -140,11 +171,27 @@ class OutflowInDB(OutflowBase):
 
 class OutflowUser(BaseModel):
     outflow: List[OutflowInDB] = []
+    next_cursor: Optional[str] = None
 
     class Config:
         orm_mode = True
 
 
+class OutflowBulkUser(BaseModel):
+    outflow: List[OutflowInDB] = []
+
+    class Config:
+        orm_mode = True
+
+
+class OutflowDescriptionGroupUser(BaseModel):
+    outflow: List[FlowDescriptionGroup] = []
+
+
+class OutflowPeriodGroupUser(BaseModel):
+    outflow: List[FlowPeriodGroup] = []
+
+
 class OutflowRegularBase(BaseModel):
     description: str = 'Ежемесячные расходы'
     sum: int = 0
@@ -272,6 +319,13 @@ class LiabilitieUser(BaseModel):
         orm_mode = True
 
 
+class Revaluation(BaseModel):
+    # новая сумма актива или пассива с начала месяца date; sum = 0 закрывает запись без продолжения
+    id: int
+    sum: int
+    date: datetime = Field(default_factory=datetime.now)
+
+
 class CategoryBase(BaseModel):
     category: str = 'Прочая категория'
 
@@ -342,4 +396,61 @@ class MostPopular(BaseModel):
     autocomplete: List = []
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class Autocomplete(BaseModel):
+    autocomplete: List[str] = []
+
+
+class DashboardTotals(BaseModel):
+    inflow: int = 0
+    outflow: int = 0
+    cashflow: int = 0
+    assets: int = 0
+    liabilities: int = 0
+    capital: int = 0
+
+
+class Dashboard(BaseModel):
+    date_in: datetime
+    date_out: datetime
+    inflow: List[InflowInDB] = []
+    outflow: List[OutflowInDB] = []
+    inflow_regular: List[InflowRegularInDB] = []
+    outflow_regular: List[OutflowRegularInDB] = []
+    assets: List[AssetOut] = []
+    liabilities: List[LiabilitieOut] = []
+    categories: List[CategoryOut] = []
+    most_popular: List[Popular] = []
+    totals: DashboardTotals
+
+    class Config:
+        orm_mode = True
+
+
+class ExportJob(BaseModel):
+    id: str
+    status: str
+    created: datetime
+    finished: Union[datetime, None] = None
+
+    class Config:
+        orm_mode = True
+
+
+class ImportProfile(BaseModel):
+    delimiter: str = Field(';', min_length=1, max_length=1)
+    encoding: str = 'utf-8-sig'
+    header: bool = True
+    skip_rows: int = Field(0, ge=0)
+    date_column: str = 'date'
+    date_format: str = '%d.%m.%Y'
+    description_column: str = 'description'
+    sum_column: str = 'sum'
+
+
+class ImportResult(BaseModel):
+    total: int
+    imported: int
+    skipped: int
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from config import BCRYPT_ROUNDS, HASH_WORKERS, HASH_QUEUE_LIMIT
+
+# хэши с другим числом раундов помечаются как устаревшие и пересчитываются при входе
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+hashing_requests = 0
+
+
+async def run_hashing(func, *args):
+    # bcrypt выполняется в отдельном пуле потоков; если очередь переполнена, запрос отклоняется сразу
+    global hashing_requests
+    if hashing_requests >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many authentication requests, try again later",
+                            headers={"Retry-After": "1"})
+    hashing_requests += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    finally:
+        hashing_requests -= 1
+
+
+async def get_password_hash(password: str) -> str:
+    return await run_hashing(pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str):
+    # возвращает (пароль верный, новый хэш или None, если пересчет не нужен)
+    return await run_hashing(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+def calibrate(target_ms: float, min_rounds: int = 4, max_rounds: int = 16, samples: int = 3):
+    # наибольшее число раундов, при котором хэширование укладывается в target_ms
+    best = min_rounds
+    CryptContext(schemes=["bcrypt"], bcrypt__rounds=min_rounds).hash("warm up")
+    for rounds in range(min_rounds, max_rounds + 1):
+        context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+        started = time.perf_counter()
+        for _ in range(samples):
+            context.hash("calibration password")
+        elapsed_ms = (time.perf_counter() - started) * 1000 / samples
+        print(f"rounds={rounds}: {elapsed_ms:.1f} ms")
+        if elapsed_ms > target_ms:
+            break
+        best = rounds
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Password hashing utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser("calibrate", help="pick bcrypt cost for a target hashing latency")
+    calibrate_parser.add_argument("--target-ms", type=float, default=250)
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        rounds = calibrate(args.target_ms)
+        print(f"BCRYPT_ROUNDS={rounds}  # current: {BCRYPT_ROUNDS}")
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+import random
+from datetime import datetime, timedelta
+
+from autocomplete import PrefixIndex
+
+
+def test_prefix_index_ranks_by_count_then_recency():
+    index = PrefixIndex()
+    index.add("Кафе", datetime(2022, 1, 1), count=3)
+    index.add("Кафетерий", datetime(2022, 3, 1), count=3)
+    index.add("Каршеринг", datetime(2022, 2, 1), count=5)
+    index.add("Такси", datetime(2022, 2, 1))
+    assert index.search("ка", 10) == ["Каршеринг", "Кафетерий", "Кафе"]
+    assert index.search("КАФ", 1) == ["Кафетерий"]
+    assert index.search("", 2) == ["Каршеринг", "Кафетерий"]
+
+
+def test_prefix_index_updates_incrementally():
+    index = PrefixIndex()
+    index.add("Такси", datetime(2022, 1, 1))
+    index.add("Такси", datetime(2022, 2, 1))
+    index.remove("Такси")
+    assert index.search("так", 10) == ["Такси"]
+    index.remove("Такси")
+    index.remove("Такси")
+    assert index.search("так", 10) == []
+    assert index.keys == []
+
+
+def test_prefix_index_returns_top_matches_of_many():
+    rng = random.Random(1)
+    index = PrefixIndex()
+    stats = dict()
+    for number in range(2000):
+        description = f"Кафе {number}"
+        stats[description] = (rng.randint(1, 20), datetime(2022, 1, 1) + timedelta(days=rng.randint(0, 365)))
+        index.add(description, stats[description][1], count=stats[description][0])
+        index.add(f"Такси {number}", datetime(2022, 1, 1), count=100)
+    expected = sorted(stats, key=lambda description: stats[description], reverse=True)
+    assert index.search("ка", 10) == expected[:10]
+    assert index.search("кафе 1", 5) == [description for description in expected
+                                         if description.startswith("Кафе 1")][:5]
+    assert index.search("ка", 0) == []
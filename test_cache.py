@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+import asyncio
+import time
+
+from cache import MemoryCache, TTLCache
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("token", "alice", ttl=0.01)
+    cache.set("expired", "bob", ttl=-1)
+    time.sleep(0.02)
+    assert cache.get("token") is None
+    assert cache.get("expired") is None
+    assert len(cache) == 0
+
+
+def test_memory_cache_evicts_by_size_and_invalidates_tags():
+    async def scenario():
+        cache = MemoryCache(max_bytes=10, ttl=60)
+        await cache.set("a", b"12345", ["1:inflow"], await cache.generation(["1:inflow"]))
+        await cache.set("b", b"12345", ["1:outflow"], await cache.generation(["1:outflow"]))
+        assert await cache.get("a") == b"12345"
+        await cache.set("c", b"1", ["2:inflow"], await cache.generation(["2:inflow"]))
+        assert await cache.get("b") is None
+        await cache.invalidate("1:inflow")
+        assert await cache.get("a") is None and await cache.get("c") == b"1"
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["entries"], stats["bytes"], stats["evictions"], stats["invalidations"]) == (1, 1, 1, 1)
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+
+
+def test_memory_cache_skips_values_read_before_invalidation():
+    async def scenario():
+        cache = MemoryCache(max_bytes=100, ttl=60)
+        generation = await cache.generation(["1:inflow"])
+        await cache.invalidate("1:inflow")
+        await cache.set("a", b"stale", ["1:inflow"], generation)
+        return await cache.get("a")
+
+    assert asyncio.run(scenario()) is None
+
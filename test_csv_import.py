@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import csv_import
+import schemas
+from csv_import import complete_part_end, iter_batches, parse_sum, spooled
+
+
+async def collect(chunks, profile):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+    return [row async for batch in iter_batches(stream(), profile, 1) for row in batch]
+
+
+def test_complete_part_end_keeps_quoted_newlines():
+    text = 'a;"b\nc";1\nd;"e\n'
+    assert text[:complete_part_end(text)] == 'a;"b\nc";1\n'
+    assert complete_part_end('a;"b\nc') == 0
+
+
+def test_iter_batches_reads_chunked_upload():
+    data = 'date;description;sum\n01.02.2022;"Кафе\n""Ромашка""";-1 234,56\n\n02.02.2022;Такси;300\n'
+    data = data.encode('utf-8-sig')
+    rows = asyncio.run(collect([data[i:i + 5] for i in range(0, len(data), 5)], schemas.ImportProfile()))
+    assert [(line, date.day, description, sum) for line, date, description, sum, _ in rows] == \
+           [(2, 1, 'Кафе\n"Ромашка"', 1235), (4, 2, 'Такси', 300)]
+    assert rows[0][4] != rows[1][4]
+
+
+def test_iter_batches_stops_at_unmatched_quote(monkeypatch):
+    monkeypatch.setattr(csv_import, "IMPORT_MAX_PENDING", 100)
+    data = ('date;description;sum\n01.02.2022;"Кафе;300\n' + '02.02.2022;Такси;300\n' * 50).encode()
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(collect([data[i:i + 10] for i in range(0, len(data), 10)], schemas.ImportProfile()))
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("value", ["inf", "-inf", "nan", "1e400", "1e12", "2147483648"])
+def test_parse_sum_rejects_values_out_of_integer_range(value):
+    with pytest.raises(ValueError):
+        parse_sum(value)
+    data = f"01.02.2022;Кафе;{value}\n".encode()
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(collect([data], schemas.ImportProfile(header=False, date_column="0", description_column="1",
+                                                          sum_column="2")))
+    assert error.value.status_code == 400
+
+
+def test_spooled_upload_is_read_back_in_chunks(monkeypatch):
+    monkeypatch.setattr(csv_import, "IMPORT_SPOOL_SIZE", 100)
+    monkeypatch.setattr(csv_import, "IMPORT_CHUNK_SIZE", 70)
+    data = b"".join(f"{day:02d}.02.2022;Такси;{day}\n".encode() for day in range(1, 29))
+
+    async def read():
+        async def stream():
+            for start in range(0, len(data), 33):
+                yield data[start:start + 33]
+        async with spooled(stream()) as upload:
+            return [chunk async for chunk in upload]
+
+    chunks = asyncio.run(read())
+    assert b"".join(chunks) == data
+    assert max(len(chunk) for chunk in chunks) == 70
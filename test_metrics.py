@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+import asyncio
+
+import metrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe("/users/{user_id}/", value=value)
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{route="/users/{user_id}/",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/users/{user_id}/",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{route="/users/{user_id}/",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{route="/users/{user_id}/"} 4' in lines
+
+
+def test_timed_counts_rows_and_errors():
+    async def get_flows(fail: bool):
+        if fail:
+            raise ValueError
+        return {"outflow": [1, 2, 3], "next_cursor": None}
+
+    timed = metrics.timed(get_flows)
+    rows = metrics.crud_rows.values.get(("get_flows",), 0)
+    errors = metrics.crud_errors.values.get(("get_flows",), 0)
+    assert asyncio.run(timed(False))["outflow"] == [1, 2, 3]
+    try:
+        asyncio.run(timed(True))
+    except ValueError:
+        pass
+    assert metrics.crud_rows.values[("get_flows",)] == rows + 3
+    assert metrics.crud_errors.values[("get_flows",)] == errors + 1
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+
+import asyncio
+import logging
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+import autocomplete
+import crud
+import csv_import
+import database as database_module
+import main
+import migrations
+import schemas
+from cache import MemoryCache, TTLCache
+from config import SQLALCHEMY_DATABASE_URL
+from database import database, explain_tasks, gather, metadata, slow_queries
+from test_sqlite import check_foreign_ids_are_not_found, check_regular_sum_follows_latest_flow, \
+    check_revaluation_keeps_category
+
+
+@contextmanager
+def temporary_database():
+    # отдельная база на сервере из DATABASE_URL, удаляется после использования
+    url = make_url(SQLALCHEMY_DATABASE_URL)
+    if url.get_backend_name() != "postgresql":
+        pytest.skip("DATABASE_URL is not a PostgreSQL database")
+    server = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    name = f"cashflow_test_{uuid.uuid4().hex[:8]}"
+    try:
+        with server.connect() as connection:
+            connection.execute(text(f'CREATE DATABASE "{name}"'))
+    except OperationalError:
+        pytest.skip("PostgreSQL is not available")
+    try:
+        yield url.set(database=name).render_as_string(hide_password=False)
+    finally:
+        with server.connect() as connection:
+            connection.execute(text(f'DROP DATABASE "{name}" WITH (FORCE)'))
+        server.dispose()
+
+
+@pytest.fixture(scope="module")
+def postgres_url():
+    # схема создается миграциями, как у рабочей базы
+    with temporary_database() as url:
+        database.configure(url)
+        migrations.upgrade()
+        database.get_engine().dispose()
+        yield url
+        database.configure(SQLALCHEMY_DATABASE_URL)
+
+
+@pytest.fixture
+def client(postgres_url, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MY_INVITE", "invite")
+    monkeypatch.setattr(crud, "response_cache", MemoryCache(max_bytes=1024 * 1024, ttl=60))
+    monkeypatch.setattr(autocomplete, "indexes", TTLCache(maxsize=10, ttl=60))
+    app = main.create_app(database_url=postgres_url, static_dir=str(tmp_path / "static"))
+    with TestClient(app) as client:
+        yield client
+
+
+def login(client):
+    # база общая для тестов модуля, поэтому у каждого теста свой пользователь
+    username = f"user{uuid.uuid4().hex[:8]}"
+    response = client.post("/register", json={"username": username, "email": f"{username}@example.com",
+                                              "password": "secret", "invite": "invite"})
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+    response = client.post("/token", data={"username": username, "password": "secret"})
+    assert response.status_code == 200
+    return user_id, {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def test_postgres_balance_series_matches_python_series(client):
+    user_id, headers = login(client)
+    # переоценка вклада, пассив с разрывом: месяцы без записей обрывают ряд
+    for flow, date_in, date_out, sum in (("assets", "2025-01-01T00:00:00", "2025-06-30T23:59:59", 1000),
+                                         ("assets", "2025-07-01T00:00:00", "2300-01-01T00:00:00", 1200),
+                                         ("liabilities", "2024-09-10T00:00:00", "2024-11-30T23:59:59", 300),
+                                         ("liabilities", "2025-03-20T00:00:00", "2300-01-01T00:00:00", 500)):
+        response = client.post(f"/users/{user_id}/{flow}/", headers=headers,
+                               json={"date_in": date_in, "date_out": date_out, "description": flow, "sum": sum})
+        assert response.status_code == 200
+
+    now = datetime.now()
+    series = client.portal.call(crud.get_balance_series, user_id, now)
+    assert series == client.portal.call(crud.build_balance_series, user_id, now)
+    assert series[-1] == {"date": datetime(2025, 1, 15), "assets": 1000, "liabilities": 0}
+    assert {"date": datetime(2025, 4, 15), "assets": 1000, "liabilities": 500} in series
+
+    reports = client.get(f"/users/{user_id}/reports/", headers=headers).json()
+    assert reports["assets"][-1] == {"description": "01.25", "sum": 1000}
+
+
+def test_postgres_migrations_upgrade_schema_created_without_them():
+    # create_all и CreateDB.sql создают сразу таблицы последних сумм и не отмечают миграции примененными
+    with temporary_database() as url:
+        database.configure(url)
+        try:
+            metadata.create_all(database.get_engine())
+            assert not migrations.check()
+            migrations.upgrade()
+            assert migrations.check()
+        finally:
+            database.get_engine().dispose()
+            database.configure(SQLALCHEMY_DATABASE_URL)
+
+
+def test_postgres_migrations_stop_before_upgrade_on_duplicate_emails():
+    # старая база без уникального индекса по email: миграции не применяются, пока дубли не исправлены
+    with temporary_database() as url:
+        database.configure(url)
+        try:
+            with database.get_engine().begin() as connection:
+                connection.execute(text("CREATE TABLE users (id serial PRIMARY KEY, username varchar, "
+                                        "email varchar, hashed_password varchar, is_active boolean)"))
+                connection.execute(text("INSERT INTO users (username, email) VALUES "
+                                        "('alice', 'same@example.com'), ('bob', 'same@example.com'), "
+                                        "('carol', 'carol@example.com')"))
+            with pytest.raises(migrations.MigrationError, match="same@example.com"):
+                migrations.upgrade()
+            with database.get_engine().begin() as connection:
+                assert migrations.applied_versions(connection) == set()
+                connection.execute(text("UPDATE users SET email = 'bob@example.com' WHERE username = 'bob'"))
+            migrations.upgrade()
+            assert migrations.check()
+        finally:
+            database.get_engine().dispose()
+            database.configure(SQLALCHEMY_DATABASE_URL)
+
+
+def test_postgres_regular_sums_follow_latest_flow(client):
+    user_id, headers = login(client)
+    for flow in ("inflow", "outflow"):
+        check_regular_sum_follows_latest_flow(client, user_id, headers, flow)
+
+
+def test_postgres_foreign_ids_are_not_found(client):
+    check_foreign_ids_are_not_found(client, login(client), login(client))
+
+
+def test_postgres_revaluation_keeps_category(client):
+    user_id, headers = login(client)
+    for resource in ("assets", "liabilities"):
+        check_revaluation_keeps_category(client, user_id, headers, resource)
+
+
+def test_postgres_concurrent_imports_of_one_file_import_it_once(client):
+    user_id, headers = login(client)
+    data = "".join(f"{day:02d}.03.2026;Кофе;{day * 10}\n" for day in range(1, 21)).encode()
+    profile = schemas.ImportProfile(header=False, date_column="0", description_column="1", sum_column="2")
+
+    async def stream():
+        yield data
+
+    async def import_twice():
+        return await gather(*(crud.import_user_outflows(batches=csv_import.iter_batches(stream(), profile, user_id),
+                                                        user_id=user_id) for _ in range(2)))
+
+    results = client.portal.call(import_twice)
+    assert sorted(result["imported"] for result in results) == [0, 20]
+    response = client.get(f"/users/{user_id}/outflow/", headers=headers,
+                          params={"date_in": "2026-03-01T00:00:00", "date_out": "2026-03-31T23:59:59"})
+    assert len(response.json()["outflow"]) == 20
+
+
+def test_postgres_import_streams_spooled_upload_in_batches(client, monkeypatch):
+    user_id, headers = login(client)
+    monkeypatch.setattr(csv_import, "IMPORT_BATCH_SIZE", 7)
+    monkeypatch.setattr(csv_import, "IMPORT_SPOOL_SIZE", 100)
+    params = {"header": "false", "date_column": "0", "description_column": "1", "sum_column": "2"}
+    lines = [f"{day % 28 + 1:02d}.03.2026;Кофе {day};{day + 1}\n" for day in range(50)]
+    # ошибка в последней пачке откатывает уже скопированные
+    response = client.post(f"/users/{user_id}/outflow/import", headers=headers, params=params,
+                           content="".join(lines + ["31.03.2026;Кофе;1e12\n"]).encode())
+    assert response.status_code == 400
+    response = client.post(f"/users/{user_id}/outflow/import", headers=headers, params=params,
+                           content="".join(lines).encode())
+    assert response.json() == {"total": 50, "imported": 50, "skipped": 0}
+
+
+def make_flow_history(client, user_id, headers):
+    # записи через все пути изменения: по одной, пачкой, импортом и удалением
+    ids = []
+    for flow, date, description, sum in (("inflow", "2026-01-05T10:00:00", "Зарплата", 1000),
+                                         ("outflow", "2026-01-06T10:00:00", "Кофе", 100),
+                                         ("outflow", "2026-02-01T00:00:00", "Такси", 300),
+                                         ("outflow", "2026-01-31T23:59:59", "Кофе", 150)):
+        response = client.post(f"/users/{user_id}/{flow}/", headers=headers,
+                               json={"date": date, "description": description, "sum": sum})
+        ids.append((flow, response.json()["id"]))
+    response = client.post(f"/users/{user_id}/outflow/bulk", headers=headers,
+                           json=[{"date": f"2026-02-{day:02d}T12:00:00", "description": description, "sum": day}
+                                 for day in range(1, 11) for description in ("Кофе", "Кино")])
+    ids += [("outflow", outflow["id"]) for outflow in response.json()["outflow"][:3]]
+    for flow in ("inflow", "outflow"):
+        response = client.post(f"/users/{user_id}/{flow}/import", headers=headers,
+                               params={"header": "false", "date_column": "0", "description_column": "1",
+                                       "sum_column": "2"},
+                               content="03.02.2026;Кофе;70\n15.03.2026;Аптека;500\n".encode())
+        assert response.json()["imported"] == 2
+    # удаляются единственная запись месяца, последняя запись описания и записи из пачки
+    for flow, flow_id in ids[1:3] + ids[4:]:
+        response = client.delete(f"/users/{user_id}/{flow}/", headers=headers, params={f"{flow}_id": flow_id})
+        assert response.json() == {"result": f"{flow} deleted"}
+
+
+def read_rollup(table: str, user_id: int):
+    with database.get_engine().connect() as connection:
+        rows = connection.execute(text(f"SELECT * FROM {table} WHERE owner_id = :owner_id"),
+                                  {"owner_id": user_id})
+        return sorted(tuple(row) for row in rows)
+
+
+def rebuild_rollups():
+    with database.get_engine().begin() as connection:
+        migrations.rebuild_rollups(connection)
+
+
+def test_postgres_monthly_sums_match_rebuild(client):
+    user_id, headers = login(client)
+    make_flow_history(client, user_id, headers)
+    monthly = read_rollup("flow_monthly", user_id)
+    assert monthly
+    rebuild_rollups()
+    assert read_rollup("flow_monthly", user_id) == monthly
+
+
+def test_postgres_outflow_usage_matches_rebuild(client):
+    user_id, headers = login(client)
+    make_flow_history(client, user_id, headers)
+    usage = read_rollup("outflow_usage", user_id)
+    assert usage
+    rebuild_rollups()
+    assert read_rollup("outflow_usage", user_id) == usage
+
+
+def test_postgres_slow_query_log_hides_values_and_does_not_analyze_writes(client, caplog):
+    user_id, headers = login(client)
+    statements = [("SELECT description FROM outflow_regular WHERE owner_id = $1 AND sum > 987654 "
+                   "AND description <> 'Такси'", True),
+                  ("WITH regular AS (SELECT CAST($1 AS integer) AS owner_id) "
+                   "INSERT INTO outflow_regular (description, sum, owner_id) "
+                   "SELECT 'Такси', 987654, owner_id FROM regular", False)]
+    with caplog.at_level(logging.WARNING, logger="database"):
+        for statement, analyzed in statements:
+            caplog.clear()
+            client.portal.call(slow_queries.explain, database._backend._pool, statement, [user_id], 1.0, "test", "")
+            log = caplog.text
+            assert "EXPLAIN failed" not in log
+            assert ("actual time" in log) == analyzed
+            assert "987654" not in log and "Такси" not in log
+    assert client.get(f"/users/{user_id}/outflow_regular/", headers=headers).json()["outflow_regular"] == []
+
+
+def test_postgres_slow_query_explain_task_is_kept_until_done(client, monkeypatch, caplog):
+    monkeypatch.setattr(database_module, "SLOW_QUERY_MS", 1e-9)
+    monkeypatch.setattr(slow_queries, "explained", TTLCache(maxsize=10, ttl=60))
+
+    async def slow_query():
+        await database.fetch_all("SELECT 1 AS slow_query_task_check")
+        pending = set(explain_tasks)
+        assert pending
+        await asyncio.gather(*pending)
+        return pending & explain_tasks
+
+    with caplog.at_level(logging.WARNING, logger="database"):
+        assert client.portal.call(slow_query) == set()
+    assert "slow_query_task_check" in caplog.text
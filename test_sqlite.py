@@ -0,0 +1,439 @@
+#!/usr/bin/python3
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import autocomplete
+import crud
+import jobs
+import main
+import models
+from cache import MemoryCache, TTLCache
+from config import SQLALCHEMY_DATABASE_URL
+from database import database
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MY_INVITE", "invite")
+    monkeypatch.setattr(crud, "response_cache", MemoryCache(max_bytes=1024 * 1024, ttl=60))
+    monkeypatch.setattr(autocomplete, "indexes", TTLCache(maxsize=10, ttl=60))
+    app = main.create_app(database_url=f"sqlite:///{tmp_path}/cashflow.db", static_dir=str(tmp_path / "static"))
+    with TestClient(app) as client:
+        yield client
+    database.configure(SQLALCHEMY_DATABASE_URL)
+
+
+def login(client, username: str = "alice"):
+    response = client.post("/register", json={"username": username, "email": f"{username}@example.com",
+                                              "password": "secret", "invite": "invite"})
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+    response = client.post("/token", data={"username": username, "password": "secret"})
+    assert response.status_code == 200
+    return user_id, {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def test_sqlite_flows_and_reports(client):
+    user_id, headers = login(client)
+    month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for day, sum in ((2, 100), (3, 250)):
+        response = client.post(f"/users/{user_id}/outflow/", headers=headers,
+                               json={"date": month.replace(day=day).isoformat(), "description": "Кофе", "sum": sum})
+        assert response.status_code == 200
+    response = client.post(f"/users/{user_id}/outflow_regular/", headers=headers, json={"description": "Кофе"})
+    assert response.status_code == 200
+    response = client.post(f"/users/{user_id}/assets/", headers=headers,
+                           json={"date_in": month.isoformat(), "description": "Вклад", "sum": 1000})
+    assert response.status_code == 200
+
+    response = client.get(f"/users/{user_id}/outflow/", headers=headers)
+    assert [outflow["sum"] for outflow in response.json()["outflow"]] == [100, 250]
+
+    reports = client.get(f"/users/{user_id}/reports/", headers=headers).json()
+    assert reports["assets"] == [{"description": month.strftime("%m.%y"), "sum": 1000}]
+    assert [(outflow["description"], outflow["sum"]) for outflow in reports["outflow_regular"]] == [("Кофе", 350)]
+
+    response = client.get(f"/users/{user_id}/autocomplete", headers=headers, params={"prefix": "ко"})
+    assert response.json() == {"autocomplete": ["Кофе"]}
+
+    response = client.post(f"/users/{user_id}/outflow/import", headers=headers, params={"description_column": "1",
+                           "sum_column": "2"}, content=b"date;description;sum\n")
+    assert response.status_code == 501
+
+
+def test_sqlite_bulk_revaluation_is_atomic_and_keeps_category(client):
+    user_id, headers = login(client)
+    category_id = client.post(f"/users/{user_id}/categories/", headers=headers, json={"category": "Вклады"}).json()["id"]
+    ids = [client.post(f"/users/{user_id}/assets/", headers=headers,
+                       json={"date_in": "2026-01-01T00:00:00", "description": description, "sum": 100,
+                             "category_id": category_id}).json()["id"] for description in ("Вклад", "Счет")]
+
+    response = client.put(f"/users/{user_id}/assets/revaluation", headers=headers,
+                          json=[{"id": ids[0], "sum": 150, "date": "2026-06-10T00:00:00"}, {"id": 999, "sum": 1}])
+    assert response.status_code == 404
+    response = client.put(f"/users/{user_id}/assets/revaluation", headers=headers,
+                          json=[{"id": ids[0], "sum": 150, "date": "2026-06-10T00:00:00"},
+                                {"id": ids[1], "sum": 0, "date": "2026-06-10T00:00:00"}])
+    assert response.status_code == 200
+    assert [(asset["sum"], asset["category_id"]) for asset in response.json()["assets"]] == [(150, category_id)]
+
+    def sums(date):
+        response = client.get(f"/users/{user_id}/assets/", headers=headers, params={"date": date})
+        return sorted((asset["description"], asset["sum"]) for asset in response.json()["assets"])
+
+    assert sums("2026-05-15T00:00:00") == [("Вклад", 100), ("Счет", 100)]
+    assert sums("2026-06-15T00:00:00") == [("Вклад", 150)]
+
+
+def check_revaluation_keeps_category(client, user_id, headers, resource):
+    # одиночный PUT переоценивает с начала текущего месяца, пачка - с начала месяца date; категория сохраняется
+    month = crud.month_of(datetime.now())
+    category_id = client.post(f"/users/{user_id}/categories/", headers=headers,
+                              json={"category": resource}).json()["id"]
+    ids = [client.post(f"/users/{user_id}/{resource}/", headers=headers,
+                       json={"date_in": (month - timedelta(days=60)).isoformat(), "description": description,
+                             "sum": 100, "category_id": category_id}).json()["id"] for description in ("Первый", "Второй")]
+
+    def rows(date):
+        response = client.get(f"/users/{user_id}/{resource}/", headers=headers, params={"date": date.isoformat()})
+        return sorted((row["description"], row["sum"], row["category_id"]) for row in response.json()[resource])
+
+    response = client.put(f"/users/{user_id}/{resource}/", headers=headers,
+                          json={"id": ids[0], "description": "Первый", "sum": 150, "category_id": None})
+    assert response.status_code == 200
+    second = timedelta(seconds=1)
+    assert rows(month - second) == [("Второй", 100, category_id), ("Первый", 100, category_id)]
+    assert rows(month) == [("Второй", 100, category_id), ("Первый", 150, category_id)]
+
+    next_month = crud.month_of(month + timedelta(days=40))
+    current = [row["id"] for row in client.get(f"/users/{user_id}/{resource}/", headers=headers,
+                                               params={"date": month.isoformat()}).json()[resource]]
+    response = client.put(f"/users/{user_id}/{resource}/revaluation", headers=headers,
+                          json=[{"id": row_id, "sum": 200, "date": (next_month + timedelta(days=9)).isoformat()}
+                                for row_id in current])
+    assert response.status_code == 200
+    assert rows(next_month - second) == [("Второй", 100, category_id), ("Первый", 150, category_id)]
+    assert rows(next_month) == [("Второй", 200, category_id), ("Первый", 200, category_id)]
+
+
+def test_sqlite_revaluation_keeps_category(client):
+    user_id, headers = login(client)
+    for resource in ("assets", "liabilities"):
+        check_revaluation_keeps_category(client, user_id, headers, resource)
+
+
+def test_sqlite_dashboard_combines_month_with_totals(client):
+    user_id, headers = login(client)
+    for flow, day, sum in (("inflow", 5, 1000), ("outflow", 6, 300), ("outflow", 7, 200), ("outflow", 1, 50)):
+        month = "2026-03" if day > 1 else "2026-02"
+        response = client.post(f"/users/{user_id}/{flow}/", headers=headers,
+                               json={"date": f"{month}-{day:02d}T12:00:00", "description": "Кофе", "sum": sum})
+        assert response.status_code == 200
+    for flow, date_in, sum in (("assets", "2026-01-01", 5000), ("assets", "2026-04-01", 7000),
+                               ("liabilities", "2026-02-01", 1500)):
+        client.post(f"/users/{user_id}/{flow}/", headers=headers,
+                    json={"date_in": f"{date_in}T00:00:00", "description": flow, "sum": sum})
+
+    response = client.get(f"/users/{user_id}/dashboard", headers=headers, params={"month": "2026-03-15T00:00:00"})
+    assert response.status_code == 200
+    dashboard = response.json()
+    assert [outflow["sum"] for outflow in dashboard["outflow"]] == [300, 200]
+    assert dashboard["totals"] == {"inflow": 1000, "outflow": 500, "cashflow": 500, "assets": 5000,
+                                   "liabilities": 1500, "capital": 3500}
+
+    response = client.get(f"/users/{user_id}/dashboard", headers={**headers, "If-None-Match": response.headers["etag"]},
+                          params={"month": "2026-03-15T00:00:00"})
+    assert response.status_code == 304
+
+
+def test_sqlite_outflow_grouped_by_description_and_week(client):
+    user_id, headers = login(client)
+    # 2 марта 2026 - понедельник, 8 марта - воскресенье той же недели
+    for date, description, sum in (("2026-03-02T10:00:00", "Кофе", 10), ("2026-03-08T23:00:00", "Кофе", 20),
+                                   ("2026-03-08T12:00:00", "Такси", 5), ("2026-03-09T00:30:00", "Кофе", 1)):
+        client.post(f"/users/{user_id}/outflow/", headers=headers,
+                    json={"date": date, "description": description, "sum": sum})
+    period = {"date_in": "2026-03-01T00:00:00", "date_out": "2026-03-31T23:59:59"}
+
+    response = client.get(f"/users/{user_id}/outflow/", headers=headers, params={**period, "group_by": "description"})
+    assert response.json()["outflow"] == [{"description": "Кофе", "sum": 31, "count": 3},
+                                          {"description": "Такси", "sum": 5, "count": 1}]
+    response = client.get(f"/users/{user_id}/outflow/", headers=headers, params={**period, "group_by": "week"})
+    assert response.json()["outflow"] == [{"date": "2026-03-02T00:00:00", "sum": 35, "count": 3},
+                                          {"date": "2026-03-09T00:00:00", "sum": 1, "count": 1}]
+
+    response = client.get(f"/users/{user_id}/outflow/", headers=headers,
+                          params={**period, "group_by": "day", "limit": 10})
+    assert response.status_code == 400
+    assert client.get("/openapi.json").status_code == 200
+
+
+def test_sqlite_export_keeps_files_of_listed_jobs(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "EXPORT_DIR", str(tmp_path / "export"))
+    monkeypatch.setattr(jobs, "jobs", dict())
+    monkeypatch.setattr(jobs, "jobs_by_key", dict())
+    monkeypatch.setattr(jobs, "workers", None)
+    user_id, headers = login(client)
+
+    def export():
+        job = client.post(f"/users/{user_id}/export/jobs", headers=headers).json()
+        for _ in range(100):
+            job = client.get(f"/users/{user_id}/export/jobs/{job['id']}", headers=headers).json()
+            if job["status"] != "pending" and job["status"] != "running":
+                break
+            time.sleep(0.05)
+        assert job["status"] == "done"
+        return job["id"]
+
+    first = export()
+    client.post(f"/users/{user_id}/outflow/", headers=headers, json={"description": "Кофе", "sum": 100})
+    second = export()
+    assert first != second
+    # новая выгрузка не удаляет файл задачи, которая еще числится выполненной
+    for job_id in (first, second):
+        response = client.get(f"/users/{user_id}/export/jobs/{job_id}/file", headers=headers)
+        assert response.status_code == 200
+        assert response.content[:2] == b"PK"
+    assert jobs.jobs[first].readers == 0
+    # ответ, который не был отправлен (клиент ушел раньше), не оставляет задачу занятой
+    jobs.ArtifactResponse(jobs.jobs[first], "cashflow.xlsx")
+    assert jobs.jobs[first].readers == 0
+
+
+def check_regular_sum_follows_latest_flow(client, user_id, headers, flow):
+    client.post(f"/users/{user_id}/{flow}_regular/", headers=headers, json={"description": "Кофе", "sum": 50})
+
+    def regular_sum():
+        response = client.get(f"/users/{user_id}/{flow}_regular/", headers=headers)
+        return response.json()[f"{flow}_regular"][0]["sum"]
+
+    def create(date, sum):
+        response = client.post(f"/users/{user_id}/{flow}/", headers=headers,
+                               json={"date": date, "description": "Кофе", "sum": sum})
+        return response.json()["id"]
+
+    assert regular_sum() == 50
+    march = create("2026-03-10T00:00:00", 100)
+    latest = create("2026-03-20T00:00:00", 200)
+    older = create("2026-02-01T00:00:00", 300)
+    assert regular_sum() == 200
+    # при равных датах последней считается более поздняя запись
+    same_date = create("2026-03-20T00:00:00", 400)
+    assert regular_sum() == 400
+    for flow_id, expected in ((same_date, 200), (latest, 100), (march, 300), (older, 50)):
+        response = client.delete(f"/users/{user_id}/{flow}/", headers=headers, params={f"{flow}_id": flow_id})
+        assert response.json() == {"result": f"{flow} deleted"}
+        assert regular_sum() == expected
+
+
+def test_sqlite_regular_sums_follow_latest_flow(client):
+    user_id, headers = login(client)
+    for flow in ("inflow", "outflow"):
+        check_regular_sum_follows_latest_flow(client, user_id, headers, flow)
+
+
+def check_foreign_ids_are_not_found(client, owner, stranger):
+    # изменение и удаление по чужим id отвечают "не найдено" и не трогают записи владельца
+    (owner_id, owner_headers), (stranger_id, stranger_headers) = owner, stranger
+    period = {"date_in": "2026-03-01T00:00:00", "date_out": "2026-03-31T23:59:59"}
+    ids = {}
+    for resource, body in (("categories", {"category": "Вклады"}),
+                           ("inflow", {"date": "2026-03-05T00:00:00", "description": "Зарплата", "sum": 1000}),
+                           ("outflow", {"date": "2026-03-06T00:00:00", "description": "Кофе", "sum": 100}),
+                           ("inflow_regular", {"description": "Зарплата", "sum": 1000}),
+                           ("outflow_regular", {"description": "Кофе", "sum": 100}),
+                           ("assets", {"description": "Вклад", "sum": 1000}),
+                           ("liabilities", {"description": "Кредит", "sum": 500})):
+        if resource in ("assets", "liabilities"):
+            body["category_id"] = ids["categories"]
+        response = client.post(f"/users/{owner_id}/{resource}/", headers=owner_headers, json=body)
+        assert response.status_code == 200
+        ids[resource] = response.json()["id"]
+
+    def owner_data():
+        return [client.get(f"/users/{owner_id}/{resource}/", headers=owner_headers,
+                           params=period if resource in ("inflow", "outflow") else None).json()
+                for resource in ids]
+
+    before = owner_data()
+    stranger_url = f"/users/{stranger_id}"
+    for flow in ("inflow", "outflow"):
+        response = client.delete(f"{stranger_url}/{flow}/", headers=stranger_headers,
+                                 params={f"{flow}_id": ids[flow]})
+        assert response.json() == {"result": f"{flow} for delete not found"}
+        regular = f"{flow}_regular"
+        response = client.put(f"{stranger_url}/{regular}/", headers=stranger_headers,
+                              json={"id": ids[regular], "description": "Чужое", "sum": 1})
+        assert response.json() == {"result": f"{flow} regular for update not found"}
+        response = client.delete(f"{stranger_url}/{regular}/", headers=stranger_headers,
+                                 params={f"{regular}_id": ids[regular]})
+        assert response.json() == {"result": f"regular {flow} for delete not found"}
+    for resource, name in (("assets", "asset"), ("liabilities", "liabilitie")):
+        response = client.put(f"{stranger_url}/{resource}/", headers=stranger_headers,
+                              json={"id": ids[resource], "description": "Чужое", "sum": 1, "category_id": None})
+        assert response.json() == {"result": f"{name} for update/delete not found"}
+        response = client.request("DELETE", f"{stranger_url}/{resource}/", headers=stranger_headers,
+                                  json={"id": ids[resource]})
+        assert response.json() == {"result": f"{name} for update/delete not found"}
+        response = client.put(f"{stranger_url}/{resource}/revaluation", headers=stranger_headers,
+                              json=[{"id": ids[resource], "sum": 1}])
+        assert response.status_code == 404
+    response = client.delete(f"{stranger_url}/categories/", headers=stranger_headers,
+                             params={"category_id": ids["categories"]})
+    assert response.json() == {"result": "category for delete not found"}
+    assert owner_data() == before
+
+
+def test_sqlite_foreign_ids_are_not_found(client):
+    check_foreign_ids_are_not_found(client, login(client), login(client, "bob"))
+
+
+def test_sqlite_bulk_create_returns_rows_without_cursor(client):
+    user_id, headers = login(client)
+    response = client.post(f"/users/{user_id}/outflow/bulk", headers=headers,
+                           json=[{"description": "Кофе", "sum": 100}, {"description": "Такси", "sum": 300}])
+    assert response.status_code == 200
+    assert list(response.json()) == ["outflow"]
+    assert [(outflow["description"], outflow["sum"]) for outflow in response.json()["outflow"]] == \
+        [("Кофе", 100), ("Такси", 300)]
+
+
+def test_sqlite_ndjson_listing_answers_conditional_requests(client):
+    user_id, headers = login(client)
+    client.post(f"/users/{user_id}/outflow/", headers=headers, json={"description": "Кофе", "sum": 100})
+    headers = {**headers, "Accept": "application/x-ndjson"}
+    response = client.get(f"/users/{user_id}/outflow/", headers=headers)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert len(response.text.splitlines()) == 1
+    response = client.get(f"/users/{user_id}/outflow/", headers={**headers, "If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+def test_sqlite_etag_changes_with_data_user_and_query(client):
+    alice_id, alice = login(client)
+    bob_id, bob = login(client, "bob")
+    period = {"date_in": "2026-03-01T00:00:00", "date_out": "2026-03-31T23:59:59"}
+
+    def etag(user_id, headers, params):
+        response = client.get(f"/users/{user_id}/outflow/", headers=headers, params=params)
+        assert response.status_code == 200
+        return response.headers["etag"]
+
+    first = etag(alice_id, alice, period)
+    # у пользователей с одинаковыми (пустыми) данными и одним запросом разные ETag, как и у разных запросов
+    assert first != etag(bob_id, bob, period)
+    assert first != etag(alice_id, alice, {**period, "date_out": "2026-03-30T23:59:59"})
+    assert first != etag(alice_id, alice, {**period, "group_by": "day"})
+
+    conditional = {**alice, "If-None-Match": first}
+    assert client.get(f"/users/{alice_id}/outflow/", headers=conditional, params=period).status_code == 304
+    client.post(f"/users/{alice_id}/outflow/", headers=alice,
+                json={"date": "2026-03-05T00:00:00", "description": "Кофе", "sum": 100})
+    response = client.get(f"/users/{alice_id}/outflow/", headers=conditional, params=period)
+    assert response.status_code == 200
+    assert response.headers["etag"] != first
+    assert [outflow["sum"] for outflow in response.json()["outflow"]] == [100]
+    # изменение другого пользователя не сбрасывает ETag
+    client.post(f"/users/{bob_id}/outflow/", headers=bob, json={"description": "Кофе", "sum": 100})
+    conditional = {**alice, "If-None-Match": response.headers["etag"]}
+    assert client.get(f"/users/{alice_id}/outflow/", headers=conditional, params=period).status_code == 304
+
+
+def test_sqlite_cached_reports_follow_current_month(client):
+    user_id, headers = login(client)
+    client.post(f"/users/{user_id}/assets/", headers=headers,
+                json={"date_in": "2026-01-01T00:00:00", "description": "Вклад", "sum": 1000})
+    for month, last in ((datetime(2026, 3, 1), "03.26"), (datetime(2026, 4, 1), "04.26")):
+        reports = client.portal.call(lambda: crud.get_reports(user_id=user_id, month=month))
+        assert reports["assets"][0] == {"description": last, "sum": 1000}
+
+
+def test_sqlite_cache_follows_writes_of_other_workers(client):
+    user_id, headers = login(client)
+    period = {"date_in": "2026-03-01T00:00:00", "date_out": "2026-03-31T23:59:59"}
+
+    def sums():
+        response = client.get(f"/users/{user_id}/outflow/", headers=headers, params=period)
+        return [outflow["sum"] for outflow in response.json()["outflow"]]
+
+    client.post(f"/users/{user_id}/outflow/", headers=headers,
+                json={"date": "2026-03-05T00:00:00", "description": "Кофе", "sum": 100})
+    assert sums() == [100]
+    # запись через другой процесс: строки и версия меняются в базе, теги этого процесса не сбрасываются
+    with database.get_engine().begin() as connection:
+        connection.execute(models.outflows.insert().values(date=datetime(2026, 3, 6), description="Такси", sum=300,
+                                                           owner_id=user_id))
+        connection.execute(models.data_versions.update().where(models.data_versions.c.owner_id == user_id)
+                           .where(models.data_versions.c.resource == "outflow")
+                           .values(version=models.data_versions.c.version + 1))
+    assert sums() == [100, 300]
+    dashboard = client.get(f"/users/{user_id}/dashboard", headers=headers, params={"month": "2026-03-01T00:00:00"})
+    assert [outflow["sum"] for outflow in dashboard.json()["outflow"]] == [100, 300]
+
+
+def test_secret_key_is_generated_only_in_sqlite_mode(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(main, "MY_INVITE", "invite")
+    monkeypatch.setattr(main, "SECRET_KEY", None)
+    app = main.create_app(database_url="postgresql://cashflow@127.0.0.1:1/cashflow", static_dir=str(tmp_path))
+    with pytest.raises(RuntimeError, match="SECRET_KEY"):
+        with TestClient(app):
+            pass
+    app = main.create_app(database_url=f"sqlite:///{tmp_path}/cashflow.db", static_dir=str(tmp_path))
+    try:
+        with TestClient(app) as client:
+            login(client)
+    finally:
+        database.configure(SQLALCHEMY_DATABASE_URL)
+    assert main.SECRET_KEY
+    assert "SECRET_KEY is not set" in caplog.text
+
+
+def test_sqlite_autocomplete_ignores_rolled_back_flows(client):
+    user_id, headers = login(client)
+    client.post(f"/users/{user_id}/outflow/", headers=headers, json={"description": "Кофе", "sum": 100})
+    assert client.get(f"/users/{user_id}/autocomplete", headers=headers, params={"prefix": "к"}).json() == \
+        {"autocomplete": ["Кофе"]}
+
+    async def create_and_fail():
+        async with crud.transaction():
+            await crud.flows_created("outflow", user_id, [{"id": 10 ** 6, "date": datetime(2026, 3, 1),
+                                                           "description": "Капучино", "sum": 200}])
+            raise RuntimeError("rollback")
+
+    with pytest.raises(RuntimeError):
+        client.portal.call(create_and_fail)
+    assert client.get(f"/users/{user_id}/autocomplete", headers=headers, params={"prefix": "к"}).json() == \
+        {"autocomplete": ["Кофе"]}
+
+
+def test_sqlite_dashboards_share_a_limit_of_parallel_reads(client, monkeypatch):
+    user_id, headers = login(client)
+    monkeypatch.setattr(crud, "DASHBOARD_CONCURRENCY", 3)
+    monkeypatch.setattr(crud, "dashboard_reads", None)
+    running = {"now": 0, "peak": 0}
+    for name in ("get_inflow_user", "get_outflow_user", "get_inflow_regular_user", "get_outflow_regular_user",
+                 "get_assets_user", "get_liabilities_user", "get_user_categories", "get_most_popular"):
+        async def read(*args, read=getattr(crud, name), **kwargs):
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            try:
+                await asyncio.sleep(0.01)
+                return await read(*args, **kwargs)
+            finally:
+                running["now"] -= 1
+        monkeypatch.setattr(crud, name, read)
+
+    async def two_dashboards():
+        month = {"date_in": datetime(2026, 3, 1), "date_out": datetime(2026, 3, 31, 23, 59, 59),
+                 "date": datetime(2026, 3, 31, 23, 59, 59)}
+        return await asyncio.gather(crud.get_dashboard(user_id=user_id, **month),
+                                    crud.get_dashboard(user_id=user_id, **month))
+
+    dashboards = client.portal.call(two_dashboards)
+    assert [dashboard["totals"]["cashflow"] for dashboard in dashboards] == [0, 0]
+    assert running["peak"] == 3